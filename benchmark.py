@@ -0,0 +1,370 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from esrgan_integration import ESRGANHandler
+from ffmpeg_integration import FFmpegHandler, check_process
+from streaming import StreamingPipeline
+from utils import setup_logging
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Bumped whenever the layout of the JSON report changes
+REPORT_VERSION = 2
+
+
+class StageTimer:
+    """Collects wall-clock samples, in seconds, for named pipeline stages."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> dict:
+        return {stage: summarize(samples) for stage, samples in self.samples.items()}
+
+
+def summarize(samples: List[float]) -> dict:
+    values = np.asarray(samples, dtype=np.float64) * 1000.0
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "calls": len(samples),
+        "total_ms": float(values.sum()),
+        "mean_ms": float(values.mean()),
+        "min_ms": float(values.min()),
+        "p50_ms": float(p50),
+        "p90_ms": float(p90),
+        "p99_ms": float(p99),
+        "max_ms": float(values.max()),
+    }
+
+
+def peak_rss_bytes() -> Optional[Tuple[int, int]]:
+    # Peak resident set size of this process and of the children it has
+    # waited for (the FFmpeg processes)
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    unit = 1 if sys.platform == "darwin" else 1024
+    return usage * unit, children * unit
+
+
+def make_test_clip(
+    path: str, width: int, height: int, frame_count: int, frame_rate: int = 24
+):
+    # Synthetic clip from the lavfi test source, so that runs are reproducible
+    # without shipping footage
+    ffmpeg_command = [
+        "ffmpeg",
+        "-y",
+        "-v",
+        "error",
+        "-f",
+        "lavfi",
+        "-i",
+        f"testsrc=size={width}x{height}:rate={frame_rate}",
+        "-frames:v",
+        str(frame_count),
+        *FFmpegHandler().encoder_arguments(),
+        path,
+    ]
+    logging.info(f"Running FFmpeg command: {' '.join(ffmpeg_command)}")
+    subprocess.run(ffmpeg_command, check=True, capture_output=True)
+
+
+def run_stages(
+    esrgan_handler: ESRGANHandler,
+    ffmpeg_handler: FFmpegHandler,
+    clip: str,
+    output_video: str,
+    batch_size: int,
+) -> dict:
+    # Runs the stages one after the other on the same thread, so that each
+    # sample only measures its own stage
+    width, height = ffmpeg_handler.get_frame_size(clip)
+    frame_rate = ffmpeg_handler.get_frame_rate(clip)
+    frame_bytes = width * height * 3
+    upsampler = esrgan_handler.upsampler
+    scale = esrgan_handler.scale
+    timer = StageTimer()
+
+    decoder = ffmpeg_handler.open_decoder(clip)
+    encoder = ffmpeg_handler.open_encoder(
+        output_video, width * scale, height * scale, frame_rate
+    )
+    frame_count = 0
+    first_frame_seconds = None
+    start = time.perf_counter()
+    end_of_stream = False
+    while not end_of_stream:
+        frames = []
+        while len(frames) < batch_size:
+            with timer.measure("decode"):
+                data = decoder.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                end_of_stream = True
+                break
+            frames.append(np.frombuffer(data, np.uint8).reshape(height, width, 3))
+        if not frames:
+            break
+
+        # The path ESRGANHandler.upscale_batch runs: padding, inference and
+        # the conversion back to frames in one call on reused buffers
+        with timer.measure("upscale"):
+            outputs = upsampler.enhance_batch_into(frames, bit_depth=8, outscale=scale)
+        for frame in outputs:
+            with timer.measure("encode"):
+                encoder.stdin.write(frame.tobytes())
+            if first_frame_seconds is None:
+                first_frame_seconds = time.perf_counter() - start
+        frame_count += len(frames)
+
+    # Flushing the encoder is part of the encode stage
+    with timer.measure("encode"):
+        encoder.stdin.close()
+        encoder.wait()
+    elapsed = time.perf_counter() - start
+    decoder.stdout.close()
+    for process in (decoder, encoder):
+        check_process(process)
+    return {
+        "frames": frame_count,
+        "seconds": elapsed,
+        "fps": frame_count / elapsed,
+        # From the start of the decoder to the first frame handed to the
+        # encoder
+        "first_frame_seconds": first_frame_seconds,
+        "stages": timer.summary(),
+        "bytes_written": os.path.getsize(output_video),
+    }
+
+
+def run_pipeline(
+    esrgan_handler: ESRGANHandler,
+    ffmpeg_handler: FFmpegHandler,
+    clip: str,
+    output_video: str,
+    batch_size: int,
+) -> dict:
+    # The threaded streaming pipeline used for real jobs, where the stages
+    # overlap
+    pipeline = StreamingPipeline(
+        ffmpeg_handler, esrgan_handler.upscale_batch, batch_size=batch_size
+    )
+    start = time.perf_counter()
+    frame_count = pipeline.run(clip, output_video)
+    elapsed = time.perf_counter() - start
+    return {
+        "frames": frame_count,
+        "seconds": elapsed,
+        "fps": frame_count / elapsed,
+        "bytes_written": os.path.getsize(output_video),
+    }
+
+
+def run_case(clip: str, esrgan_settings: dict, batch_size: int, pipeline: bool) -> dict:
+    setup_logging()
+    ffmpeg_handler = FFmpegHandler()
+    esrgan_handler = ESRGANHandler(**esrgan_settings)
+    start = time.perf_counter()
+    esrgan_handler.upsampler = esrgan_handler.create_upsampler()
+    result = {"model_load_seconds": time.perf_counter() - start}
+    start = time.perf_counter()
+    esrgan_handler.prepare(*ffmpeg_handler.get_frame_size(clip))
+    result["warmup_seconds"] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as work_folder:
+        output_video = os.path.join(work_folder, "output.mp4")
+        result["sequential"] = run_stages(
+            esrgan_handler, ffmpeg_handler, clip, output_video, batch_size
+        )
+        # Latency of a fresh worker: loading the model, warming it up and
+        # getting the first frame through the stages
+        result["cold_start_seconds"] = (
+            result["model_load_seconds"]
+            + result["warmup_seconds"]
+            + result["sequential"]["first_frame_seconds"]
+        )
+        if pipeline:
+            result["pipeline"] = run_pipeline(
+                esrgan_handler, ffmpeg_handler, clip, output_video, batch_size
+            )
+    rss = peak_rss_bytes()
+    if rss is not None:
+        result["peak_rss_bytes"], result["peak_child_rss_bytes"] = rss
+    return result
+
+
+def environment() -> dict:
+    import torch
+
+    from realesrgan.version import __version__
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "realesrgan": __version__,
+    }
+
+
+def parse_resolution(value: str):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure the upscaling pipeline on synthetic clips."
+    )
+    parser.add_argument(
+        "--resolutions",
+        nargs="+",
+        type=parse_resolution,
+        default=[(320, 240), (640, 360)],
+        help="Input sizes as WIDTHxHEIGHT",
+    )
+    parser.add_argument(
+        "--tiles", nargs="+", type=int, default=[0], help="Tile sizes, 0 for none"
+    )
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--frames", type=int, default=24, help="Frames per clip")
+    parser.add_argument(
+        "--model-path",
+        default=None,
+        help="Weights (.pth, URL or ncnn .param), defaults to the bundled models",
+    )
+    parser.add_argument("--scale", type=int, default=2, help="Output scale")
+    parser.add_argument("--half", action="store_true", help="fp16 inference")
+    parser.add_argument("--device", default=None, help="Torch device, e.g. cpu")
+    parser.add_argument(
+        "--inference-mode",
+        choices=["script", "compile", "eager", "none"],
+        default="eager",
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="Warm the model up for the clip size before timing the stages",
+    )
+    parser.add_argument(
+        "--no-pipeline",
+        action="store_true",
+        help="Only time the stages one after the other",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Run all cases in this process, peak RSS is then cumulative",
+    )
+    parser.add_argument(
+        "-o", "--output", default=None, help="Write the JSON report to this file"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    setup_logging()
+    report = {"version": REPORT_VERSION, "environment": environment(), "cases": []}
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_clips_") as clip_folder:
+        for width, height in args.resolutions:
+            clip = os.path.join(clip_folder, f"testsrc_{width}x{height}.mp4")
+            make_test_clip(clip, width, height, args.frames)
+            for tile in args.tiles:
+                for batch_size in args.batch_sizes:
+                    esrgan_settings = {
+                        "model_path": args.model_path,
+                        "scale": args.scale,
+                        "tile": tile,
+                        "half": args.half,
+                        "device": args.device,
+                        "batch_size": batch_size,
+                        "inference_mode": (
+                            None
+                            if args.inference_mode == "none"
+                            else args.inference_mode
+                        ),
+                        "warmup": args.warmup,
+                    }
+                    case_args = (
+                        clip,
+                        esrgan_settings,
+                        batch_size,
+                        not args.no_pipeline,
+                    )
+                    logging.info(
+                        f"Benchmarking {width}x{height}, tile {tile}, "
+                        f"batch size {batch_size}"
+                    )
+                    if args.in_process:
+                        result = run_case(*case_args)
+                    else:
+                        # A fresh process per case keeps the peak RSS and the
+                        # model load time of the cases independent
+                        with concurrent.futures.ProcessPoolExecutor(
+                            max_workers=1,
+                            mp_context=multiprocessing.get_context("spawn"),
+                        ) as executor:
+                            result = executor.submit(run_case, *case_args).result()
+                    report["cases"].append(
+                        {
+                            "width": width,
+                            "height": height,
+                            "tile": tile,
+                            "batch_size": batch_size,
+                            **result,
+                        }
+                    )
+                    logging.info(
+                        f"{result['cold_start_seconds']:.2f}s to the first frame, "
+                        f"{result['sequential']['fps']:.2f} fps sequential"
+                        + (
+                            f", {result['pipeline']['fps']:.2f} fps pipelined"
+                            if "pipeline" in result
+                            else ""
+                        )
+                    )
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,516 @@
+import bisect
+import functools
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, List, NamedTuple, Optional, Sequence
+
+from crop_detection import CropBox, CroppedUpscaler
+from encoding import EncoderProfile, split_threads
+from esrgan_integration import ESRGANHandler
+from ffmpeg_integration import FFmpegHandler
+from frame_cache import DirtyTileUpscaler, FrameDeduplicator
+from job_manifest import JobManifest, fingerprint_file
+from metrics import REGISTRY
+from scene_detection import ShotSplitter
+from streaming import (
+    FRAMES_DECODED,
+    FRAMES_ENCODED,
+    FRAMES_UPSCALED,
+    StreamingPipeline,
+)
+
+SEGMENTS_DONE = REGISTRY.counter("segments_done_total", "Segments upscaled")
+SEGMENT_BYTES = REGISTRY.counter(
+    "segment_bytes_total", "Bytes of encoded segment files written"
+)
+
+# Stages of a segment whose frame counts are reported while it runs
+SEGMENT_STAGES = ("decode", "upscale", "encode")
+# Seconds between the progress messages of a worker process, per stage
+WORKER_PROGRESS_INTERVAL = 0.25
+
+
+class Segment(NamedTuple):
+    index: int
+    start: float
+    # None for the last segment, which runs to the end of the video
+    end: Optional[float]
+
+
+def plan_segments(
+    keyframe_times: List[float],
+    duration: float,
+    count: int,
+    preferred_times: Sequence[float] = (),
+) -> List[Segment]:
+    # Split at the keyframes closest to evenly spaced points in time, so every
+    # segment can be decoded on its own. A preferred keyframe (one on a shot
+    # cut) within a quarter of a segment of the point wins over the closest.
+    # All times count from the start of the video, as -ss and
+    # FFmpegHandler.get_keyframe_times do.
+    boundaries = [0.0]
+    slack = duration / count / 4
+    for i in range(1, count):
+        target = duration * i / count
+        first = bisect.bisect_left(preferred_times, target - slack)
+        last = bisect.bisect_right(preferred_times, target + slack)
+        nearby = preferred_times[first:last]
+        if not nearby:
+            position = bisect.bisect_left(keyframe_times, target)
+            nearby = keyframe_times[max(position - 1, 0) : position + 1]
+        if not nearby:
+            break
+        keyframe_time = min(nearby, key=lambda t: abs(t - target))
+        if keyframe_time > boundaries[-1]:
+            boundaries.append(keyframe_time)
+    ends = boundaries[1:] + [None]
+    return [
+        Segment(index, start, end)
+        for index, (start, end) in enumerate(zip(boundaries, ends))
+    ]
+
+
+def cut_keyframes(
+    keyframe_times: List[float], cut_times: Sequence[float], tolerance: float
+) -> List[float]:
+    # The keyframes within tolerance of a shot cut. Encoders usually put one
+    # on every cut, a cut without one cannot be a segment boundary.
+    keyframes = []
+    for cut_time in cut_times:
+        position = bisect.bisect_left(keyframe_times, cut_time - tolerance)
+        if (
+            position < len(keyframe_times)
+            and keyframe_times[position] <= cut_time + tolerance
+        ):
+            keyframes.append(keyframe_times[position])
+    return keyframes
+
+
+# Handlers live for the lifetime of a worker process, so the segments it
+# processes share one loaded model
+_worker_handlers = {}
+# Queue of the (segment index, stage, frames) progress of a worker process
+_worker_progress = None
+
+
+def _init_worker(threads: int, progress_queue=None):
+    global _worker_progress
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    _worker_progress = progress_queue
+    import torch
+
+    torch.set_num_threads(threads)
+
+
+class _QueueProgress:
+    # Sends the frame counts of a segment from a worker process to the
+    # parent, at most once per interval and stage plus the last count
+    def __init__(self, progress_queue, index: int):
+        self.progress_queue = progress_queue
+        self.index = index
+        self.sent = {}
+        self.pending = {}
+
+    def __call__(self, stage: str, frames: int):
+        now = time.monotonic()
+        if now - self.sent.get(stage, float("-inf")) < WORKER_PROGRESS_INTERVAL:
+            self.pending[stage] = frames
+            return
+        self.sent[stage] = now
+        self.pending.pop(stage, None)
+        self.progress_queue.put((self.index, stage, frames))
+
+    def flush(self):
+        for stage, frames in self.pending.items():
+            self.progress_queue.put((self.index, stage, frames))
+        self.pending = {}
+
+
+def _upscale_segment(
+    video_file: str,
+    segment: Segment,
+    segment_video: str,
+    esrgan_settings: dict,
+    dedup: bool,
+    dedup_threshold: float,
+    probe_cache_folder: Optional[str] = None,
+    encoder_profile: Optional[EncoderProfile] = None,
+    crop_box: Optional[CropBox] = None,
+    dirty_tiles: bool = False,
+    dirty_tile_threshold: float = 2.0,
+    cuts: Optional[Sequence[int]] = None,
+    progress_callback: Optional[Callable[[str, int], None]] = None,
+) -> int:
+    # progress_callback gets the frames of the segment decoded, upscaled and
+    # encoded so far. In a worker process they go to the queue of the pool.
+    key = tuple(sorted(esrgan_settings.items()))
+    if key not in _worker_handlers:
+        _worker_handlers[key] = ESRGANHandler(**esrgan_settings)
+    esrgan_handler = _worker_handlers[key]
+    ffmpeg_handler = FFmpegHandler(probe_cache_folder, encoder_profile)
+
+    upscale = esrgan_handler.upscale_batch
+    tile_upscaler = dedup_upscaler = None
+    if dirty_tiles:
+        # One cache per segment, the first frame of each is upscaled whole
+        upscale = tile_upscaler = DirtyTileUpscaler(
+            esrgan_handler, dirty_tile_threshold
+        )
+    width, height = ffmpeg_handler.get_frame_size(video_file)
+    if crop_box is not None:
+        upscale = CroppedUpscaler(upscale, crop_box, esrgan_handler.scale)
+        width, height = crop_box.width, crop_box.height
+    if dedup:
+        upscale = dedup_upscaler = FrameDeduplicator(
+            upscale, threshold=dedup_threshold
+        )
+    frame_rate = ffmpeg_handler.probe(video_file).fps
+    if cuts:
+        upscale = ShotSplitter(
+            upscale,
+            cuts,
+            # segment.start counts from the start of the video, on the
+            # constant frame rate grid of the decoder like the cuts
+            first_frame=round(segment.start * frame_rate),
+            stages=(dedup_upscaler, tile_upscaler),
+        )
+    pipeline = StreamingPipeline(
+        ffmpeg_handler,
+        upscale,
+        batch_size=esrgan_handler.prepare(
+            width,
+            height,
+            tile_upscaler.tile_cache.tile_size if tile_upscaler else None,
+        ),
+    )
+
+    start, frames = None, None
+    if segment.index > 0:
+        # Seek half a frame before the keyframe so it is not dropped by
+        # rounding, the frames before it are discarded by FFmpeg
+        start = segment.start - 0.5 / frame_rate
+    if segment.end is not None:
+        # The decoder outputs frames at the constant frame rate of the probe,
+        # so the count follows from the times of the boundaries on variable
+        # frame rate sources too
+        frames = round((segment.end - segment.start) * frame_rate)
+    # Encode under a temporary name, so a segment file only exists complete
+    root, extension = os.path.splitext(segment_video)
+    partial_video = f"{root}.partial{extension}"
+    # The other streams are copied once, when the segments are joined
+    queue_progress = None
+    if progress_callback is None and _worker_progress is not None:
+        progress_callback = queue_progress = _QueueProgress(
+            _worker_progress, segment.index
+        )
+    frame_count = pipeline.run(
+        video_file,
+        partial_video,
+        progress_callback=progress_callback,
+        start=start,
+        frames=frames,
+        copy_streams=False,
+    )
+    if queue_progress is not None:
+        queue_progress.flush()
+    os.replace(partial_video, segment_video)
+    if dedup:
+        dedup_upscaler.report(f"{video_file} segment {segment.index}")
+    if dirty_tiles:
+        tile_upscaler.report(f"{video_file} segment {segment.index}")
+    return frame_count
+
+
+class ChunkedProcessor:
+    """Upscale one video in keyframe-aligned segments across worker processes.
+
+    Every worker process loads its own model and is limited to
+    ``threads_per_worker`` threads. The segments are encoded independently and
+    joined with the concat demuxer without re-encoding. With ``resume``, the
+    finished segments are recorded in a manifest next to the output so that a
+    rerun of an interrupted job only processes the remaining ones.
+    """
+
+    def __init__(
+        self,
+        ffmpeg_handler: FFmpegHandler,
+        esrgan_settings: dict,
+        workers: Optional[int] = None,
+        threads_per_worker: Optional[int] = None,
+        segments_per_worker: int = 2,
+        max_segment_duration: float = 300.0,
+        dedup: bool = True,
+        dedup_threshold: float = 0.0,
+        resume: bool = True,
+        crop_detect: bool = False,
+        dirty_tiles: bool = False,
+        dirty_tile_threshold: float = 2.0,
+        scene_cuts: bool = False,
+    ):
+        cpu_count = os.cpu_count() or 1
+        self.ffmpeg_handler = ffmpeg_handler
+        self.esrgan_settings = esrgan_settings
+        self.workers = workers or max(1, cpu_count // 4)
+        # Each worker runs an upscaler and an encoder, split its cores
+        upscaler_threads, encoder_threads = split_threads(cpu_count, self.workers)
+        self.threads_per_worker = (
+            threads_per_worker or esrgan_settings.get("threads") or upscaler_threads
+        )
+        self.encoder_profile = ffmpeg_handler.encoder_profile
+        if self.encoder_profile.threads is None:
+            self.encoder_profile = self.encoder_profile._replace(
+                threads=encoder_threads
+            )
+        self.segments_per_worker = segments_per_worker
+        self.max_segment_duration = max_segment_duration
+        self.dedup = dedup
+        self.dedup_threshold = dedup_threshold
+        self.resume = resume
+        # Upscale only the active area of letterboxed videos
+        self.crop_detect = crop_detect
+        self.crop_box = None
+        # Upscale only the tiles that changed since the previous frames
+        self.dirty_tiles = dirty_tiles
+        self.dirty_tile_threshold = dirty_tile_threshold
+        # Split at shot cuts, and start the caches over at every cut
+        self.scene_cuts = scene_cuts
+        self.shot_index = None
+
+    def job_settings(self) -> dict:
+        # Everything that changes the upscaled frames
+        # Thread counts do not change the frames, a job can resume with others
+        esrgan_settings = dict(self.esrgan_settings)
+        esrgan_settings.pop("threads", None)
+        return {
+            "esrgan": esrgan_settings,
+            "encoder": self.encoder_profile._replace(threads=None)._asdict(),
+            "dedup": self.dedup,
+            "dedup_threshold": self.dedup_threshold,
+            "crop": list(self.crop_box) if self.crop_box else None,
+            "dirty_tile_threshold": (
+                self.dirty_tile_threshold if self.dirty_tiles else None
+            ),
+            "scene_cuts": self.scene_cuts,
+        }
+
+    def plan(self, video_file: str) -> List[Segment]:
+        duration = self.ffmpeg_handler.get_duration(video_file)
+        keyframe_times = self.ffmpeg_handler.get_keyframe_times(video_file)
+        # Enough segments to keep every worker busy, and short enough that an
+        # interrupted job does not lose much work
+        count = max(
+            self.workers * self.segments_per_worker,
+            math.ceil(duration / self.max_segment_duration),
+        )
+        preferred_times = []
+        if self.shot_index is not None:
+            fps = self.ffmpeg_handler.probe(video_file).fps
+            preferred_times = cut_keyframes(
+                keyframe_times, self.shot_index.cut_times(fps), 0.5 / fps
+            )
+        return plan_segments(keyframe_times, duration, count, preferred_times)
+
+    def run(
+        self,
+        video_file: str,
+        output_video: str,
+        progress_callback: Optional[Callable[[str, int], None]] = None,
+    ):
+        self.crop_box = None
+        if self.crop_detect:
+            self.crop_box = self.ffmpeg_handler.detect_crop(video_file)
+        self.shot_index = None
+        if self.scene_cuts:
+            self.shot_index = self.ffmpeg_handler.get_shot_index(video_file)
+        manifest = None
+        completed = {}
+        if self.resume:
+            manifest = JobManifest(output_video + ".manifest.jsonl")
+            source = fingerprint_file(video_file)
+            settings = self.job_settings()
+        if manifest is not None and manifest.matches(source, settings):
+            if manifest.done and os.path.exists(output_video):
+                logging.info(f"Skipping {video_file}, already upscaled")
+                return
+            segments = [Segment(*segment) for segment in manifest.plan]
+            completed = manifest.completed_segments()
+            logging.info(
+                f"Resuming {video_file}: {len(completed)}/{len(segments)} "
+                f"segments already upscaled"
+            )
+        else:
+            segments = self.plan(video_file)
+            if manifest is not None:
+                manifest.start(source, settings, [list(s) for s in segments])
+        logging.info(
+            f"Splitting {video_file} into {len(segments)} segments "
+            f"across {self.workers} workers"
+        )
+
+        work_folder = output_video + ".segments"
+        os.makedirs(work_folder, exist_ok=True)
+        extension = os.path.splitext(output_video)[1]
+        segment_videos = [
+            os.path.join(work_folder, f"segment_{segment.index:05d}{extension}")
+            for segment in segments
+        ]
+        pending = [
+            (segment, segment_video)
+            for segment, segment_video in zip(segments, segment_videos)
+            if segment.index not in completed
+        ]
+
+        # Progress is reported in frames per stage, summed over the segments
+        # as their frames go through
+        progress = _SegmentProgress(progress_callback)
+        for index, record in completed.items():
+            progress.finish(index, record["frames"])
+        for segment, segment_video, frames in self.upscale_segments(
+            video_file, pending, progress.update
+        ):
+            SEGMENTS_DONE.inc()
+            SEGMENT_BYTES.inc(os.path.getsize(segment_video))
+            if manifest is not None:
+                manifest.mark_segment(segment.index, segment_video, frames)
+            progress.finish(segment.index, frames)
+        frames_done = progress.total("encode")
+
+        self.ffmpeg_handler.concat_videos(
+            segment_videos, output_video, source_video=video_file
+        )
+        if progress_callback:
+            progress_callback("concat", frames_done)
+        if manifest is not None:
+            manifest.mark_done(output_video)
+        shutil.rmtree(work_folder)
+
+    def upscale_segments(
+        self,
+        video_file: str,
+        pending: list,
+        progress_callback: Optional[Callable[[int, str, int], None]] = None,
+    ):
+        # Yields (segment, segment_video, frames) as segments finish.
+        # progress_callback gets the segment index, the stage and the frames
+        # of the segment through that stage so far.
+        arguments = (
+            self.esrgan_settings,
+            self.dedup,
+            self.dedup_threshold,
+            self.ffmpeg_handler.probe_cache_folder,
+            self.encoder_profile,
+            self.crop_box,
+            self.dirty_tiles,
+            self.dirty_tile_threshold,
+            self.shot_index.cuts if self.shot_index else None,
+        )
+        if self.workers == 1:
+            # No worker process needed, keep the model in this process
+            for segment, segment_video in pending:
+                segment_progress = None
+                if progress_callback:
+                    segment_progress = functools.partial(
+                        progress_callback, segment.index
+                    )
+                frames = _upscale_segment(
+                    video_file,
+                    segment,
+                    segment_video,
+                    *arguments,
+                    progress_callback=segment_progress,
+                )
+                yield segment, segment_video, frames
+            return
+
+        context = multiprocessing.get_context("spawn")
+        progress_queue = context.Queue() if progress_callback else None
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.threads_per_worker, progress_queue),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _upscale_segment, video_file, segment, segment_video, *arguments
+                ): (segment, segment_video)
+                for segment, segment_video in pending
+            }
+            try:
+                running = set(futures)
+                while running:
+                    done, running = wait(
+                        running,
+                        timeout=WORKER_PROGRESS_INTERVAL,
+                        return_when=FIRST_COMPLETED,
+                    )
+                    if progress_queue is not None:
+                        _drain_progress(progress_queue, progress_callback)
+                    for future in done:
+                        segment, segment_video = futures[future]
+                        frames = future.result()
+                        # Worker processes have their own metrics registry,
+                        # count their frames here once the segment is done
+                        for counter in (
+                            FRAMES_DECODED,
+                            FRAMES_UPSCALED,
+                            FRAMES_ENCODED,
+                        ):
+                            counter.inc(frames)
+                        yield segment, segment_video, frames
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+
+def _drain_progress(progress_queue, progress_callback):
+    while True:
+        try:
+            index, stage, frames = progress_queue.get_nowait()
+        except queue.Empty:
+            return
+        progress_callback(index, stage, frames)
+
+
+class _SegmentProgress:
+    # Frames of every segment through each stage, reported as the sum over
+    # the segments. Counts of a finished segment are final, late messages of
+    # its worker are ignored.
+    def __init__(self, progress_callback: Optional[Callable[[str, int], None]]):
+        self.progress_callback = progress_callback
+        self.frames = {stage: {} for stage in SEGMENT_STAGES}
+        self.finished = set()
+        self._lock = threading.Lock()
+
+    def update(self, index: int, stage: str, frames: int):
+        with self._lock:
+            if index in self.finished or stage not in self.frames:
+                return
+            self.frames[stage][index] = frames
+            total = sum(self.frames[stage].values())
+        if self.progress_callback:
+            self.progress_callback(stage, total)
+
+    def finish(self, index: int, frames: int):
+        with self._lock:
+            self.finished.add(index)
+            for stage_frames in self.frames.values():
+                stage_frames[index] = frames
+            totals = {
+                stage: sum(stage_frames.values())
+                for stage, stage_frames in self.frames.items()
+            }
+        if self.progress_callback:
+            for stage, total in totals.items():
+                self.progress_callback(stage, total)
+
+    def total(self, stage: str) -> int:
+        with self._lock:
+            return sum(self.frames[stage].values())
@@ -0,0 +1,356 @@
+import argparse
+import logging
+import sys
+
+from encoding import CODECS, PROFILES
+from esrgan_integration import ESRGANHandler
+from frame_store import FRAME_FORMATS
+from model_registry import MODELS
+from metrics import JsonFileSink, LogSink, MetricsReporter, PrometheusEndpoint
+from scheduler import FAILED, JobScheduler
+from utils import setup_logging
+from video_processor import VideoProcessor
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Upscale videos without a display server."
+    )
+    parser.add_argument(
+        "videos", nargs="+", help="Videos to upscale, or images with --images"
+    )
+    parser.add_argument(
+        "-o", "--output", required=True, help="Destination folder for the results"
+    )
+    parser.add_argument(
+        "--images",
+        action="store_true",
+        help="The inputs are image files, upscale them in batches in process",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Pipe frames through the in-process upscaler instead of frame folders",
+    )
+    parser.add_argument(
+        "--frame-format",
+        choices=FRAME_FORMATS,
+        default="png",
+        help="Intermediate frames without --streaming: png, png0 (uncompressed "
+        "PNG), jpg, raw (one memory-mapped file) or lz4",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes per video, more than one implies --streaming",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Do not checkpoint segments, always start from scratch",
+    )
+    parser.add_argument(
+        "--no-dedup", action="store_true", help="Upscale repeated frames again"
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=0.0,
+        help="Mean absolute error (8-bit levels) below which frames count as repeats",
+    )
+    parser.add_argument(
+        "--dirty-tiles",
+        action="store_true",
+        help="Upscale only the tiles that changed since the previous frame",
+    )
+    parser.add_argument(
+        "--dirty-tile-threshold",
+        type=float,
+        default=2.0,
+        help="Mean absolute error (8-bit levels) of an 8x8 block above which a "
+        "tile counts as changed",
+    )
+    parser.add_argument(
+        "--scene-cuts",
+        action="store_true",
+        help="Find the shot cuts first, reset the frame caches and split "
+        "segments at them",
+    )
+    parser.add_argument(
+        "--concurrent",
+        action="store_true",
+        help="Upscale several videos at once within --cpu-budget and --memory-budget",
+    )
+    parser.add_argument(
+        "--cpu-budget",
+        type=int,
+        default=None,
+        help="Threads shared by the concurrent videos, defaults to every core",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="MiB shared by the concurrent videos, defaults to 80%% of the memory",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=1,
+        help="Times a failed video is retried with --concurrent",
+    )
+    parser.add_argument(
+        "--crop",
+        action="store_true",
+        help="Detect black bars and upscale only the picture inside them",
+    )
+    parser.add_argument(
+        "--model",
+        choices=sorted(MODELS),
+        default=None,
+        help="Model family to upscale with, the member closest to --scale is used",
+    )
+    parser.add_argument(
+        "--model-path",
+        default=None,
+        help="Weights (.pth, URL or ncnn .param), defaults to those of --model",
+    )
+    parser.add_argument("--scale", type=int, default=2, help="Output scale")
+    parser.add_argument("--tile", type=int, default=0, help="Tile size, 0 for none")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--half", action="store_true", help="fp16 inference")
+    parser.add_argument("--device", default=None, help="Torch device, e.g. cpu")
+    parser.add_argument(
+        "--inference-mode",
+        choices=["script", "compile", "eager", "none"],
+        default="eager",
+        help="How the network is prepared for inference",
+    )
+    parser.add_argument(
+        "--quantized",
+        action="store_true",
+        help="--model-path is an int8 archive from realesrgan.quantization",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="Upscaler threads per worker"
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="Run the model on blank frames before each video, so that the "
+        "first frames run at full speed",
+    )
+    parser.add_argument(
+        "--encoder-profile",
+        choices=sorted(PROFILES),
+        default="balanced",
+        help="Encoder settings, the options below override them",
+    )
+    parser.add_argument("--encoder", choices=sorted(CODECS), default=None)
+    parser.add_argument("--preset", default=None, help="Encoder preset")
+    parser.add_argument("--crf", type=int, default=None, help="Encoder CRF")
+    parser.add_argument("--tune", default=None, help="Encoder tune")
+    parser.add_argument(
+        "--encoder-threads",
+        type=int,
+        default=None,
+        help="Encoder threads per worker, 0 for the encoder default",
+    )
+    parser.add_argument("--ten-bit", action="store_true", help="Encode 10-bit video")
+    parser.add_argument(
+        "--probe-cache",
+        default=None,
+        help="Folder where ffprobe results are kept between runs",
+    )
+    parser.add_argument(
+        "--metrics-log", action="store_true", help="Log the pipeline metrics"
+    )
+    parser.add_argument(
+        "--metrics-json", default=None, help="Append metric snapshots to this file"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the metrics in the Prometheus format on this local port",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between metric reports",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    # The registry models are float weights, a quantized archive has to be given
+    if args.quantized and not args.model_path:
+        parser.error("--quantized needs --model-path to an int8 archive")
+    return args
+
+
+def create_scheduler(args, esrgan_handler, encoder_profile, processor_options):
+    memory_budget = args.memory_budget * 1024**2 if args.memory_budget else None
+    scheduler = JobScheduler(
+        args.output,
+        esrgan_handler.get_settings(),
+        encoder_profile,
+        cpu_budget=args.cpu_budget,
+        memory_budget=memory_budget,
+        **processor_options,
+    )
+    scheduler.job_finished.connect(lambda job: logging.info(f"Wrote {job.output}"))
+    logged_percent = {}
+
+    def log_progress(job, fraction):
+        percent = int(fraction * 100)
+        if logged_percent.get(job.job_id) != percent:
+            logged_percent[job.job_id] = percent
+            logging.info(f"{job.video_file}: {percent}%")
+
+    scheduler.job_progress.connect(log_progress)
+    return scheduler
+
+
+def run_scheduler(scheduler, video_files, retries) -> int:
+    failed = False
+    for video_file in video_files:
+        try:
+            scheduler.submit(video_file, max_retries=retries)
+        except Exception as error:
+            logging.error(f"Cannot queue {video_file}: {error}")
+            failed = True
+    scheduler.run()
+    if failed or any(job.state == FAILED for job in scheduler.jobs):
+        return 1
+    return 0
+
+
+def upscale_images(esrgan_handler, image_files, destination_folder) -> int:
+    total = len(image_files)
+    logged_percent = None
+
+    def log_progress(count):
+        nonlocal logged_percent
+        percent = count * 100 // total
+        if percent != logged_percent:
+            logged_percent = percent
+            logging.info(f"Images: {count}/{total} ({percent}%)")
+
+    outputs = esrgan_handler.upscale_images(
+        image_files, destination_folder, progress_callback=log_progress
+    )
+    logging.info(f"Wrote {len(outputs)} images to {destination_folder}")
+    return 0
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    setup_logging()
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    esrgan_handler = ESRGANHandler(
+        model_path=args.model_path,
+        scale=args.scale,
+        tile=args.tile,
+        half=args.half,
+        device=args.device,
+        batch_size=args.batch_size,
+        inference_mode=None if args.inference_mode == "none" else args.inference_mode,
+        quantized=args.quantized,
+        threads=args.threads,
+        model=args.model,
+        warmup=args.warmup,
+    )
+    encoder_profile = PROFILES[args.encoder_profile]
+    if args.encoder and args.encoder != encoder_profile.codec:
+        # The preset and CRF of another codec do not carry over
+        encoder_profile = encoder_profile._replace(
+            codec=args.encoder, preset=None, crf=None
+        )
+    overrides = {
+        "preset": args.preset,
+        "crf": args.crf,
+        "tune": args.tune,
+        "threads": args.encoder_threads,
+    }
+    encoder_profile = encoder_profile._replace(
+        **{key: value for key, value in overrides.items() if value is not None}
+    )
+    if args.ten_bit:
+        encoder_profile = encoder_profile._replace(ten_bit=True)
+    processor_options = {
+        "streaming": args.streaming,
+        "dedup": not args.no_dedup,
+        "dedup_threshold": args.dedup_threshold,
+        "workers": args.workers,
+        "resume": not args.no_resume,
+        "probe_cache_folder": args.probe_cache,
+        "frame_format": args.frame_format,
+        "crop_detect": args.crop,
+        "dirty_tiles": args.dirty_tiles,
+        "dirty_tile_threshold": args.dirty_tile_threshold,
+        "scene_cuts": args.scene_cuts,
+    }
+    if args.concurrent:
+        processor = create_scheduler(
+            args, esrgan_handler, encoder_profile, processor_options
+        )
+    else:
+        processor = VideoProcessor(
+            args.output,
+            args.videos,
+            esrgan_handler=esrgan_handler,
+            encoder_profile=encoder_profile,
+            **processor_options,
+        )
+        processor.video_started.connect(
+            lambda video_file: logging.info(f"Upscaling {video_file}")
+        )
+        processor.video_finished.connect(
+            lambda video_file, output: logging.info(f"Wrote {output}")
+        )
+        logged_percent = {}
+
+        def log_progress(video_file, report):
+            # The reports are already throttled, log whole percents only
+            if logged_percent.get(video_file) != report.percent:
+                logged_percent[video_file] = report.percent
+                logging.info(f"{video_file}: {report.describe()}")
+
+        processor.progress_detail.connect(log_progress)
+
+    sinks = []
+    if args.metrics_log:
+        sinks.append(LogSink())
+    if args.metrics_json:
+        sinks.append(JsonFileSink(args.metrics_json))
+    reporter = MetricsReporter(sinks, interval=args.metrics_interval)
+    endpoint = None
+    if args.metrics_port is not None:
+        endpoint = PrometheusEndpoint(port=args.metrics_port)
+        endpoint.start()
+    if sinks:
+        reporter.start()
+    try:
+        if args.images:
+            return upscale_images(esrgan_handler, args.videos, args.output)
+        if args.concurrent:
+            return run_scheduler(processor, args.videos, args.retries)
+        processor.run()
+    except KeyboardInterrupt:
+        logging.error("Interrupted")
+        return 130
+    except Exception:
+        logging.exception("Upscaling failed")
+        return 1
+    finally:
+        reporter.close()
+        if endpoint is not None:
+            endpoint.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import re
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+# Last box reported by FFmpeg's cropdetect filter, "crop=w:h:x:y"
+CROPDETECT_PATTERN = re.compile(r"crop=(-?\d+):(-?\d+):(-?\d+):(-?\d+)")
+
+
+class CropBox(NamedTuple):
+    """Active picture area of a frame, in source pixels."""
+
+    x: int
+    y: int
+    width: int
+    height: int
+
+    @property
+    def area(self) -> int:
+        return self.width * self.height
+
+    def describe(self) -> str:
+        return f"{self.width}x{self.height}+{self.x}+{self.y}"
+
+
+def parse_cropdetect(output: str) -> Optional[CropBox]:
+    # cropdetect logs a box per frame, each one covering the frames so far.
+    # Entirely black frames give empty or negative boxes.
+    boxes = []
+    for match in CROPDETECT_PATTERN.findall(output):
+        width, height, x, y = map(int, match)
+        boxes.append(CropBox(x, y, width, height))
+    for box in reversed(boxes):
+        if box.width > 0 and box.height > 0 and box.x >= 0 and box.y >= 0:
+            return box
+    return None
+
+
+def union(boxes: Iterable[CropBox]) -> CropBox:
+    boxes = list(boxes)
+    left = min(box.x for box in boxes)
+    top = min(box.y for box in boxes)
+    right = max(box.x + box.width for box in boxes)
+    bottom = max(box.y + box.height for box in boxes)
+    return CropBox(left, top, right - left, bottom - top)
+
+
+class CroppedUpscaler:
+    """Upscale only the active area of letterboxed or pillarboxed frames.
+
+    Wraps a batch upscale function. The frames are cropped to ``box`` before
+    the upscale and the outputs are put back on a canvas of the full output
+    size filled with ``fill``, so the stages around it see the geometry of the
+    uncropped frames.
+    """
+
+    def __init__(
+        self,
+        upscale: Callable[[List[np.ndarray]], List[np.ndarray]],
+        box: CropBox,
+        scale: int,
+        fill: int = 0,
+    ):
+        self.upscale = upscale
+        self.box = box
+        self.scale = scale
+        self.fill = fill
+
+    def __call__(self, frames: List[np.ndarray]) -> List[np.ndarray]:
+        if not frames:
+            return []
+        x, y, width, height = self.box
+        outputs = self.upscale(
+            [frame[y : y + height, x : x + width] for frame in frames]
+        )
+        frame_height, frame_width = frames[0].shape[:2]
+        s = self.scale
+        results = []
+        for output in outputs:
+            canvas = np.full(
+                (frame_height * s, frame_width * s, 3), self.fill, dtype=output.dtype
+            )
+            canvas[y * s : (y + height) * s, x * s : (x + width) * s] = output
+            results.append(canvas)
+        return results
@@ -0,0 +1,116 @@
+import os
+from typing import NamedTuple, Optional, Tuple
+
+# Per codec: FFmpeg encoder, default preset and CRF, 8-bit and 10-bit pixel
+# formats
+CODECS = {
+    "x264": ("libx264", "medium", 18, "yuv420p", "yuv420p10le"),
+    "x265": ("libx265", "medium", 20, "yuv420p", "yuv420p10le"),
+    "svt-av1": ("libsvtav1", "8", 30, "yuv420p", "yuv420p10le"),
+    "aom-av1": ("libaom-av1", "6", 30, "yuv420p", "yuv420p10le"),
+    # Lossless intermediate, keeps the upscaled RGB frames bit exact
+    "ffv1": ("ffv1", None, None, "bgr0", "gbrp10le"),
+}
+
+# Containers that can store each codec, the first one is used when the
+# source container cannot
+CONTAINERS = {
+    "x264": (".mp4", ".mkv", ".mov", ".m4v", ".avi", ".ts"),
+    "x265": (".mp4", ".mkv", ".mov", ".m4v", ".ts"),
+    "svt-av1": (".mp4", ".mkv", ".webm"),
+    "aom-av1": (".mp4", ".mkv", ".webm"),
+    "ffv1": (".mkv", ".avi", ".nut"),
+}
+
+
+class EncoderProfile(NamedTuple):
+    """How the upscaled frames are encoded.
+
+    ``preset`` and ``crf`` default to the codec's entry in CODECS. ``threads``
+    None lets the job pick a count with ``split_threads``, 0 lets the encoder
+    use every core.
+    """
+
+    codec: str = "x264"
+    preset: Optional[str] = None
+    crf: Optional[int] = None
+    threads: Optional[int] = None
+    tune: Optional[str] = None
+    ten_bit: bool = False
+
+    def arguments(self) -> list:
+        encoder, preset, crf, pix_fmt, pix_fmt_10bit = CODECS[self.codec]
+        preset = self.preset or preset
+        crf = self.crf if self.crf is not None else crf
+        if self.ten_bit:
+            pix_fmt = pix_fmt_10bit
+        arguments = ["-c:v", encoder, "-pix_fmt", pix_fmt]
+
+        if self.codec in ("x264", "x265"):
+            arguments += ["-preset", preset, "-crf", str(crf)]
+            if self.tune:
+                arguments += ["-tune", self.tune]
+            if self.codec == "x265":
+                # Plays in QuickTime and browsers only with this tag
+                arguments += ["-tag:v", "hvc1"]
+                if self.threads:
+                    arguments += ["-x265-params", f"pools={self.threads}"]
+            elif self.threads:
+                arguments += ["-threads", str(self.threads)]
+        elif self.codec == "svt-av1":
+            arguments += ["-preset", preset, "-crf", str(crf)]
+            params = []
+            if self.tune:
+                params.append(f"tune={self.tune}")
+            if self.threads:
+                params.append(f"lp={self.threads}")
+            if params:
+                arguments += ["-svtav1-params", ":".join(params)]
+        elif self.codec == "aom-av1":
+            arguments += ["-cpu-used", preset, "-crf", str(crf), "-b:v", "0"]
+            arguments += ["-row-mt", "1"]
+            if self.tune:
+                arguments += ["-tune", self.tune]
+            if self.threads:
+                arguments += ["-threads", str(self.threads)]
+        elif self.codec == "ffv1":
+            # Version 3 with slices encodes and decodes on several threads
+            arguments += ["-level", "3", "-slices", "16", "-slicecrc", "1"]
+            if self.threads:
+                arguments += ["-threads", str(self.threads)]
+        return arguments
+
+    @property
+    def rgb(self) -> bool:
+        return CODECS[self.codec][3].startswith(("bgr", "gbr"))
+
+    def output_path(self, path: str) -> str:
+        # Keeps the extension when the container can store the codec
+        root, extension = os.path.splitext(path)
+        containers = CONTAINERS[self.codec]
+        if extension.lower() in containers:
+            return path
+        return root + containers[0]
+
+
+# Named profiles for the common trade-offs, all CPU encoders
+PROFILES = {
+    "fast": EncoderProfile("x264", preset="veryfast", crf=20),
+    "balanced": EncoderProfile("x264"),
+    "small": EncoderProfile("x265", preset="medium", crf=22, ten_bit=True),
+    "av1": EncoderProfile("svt-av1", preset="8", crf=30, ten_bit=True),
+    "lossless": EncoderProfile("ffv1"),
+}
+
+
+def split_threads(
+    cpu_count: Optional[int] = None, workers: int = 1, encoder_share: float = 0.25
+) -> Tuple[int, int]:
+    # Upscaler and encoder threads for each of the workers, so that the
+    # pipelines together use every core once. The upscaler is the slower
+    # stage and gets the larger share.
+    cpu_count = cpu_count or os.cpu_count() or 1
+    per_worker = max(1, cpu_count // max(1, workers))
+    encoder_threads = max(1, round(per_worker * encoder_share))
+    upscaler_threads = max(1, per_worker - encoder_threads)
+    return upscaler_threads, encoder_threads
@@ -1,30 +1,356 @@
+import itertools
 import os
 import logging
 import subprocess
+import time
+from typing import List, Optional, Sequence
+import numpy as np
+from crop_detection import CropBox, CroppedUpscaler
+from frame_cache import DirtyTileUpscaler
+from frame_store import FrameStore, ImageFrameStore
+from scene_detection import ShotSplitter
+from metrics import REGISTRY
+from model_registry import DEFAULT_MODEL, MODELS, select_model
 from utils import handle_subprocess_error
 
+IMAGE_READ_STALL_SECONDS = REGISTRY.counter(
+    "image_read_stall_seconds_total", "Time the upscaler waited for images to be read"
+)
+IMAGE_WRITE_BACKPRESSURE_SECONDS = REGISTRY.counter(
+    "image_write_backpressure_seconds_total",
+    "Time the upscaler waited for queued images to be written",
+)
+
+
 class ESRGANHandler:
-    def __init__(self):
+    def __init__(
+        self,
+        model_path: Optional[str] = None,
+        scale: int = 2,
+        tile: int = 0,
+        half: bool = False,
+        device=None,
+        batch_size: int = None,
+        inference_mode: Optional[str] = "eager",
+        quantized: bool = False,
+        threads: Optional[int] = None,
+        model: Optional[str] = None,
+        warmup: bool = False,
+    ):
         self.realesrgan_executable = os.path.join(
             "realesrgan", "realesrgan_ncnn_vulkan.exe"
         )
+        # The registry model of the family closest to the target scale, so
+        # that the output needs no resize when the family allows it
+        self.model = model
+        self.spec = select_model(model or DEFAULT_MODEL, scale)
+        if model_path is None:
+            model_path = self.spec.weights()
+            self.model = self.spec.name
+        elif model is None:
+            # A file of our own, its architecture is guessed below
+            self.spec = None
+        self.model_path = model_path
+        self.scale = scale
+        self.tile = tile
+        self.half = half
+        self.device = device
+        self.batch_size = batch_size
+        self.inference_mode = inference_mode
+        self.quantized = quantized
+        # PyTorch threads, None keeps the PyTorch default
+        self.threads = threads
+        # Run the model on blank frames before the first ones of a video
+        self.warmup = warmup
+        self.upsampler = None
+
+    def get_settings(self) -> dict:
+        # Constructor arguments, so worker processes can build their own handler
+        return {
+            "model_path": self.model_path,
+            "scale": self.scale,
+            "tile": self.tile,
+            "half": self.half,
+            "device": self.device,
+            "batch_size": self.batch_size,
+            "inference_mode": self.inference_mode,
+            "quantized": self.quantized,
+            "threads": self.threads,
+            "model": self.model,
+            "warmup": self.warmup,
+        }
 
     def run_subprocess(self, command: list):
         try:
             subprocess.run(command, check=True)
         except subprocess.CalledProcessError as e:
             handle_subprocess_error(e, command)
+            raise
 
-    def upscale_frames(self, frame_folder: str):
-        output_folder = os.path.join(os.path.dirname(frame_folder), "upscaled_frames")
-        os.makedirs(output_folder, exist_ok=True)
+    def upscale_frames(
+        self,
+        source: FrameStore,
+        target: FrameStore,
+        progress_callback=None,
+        crop_box: Optional[CropBox] = None,
+        dirty_tile_threshold: Optional[float] = None,
+        cuts: Optional[Sequence[int]] = None,
+    ):
+        # Upscales every frame of the source store into the target store.
+        # progress_callback gets the number of frames upscaled so far, with a
+        # crop_box only the active area of the frames is upscaled, with a
+        # dirty_tile_threshold only the tiles that changed (see
+        # DirtyTileUpscaler), whose cache starts over at the frames in cuts.
+        image_stores = isinstance(source, ImageFrameStore) and isinstance(
+            target, ImageFrameStore
+        )
+        if (
+            not image_stores
+            or crop_box is not None
+            or dirty_tile_threshold is not None
+            or not os.path.exists(self.realesrgan_executable)
+        ):
+            # The executable only reads whole images from folders, and is
+            # Windows only
+            self.upscale_store(
+                source,
+                target,
+                progress_callback,
+                crop_box,
+                dirty_tile_threshold,
+                cuts,
+            )
+            return
+        spec = self.spec or MODELS[DEFAULT_MODEL]
+        if spec.ncnn_name is None:
+            raise ValueError(f"{spec.name} has no ncnn model for the executable")
+        if spec.ncnn_scale != self.scale:
+            # The executable cannot resize its output, the target store is
+            # sized for self.scale
+            self.upscale_store(source, target, progress_callback, cuts=cuts)
+            return
         realesrgan_command = [
             self.realesrgan_executable,
-            "-i", frame_folder,
-            "-o", output_folder,
-            "-n", "realesr-animevideov3",
-            "-s", "2",
-            "-f", "png",
-            "-g", "1"  # Using GPU ID 1, change if GPU ID is different
+            "-i", source.folder,
+            "-o", target.folder,
+            "-n", spec.ncnn_name,
+            "-s", str(spec.ncnn_scale),
+            "-f", target.extension[1:],
         ]
+        gpu_id = self.get_gpu_id()
+        if gpu_id is not None:
+            realesrgan_command += ["-g", str(gpu_id)]
+        if self.tile:
+            realesrgan_command += ["-t", str(self.tile)]
+        if self.threads:
+            # load:proc:save threads
+            realesrgan_command += ["-j", f"1:{self.threads}:2"]
         self.run_subprocess(realesrgan_command)
+
+    def upscale_store(
+        self,
+        source: FrameStore,
+        target: FrameStore,
+        progress_callback=None,
+        crop_box: Optional[CropBox] = None,
+        dirty_tile_threshold: Optional[float] = None,
+        cuts: Optional[Sequence[int]] = None,
+    ):
+        # In-process counterpart of the executable, for any frame format
+        upscale = self.upscale_batch
+        dirty_tiles = None
+        if dirty_tile_threshold is not None:
+            upscale = dirty_tiles = DirtyTileUpscaler(self, dirty_tile_threshold)
+        width, height = source.width, source.height
+        if crop_box is not None:
+            upscale = CroppedUpscaler(upscale, crop_box, self.scale)
+            width, height = crop_box.width, crop_box.height
+        if cuts and dirty_tiles is not None:
+            upscale = ShotSplitter(upscale, cuts, stages=(dirty_tiles,))
+        batch_size = self.prepare(
+            width, height, dirty_tiles.tile_cache.tile_size if dirty_tiles else None
+        )
+        frame_count = 0
+        with target.open_writer() as writer:
+            batch = []
+            for frame in itertools.chain(source.frames(), [None]):
+                if frame is not None:
+                    batch.append(frame)
+                    if len(batch) < batch_size:
+                        continue
+                for output in upscale(batch):
+                    writer.append(output)
+                frame_count += len(batch)
+                batch = []
+                if progress_callback:
+                    progress_callback(frame_count)
+        if dirty_tiles is not None:
+            dirty_tiles.report()
+
+    def upscale_images(
+        self,
+        image_paths: List[str],
+        output_folder: str,
+        extension: str = ".png",
+        progress_callback=None,
+    ) -> List[str]:
+        # In-process upscaling of image files. Reads and writes run on thread
+        # pools next to the inference, consecutive images of one shape and
+        # bit depth are upscaled as a batch. progress_callback gets the number of images
+        # written so far.
+        from realesrgan.utils import ImageReaderPool, ImageWriterPool
+
+        if self.upsampler is None:
+            self.upsampler = self.create_upsampler()
+        os.makedirs(output_folder, exist_ok=True)
+        output_paths = [
+            os.path.join(
+                output_folder, os.path.splitext(os.path.basename(path))[0] + extension
+            )
+            for path in image_paths
+        ]
+        written = 0
+
+        def image_written(path):
+            nonlocal written
+            written += 1
+            if progress_callback:
+                progress_callback(written)
+
+        reader = ImageReaderPool(image_paths)
+        writer = ImageWriterPool(callback=image_written)
+        with reader, writer:
+            batch, batch_paths = [], []
+
+            def flush():
+                for output, path in zip(self.upscale_batch(batch), batch_paths):
+                    writer.put(path, output)
+                batch.clear()
+                batch_paths.clear()
+
+            for (_, image), output_path in zip(reader, output_paths):
+                if image.ndim != 3 or image.shape[2] != 3:
+                    # Gray and alpha images are not batched
+                    output, _ = self.upsampler.enhance(image, outscale=self.scale)
+                    writer.put(output_path, output)
+                    continue
+                if batch and (
+                    image.shape != batch[0].shape
+                    or image.dtype != batch[0].dtype
+                    or len(batch) >= self.get_batch_size(*image.shape[1::-1])
+                ):
+                    flush()
+                batch.append(image)
+                batch_paths.append(output_path)
+            if batch:
+                flush()
+        IMAGE_READ_STALL_SECONDS.inc(reader.stall_seconds)
+        IMAGE_WRITE_BACKPRESSURE_SECONDS.inc(writer.backpressure_seconds)
+        logging.debug(
+            f"Upscaled {written} images, waited {reader.stall_seconds:.2f}s on "
+            f"reads and {writer.backpressure_seconds:.2f}s on writes"
+        )
+        return output_paths
+
+    def get_gpu_id(self) -> Optional[int]:
+        # The executable takes a Vulkan device index: device=1, "1" or
+        # "cuda:1". None lets it pick the default GPU.
+        if self.device is None:
+            return None
+        index = str(self.device).rpartition(":")[2]
+        return int(index) if index.isdigit() else None
+
+    def create_upsampler(self):
+        # Imported here so the executable backend does not require PyTorch
+        from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+        from realesrgan.ncnn_loader import get_ncnn_scale
+        from realesrgan.utils import RealESRGANer
+
+        if self.threads:
+            import torch
+
+            torch.set_num_threads(self.threads)
+        logging.info(f"Loading upscaling model: {self.model_path}")
+        if self.quantized:
+            # int8 archive written by realesrgan.quantization
+            return RealESRGANer(
+                scale=self.scale,
+                model_path=self.model_path,
+                tile=self.tile,
+                batch_size=self.batch_size,
+                quantized=True,
+            )
+        options = {
+            "model_path": self.model_path,
+            "tile": self.tile,
+            "half": self.half,
+            "device": self.device,
+            "batch_size": self.batch_size,
+            "inference_mode": self.inference_mode,
+        }
+        if self.model_path.endswith(".param"):
+            # The network is rebuilt from the ncnn graph
+            return RealESRGANer(scale=get_ncnn_scale(self.model_path), **options)
+
+        spec = self.spec or MODELS[DEFAULT_MODEL]
+        if spec.arch == "rrdb":
+            from basicsr.archs.rrdbnet_arch import RRDBNet
+
+            model = RRDBNet(
+                num_in_ch=3,
+                num_out_ch=3,
+                num_feat=spec.num_feat,
+                num_block=spec.num_block,
+                num_grow_ch=32,
+                scale=spec.native_scale,
+            )
+        else:
+            model = SRVGGNetCompact(
+                num_in_ch=3,
+                num_out_ch=3,
+                num_feat=spec.num_feat,
+                num_conv=spec.num_conv,
+                upscale=spec.native_scale,
+                act_type="prelu",
+            )
+        return RealESRGANer(scale=spec.native_scale, model=model, **options)
+
+    def prepare(self, width: int, height: int, tile_size: Optional[int] = None) -> int:
+        # Loads the model before the frames of a video of that size arrive
+        # and, with warmup, primes its kernels for the batch shape so that
+        # the first batch runs at full speed. tile_size is the one of a
+        # DirtyTileUpscaler, whose tiles are the shapes that run. Returns the
+        # batch size.
+        if self.upsampler is None:
+            self.upsampler = self.create_upsampler()
+        if self.warmup:
+            start = time.perf_counter()
+            if self.upsampler.warmup(height, width, tile_size=tile_size):
+                logging.info(
+                    f"Warmed up the model for {width}x{height} frames in "
+                    f"{time.perf_counter() - start:.2f}s"
+                )
+        return self.get_batch_size(width, height)
+
+    def get_batch_size(self, width: int, height: int) -> int:
+        if self.batch_size:
+            return self.batch_size
+        if self.upsampler is None:
+            self.upsampler = self.create_upsampler()
+        return self.upsampler.estimate_batch_size(height, width)
+
+    def upscale_batch(self, frames, tile_cache=None):
+        # In-process upscaling of BGR frames sharing one shape, used by the
+        # streaming mode. With a tile_cache, the frames are the next frames
+        # of a video and only their changed tiles are upscaled.
+        if not frames:
+            return []
+        if self.upsampler is None:
+            self.upsampler = self.create_upsampler()
+        # The decoders hand over 8-bit frames, 16-bit ones only come from
+        # image files
+        bit_depth = 16 if frames[0].dtype == np.uint16 else 8
+        outputs = self.upsampler.enhance_batch_into(
+            frames, bit_depth=bit_depth, outscale=self.scale, tile_cache=tile_cache
+        )
+        return list(outputs)
@@ -0,0 +1,33 @@
+import logging
+import threading
+from typing import Callable, List
+
+
+class Signal:
+    """A minimal pure-Python stand-in for ``pyqtSignal``.
+
+    Callbacks run synchronously in the thread that emits. GUI code that needs
+    them on its own thread connects a Qt signal's ``emit`` instead.
+    """
+
+    def __init__(self):
+        self._callbacks: List[Callable] = []
+        self._lock = threading.Lock()
+
+    def connect(self, callback: Callable):
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def disconnect(self, callback: Callable):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def emit(self, *args):
+        with self._lock:
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                # A broken listener must not take the processing down with it
+                logging.exception(f"Error in event callback {callback!r}")
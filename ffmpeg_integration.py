@@ -1,57 +1,440 @@
+import collections
 import subprocess
 import os
+import hashlib
+import json
 import logging
+import threading
+from fractions import Fraction
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+from crop_detection import CropBox, parse_cropdetect, union
+from encoding import EncoderProfile
+from frame_store import FrameStore
+from progress import FFmpegProgressParser
+from scene_detection import ANALYSIS_HEIGHT, ANALYSIS_WIDTH, SceneCutDetector, ShotIndex
 from utils import handle_subprocess_error
 
 
+class AudioStream(NamedTuple):
+    index: int
+    codec_name: str
+    channels: int
+    sample_rate: int
+    language: Optional[str]
+
+
+class VideoInfo(NamedTuple):
+    width: int
+    height: int
+    # Exact rational, e.g. "24000/1001", FFmpeg accepts it for -r and fps=
+    frame_rate: str
+    duration: float
+    frame_count: int
+    pix_fmt: str
+    color_range: Optional[str]
+    color_space: Optional[str]
+    color_transfer: Optional[str]
+    color_primaries: Optional[str]
+    audio_streams: Tuple[AudioStream, ...]
+    subtitle_codecs: Tuple[str, ...]
+    # Timestamp of the first frame. Seeks with -ss and the times of the
+    # keyframe index count from it, MPEG-TS usually starts around 1.4 s.
+    start_time: float = 0.0
+
+    @property
+    def fps(self) -> float:
+        return float(Fraction(self.frame_rate))
+
+
+# Subtitle codecs each container can store, containers not listed take any
+SUBTITLE_CODECS_BY_EXTENSION = {
+    ".mp4": {"mov_text"},
+    ".m4v": {"mov_text"},
+    ".mov": {"mov_text"},
+    ".webm": {"webvtt"},
+    ".mkv": {
+        "subrip",
+        "ass",
+        "ssa",
+        "webvtt",
+        "hdmv_pgs_subtitle",
+        "dvd_subtitle",
+        "dvb_subtitle",
+    },
+    ".avi": set(),
+}
+
+# swscale matrix for each colorspace tag ffprobe reports
+COLOR_MATRICES = {
+    "bt709": "bt709",
+    "bt470bg": "bt601",
+    "smpte170m": "bt601",
+    "smpte240m": "smpte240m",
+    "fcc": "fcc",
+    "bt2020nc": "bt2020",
+    "bt2020c": "bt2020",
+}
+
+# Lines of output kept for the error of a failed run_subprocess
+OUTPUT_TAIL_LINES = 40
+
+# Probe results by (path, mtime, size), shared by every handler in the process
+# so that each stage of a job reuses them. A file replaced on disk gets a new
+# key and is probed again.
+_probe_cache = {}
+_probe_cache_lock = threading.Lock()
+# Shot indexes by the same keys, computed once per source like the probes
+_shot_cache = {}
+
+
+def parse_probe(probe: dict) -> VideoInfo:
+    # Builds a VideoInfo from "ffprobe -show_format -show_streams -of json"
+    streams = probe.get("streams", [])
+    video = next(
+        (stream for stream in streams if stream.get("codec_type") == "video"), None
+    )
+    if video is None:
+        raise ValueError("No video stream found")
+
+    frame_rate = video.get("r_frame_rate", "0/0")
+    if frame_rate.endswith("/0") or frame_rate.startswith("0/"):
+        frame_rate = video.get("avg_frame_rate", "0/0")
+    if frame_rate.endswith("/0") or frame_rate.startswith("0/"):
+        raise ValueError("The video stream has no frame rate")
+    fraction = Fraction(frame_rate)
+    frame_rate = f"{fraction.numerator}/{fraction.denominator}"
+
+    duration = video.get("duration") or probe.get("format", {}).get("duration")
+    duration = float(duration) if duration not in (None, "N/A") else 0.0
+    start_time = video.get("start_time") or probe.get("format", {}).get("start_time")
+    start_time = float(start_time) if start_time not in (None, "N/A") else 0.0
+    frame_count = video.get("nb_frames", "")
+    if frame_count.isdigit():
+        frame_count = int(frame_count)
+    else:
+        # Matroska and WebM do not store it, estimate from the duration
+        frame_count = round(duration * fraction)
+
+    audio_streams = tuple(
+        AudioStream(
+            stream["index"],
+            stream.get("codec_name", ""),
+            int(stream.get("channels", 0)),
+            int(stream.get("sample_rate", 0)),
+            stream.get("tags", {}).get("language"),
+        )
+        for stream in streams
+        if stream.get("codec_type") == "audio"
+    )
+    subtitle_codecs = tuple(
+        stream.get("codec_name", "")
+        for stream in streams
+        if stream.get("codec_type") == "subtitle"
+    )
+    return VideoInfo(
+        int(video["width"]),
+        int(video["height"]),
+        frame_rate,
+        duration,
+        frame_count,
+        video.get("pix_fmt", ""),
+        video.get("color_range"),
+        video.get("color_space"),
+        video.get("color_transfer"),
+        video.get("color_primaries"),
+        audio_streams,
+        subtitle_codecs,
+        start_time,
+    )
+
+
 class FFmpegHandler:
+    def __init__(
+        self,
+        probe_cache_folder: Optional[str] = None,
+        encoder_profile: Optional[EncoderProfile] = None,
+    ):
+        # Optional folder for probe results that outlive the process
+        self.probe_cache_folder = probe_cache_folder
+        self.encoder_profile = encoder_profile or EncoderProfile()
+
     def run_subprocess(self, command: list, progress_callback=None):
-        try:
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                universal_newlines=True,
+        # progress_callback gets the number of frames FFmpeg has output so far.
+        # Raises CalledProcessError with the last lines of the output on
+        # failure, so that no stage goes on with missing frames.
+        parser = None
+        if progress_callback and command[0] == "ffmpeg":
+            # Machine-readable progress blocks instead of the stats line
+            command = [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+            parser = FFmpegProgressParser(progress_callback)
+        # stderr is merged into stdout, the error is at the end of it
+        tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            universal_newlines=True,
+        )
+        for line in iter(process.stdout.readline, ""):
+            if parser is None or not parser.feed(line):
+                logging.debug(line.rstrip())
+                tail.append(line)
+        process.stdout.close()
+        return_code = process.wait()
+        if return_code != 0:
+            error = subprocess.CalledProcessError(
+                return_code, command, output="".join(tail)
             )
-            for line in iter(process.stdout.readline, ""):
-                print(line)  # Print every line for debugging
-                if progress_callback:
-                    progress_callback(line)
-            process.stdout.close()
-            return_code = process.wait()
-            if return_code != 0:
-                raise subprocess.CalledProcessError(return_code, command)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error running command {' '.join(command)}: {e.stderr}")
+            handle_subprocess_error(error, command)
+            raise error
+
+    def extract_frames(
+        self, video_file: str, store: FrameStore, progress_callback=None
+    ) -> int:
+        # Decodes every frame into the store and returns the frame count.
+        # progress_callback gets the number of frames extracted so far.
+        output = store.ffmpeg_output()
+        if output is not None:
+            ffmpeg_command = [
+                "ffmpeg",
+                "-y",
+                "-i",
+                video_file,
+                "-map",
+                "0:v:0",
+                "-vf",
+                f"fps={self.get_frame_rate(video_file)}",
+                *output,
+            ]
+            logging.info(f"Running FFmpeg command: {' '.join(ffmpeg_command)}")
+            self.run_subprocess(ffmpeg_command, progress_callback)
+        else:
+            decoder = self.open_decoder(video_file)
+            frame_count = 0
+            shape = (store.height, store.width, 3)
+            with store.open_writer() as writer:
+                while True:
+                    data = decoder.stdout.read(store.frame_bytes)
+                    if len(data) < store.frame_bytes:
+                        break
+                    writer.append(np.frombuffer(data, dtype=np.uint8).reshape(shape))
+                    frame_count += 1
+                    if progress_callback:
+                        progress_callback(frame_count)
+            decoder.stdout.close()
+            check_process(decoder)
+
+        frame_count = len(store)
+        if frame_count == 0:
+            raise RuntimeError(f"Failed to extract frames from {video_file}")
+        return frame_count
+
+    def cache_key(self, video_file: str) -> tuple:
+        stat = os.stat(video_file)
+        return (os.path.abspath(video_file), stat.st_mtime_ns, stat.st_size)
+
+    def cache_file(self, key: tuple, extension: str) -> Optional[str]:
+        # Where the results for the file of this key outlive the process
+        if not self.probe_cache_folder:
+            return None
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.probe_cache_folder, digest + extension)
+
+    def write_cache_file(self, cache_file: str, data: dict):
+        os.makedirs(self.probe_cache_folder, exist_ok=True)
+        # Written under a temporary name, concurrent jobs never read half
+        partial_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(partial_file, "w") as partial:
+            json.dump(data, partial)
+        os.replace(partial_file, cache_file)
+
+    def probe(self, video_file: str) -> VideoInfo:
+        # One ffprobe run per file, every property below comes from it
+        key = self.cache_key(video_file)
+        with _probe_cache_lock:
+            info = _probe_cache.get(key)
+        if info is None:
+            info = parse_probe(self.read_probe(video_file, key))
+            with _probe_cache_lock:
+                _probe_cache[key] = info
+        return info
+
+    def read_probe(self, video_file: str, key: tuple) -> dict:
+        cache_file = self.cache_file(key, ".json")
+        if cache_file is not None:
+            try:
+                with open(cache_file) as cached:
+                    return json.load(cached)
+            except (OSError, ValueError):
+                pass
+
+        ffprobe_command = [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_format",
+            "-show_streams",
+            "-of",
+            "json",
+            video_file,
+        ]
+        logging.debug(f"Running FFprobe command: {' '.join(ffprobe_command)}")
+        result = subprocess.run(
+            ffprobe_command, capture_output=True, text=True, check=True
+        )
+        probe = json.loads(result.stdout)
+
+        if cache_file is not None:
+            self.write_cache_file(cache_file, probe)
+        return probe
+
+    def get_frame_rate(self, video_file: str) -> str:
+        return self.probe(video_file).frame_rate
+
+    def get_frame_size(self, video_file: str) -> Tuple[int, int]:
+        info = self.probe(video_file)
+        return info.width, info.height
+
+    def get_duration(self, video_file: str) -> float:
+        return self.probe(video_file).duration
+
+    def get_frame_count(self, video_file: str) -> int:
+        return self.probe(video_file).frame_count
+
+    def detect_crop(
+        self,
+        video_file: str,
+        samples: int = 5,
+        frames_per_sample: int = 10,
+        limit: int = 24,
+        min_saving: float = 0.02,
+    ) -> Optional[CropBox]:
+        # Runs cropdetect on short runs of frames spread over the video. The
+        # union of their boxes keeps everything any sample shows, so a dark
+        # scene cannot crop away picture. None when the bars are too thin to
+        # be worth it.
+        info = self.probe(video_file)
+        boxes = []
+        for sample in range(samples):
+            start = info.duration * (sample + 0.5) / samples
+            ffmpeg_command = [
+                "ffmpeg",
+                "-nostdin",
+                "-ss",
+                f"{start:.3f}",
+                "-i",
+                video_file,
+                "-map",
+                "0:v:0",
+                "-frames:v",
+                str(frames_per_sample),
+                "-vf",
+                f"cropdetect=limit={limit}:round=2:reset=0",
+                "-f",
+                "null",
+                "-",
+            ]
+            result = subprocess.run(ffmpeg_command, capture_output=True, text=True)
+            box = parse_cropdetect(result.stderr)
+            if box is not None:
+                boxes.append(box)
+        if not boxes:
             return None
+        box = union(boxes)
+        full_area = info.width * info.height
+        if box.area > full_area * (1 - min_saving):
+            return None
+        logging.info(
+            f"Active area of {video_file}: {box.describe()}, "
+            f"{1 - box.area / full_area:.0%} fewer pixels to upscale"
+        )
+        return box
+
+    def get_shot_index(self, video_file: str) -> ShotIndex:
+        # Analysed once per source, kept next to its probe results
+        key = self.cache_key(video_file)
+        with _probe_cache_lock:
+            shot_index = _shot_cache.get(key)
+        if shot_index is not None:
+            return shot_index
+        # Versioned with the frame timing of detect_scenes
+        cache_file = self.cache_file(key, ".shots-v2.json")
+        if cache_file is not None:
+            try:
+                with open(cache_file) as cached:
+                    data = json.load(cached)
+                shot_index = ShotIndex(tuple(data["cuts"]), data["frame_count"])
+            except (OSError, ValueError, KeyError):
+                pass
+        if shot_index is None:
+            shot_index = self.detect_scenes(video_file)
+            if cache_file is not None:
+                self.write_cache_file(cache_file, shot_index._asdict())
+        with _probe_cache_lock:
+            _shot_cache[key] = shot_index
+        return shot_index
 
-    def extract_frames(self, video_file: str, destination_folder: str) -> str:
-        frame_folder = os.path.join(destination_folder, "temporary_frames")
-        os.makedirs(frame_folder, exist_ok=True)
-        frame_rate = self.get_frame_rate(video_file)
-        output_path = os.path.join(frame_folder, "frame_%04d.jpg")
+    def detect_scenes(
+        self, video_file: str, detector: Optional[SceneCutDetector] = None
+    ) -> ShotIndex:
+        # One decode of the whole video to small grayscale frames, analysed in
+        # chunks as they arrive. At the constant frame rate of the probe like
+        # open_decoder and extract_frames, so that the cut indices are the
+        # indices of the frames they upscale, and cut n is at n / fps from
+        # the start of the video.
+        detector = detector or SceneCutDetector()
         ffmpeg_command = [
             "ffmpeg",
+            "-v",
+            "error",
+            "-nostdin",
+            # Deblocking makes no difference at the analysis size
+            "-skip_loop_filter",
+            "all",
             "-i",
             video_file,
+            "-map",
+            "0:v:0",
             "-vf",
-            f"fps={frame_rate}",
-            "-q:v",
-            "2",
-            output_path,
+            f"fps={self.get_frame_rate(video_file)},"
+            f"scale={ANALYSIS_WIDTH}:{ANALYSIS_HEIGHT}:flags=area",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "gray",
+            "pipe:1",
         ]
-
         logging.info(f"Running FFmpeg command: {' '.join(ffmpeg_command)}")
-        result = self.run_subprocess(ffmpeg_command)
-        if result is None:
-            logging.error(f"Failed to extract frames from {video_file}")
-            return None
-
-        return frame_folder
+        process = drain_stderr(
+            subprocess.Popen(
+                ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        )
+        frame_bytes = ANALYSIS_WIDTH * ANALYSIS_HEIGHT
+        with process.stdout:
+            while True:
+                data = process.stdout.read(256 * frame_bytes)
+                count = len(data) // frame_bytes
+                if count == 0:
+                    break
+                frames = np.frombuffer(data, np.uint8, count * frame_bytes)
+                detector.feed(frames.reshape(count, ANALYSIS_HEIGHT, ANALYSIS_WIDTH))
+        check_process(process)
+        shot_index = detector.finish()
+        logging.info(
+            f"Found {len(shot_index.cuts) + 1} shots in {video_file} "
+            f"({shot_index.frame_count} frames)"
+        )
+        return shot_index
 
-    def get_frame_rate(self, video_file: str) -> str:
+    def get_keyframe_times(self, video_file: str) -> List[float]:
+        # Reads the packet index only, no frame is decoded. The times count
+        # from the start of the video like -ss and the duration, not from the
+        # timestamp of its first frame.
+        start_time = self.probe(video_file).start_time
         ffprobe_command = [
             "ffprobe",
             "-v",
@@ -59,43 +442,283 @@ class FFmpegHandler:
             "-select_streams",
             "v:0",
             "-show_entries",
-            "stream=r_frame_rate",
+            "packet=pts_time,flags",
             "-of",
-            "default=noprint_wrappers=1:nokey=1",
+            "csv=p=0",
             video_file,
         ]
+        result = subprocess.run(
+            ffprobe_command, capture_output=True, text=True, check=True
+        )
+        keyframe_times = []
+        for line in result.stdout.splitlines():
+            pts_time, _, flags = line.partition(",")
+            if "K" in flags and pts_time not in ("", "N/A"):
+                keyframe_times.append(max(float(pts_time) - start_time, 0.0))
+        return sorted(keyframe_times)
 
-        try:
-            result = subprocess.run(
-                ffprobe_command, capture_output=True, text=True, check=True
+    def open_decoder(
+        self,
+        video_file: str,
+        pix_fmt: str = "bgr24",
+        start: Optional[float] = None,
+        frames: Optional[int] = None,
+    ) -> subprocess.Popen:
+        # Decode straight to raw frames on stdout, no intermediate files.
+        # Frames come out at the constant frame rate of the probe, like from
+        # extract_frames, so that frame n is at n / fps from the start (or
+        # from start) on variable frame rate sources too.
+        ffmpeg_command = ["ffmpeg", "-v", "error", "-nostdin"]
+        if start:
+            ffmpeg_command += ["-ss", f"{start:.6f}"]
+        ffmpeg_command += ["-i", video_file]
+        if frames is not None:
+            ffmpeg_command += ["-frames:v", str(frames)]
+        ffmpeg_command += [
+            "-map",
+            "0:v:0",
+            "-vf",
+            f"fps={self.get_frame_rate(video_file)}",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            pix_fmt,
+            "pipe:1",
+        ]
+        logging.info(f"Running FFmpeg command: {' '.join(ffmpeg_command)}")
+        return drain_stderr(
+            subprocess.Popen(
+                ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
             )
-            frame_rate_str = result.stdout.strip()
-            # Frame rate is usually in the format 'num/den', we calculate it as a float
-            num, den = map(int, frame_rate_str.split("/"))
-            return str(num / den)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error extracting frame rate: {e}")
-            return "30"  # Default frame rate
+        )
+
+    def open_encoder(
+        self,
+        output_video: str,
+        width: int,
+        height: int,
+        frame_rate: str,
+        pix_fmt: str = "bgr24",
+        source_video: Optional[str] = None,
+        copy_streams: bool = True,
+    ) -> subprocess.Popen:
+        # Encode raw frames read from stdin. With a source video, its color
+        # tags are kept and, unless copy_streams is False, its other streams
+        # are copied in the same pass.
+        ffmpeg_command = [
+            "ffmpeg",
+            "-y",
+            "-v",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            pix_fmt,
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            frame_rate,
+            "-i",
+            "pipe:0",
+        ]
+        if source_video is not None and copy_streams:
+            ffmpeg_command += [
+                "-i",
+                source_video,
+                *self.stream_copy_arguments(source_video, 1, output_video),
+            ]
+        if source_video is not None:
+            ffmpeg_command += self.color_arguments(source_video)
+        ffmpeg_command += [*self.encoder_arguments(), output_video]
+        logging.info(f"Running FFmpeg command: {' '.join(ffmpeg_command)}")
+        return drain_stderr(
+            subprocess.Popen(
+                ffmpeg_command, stdin=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        )
+
+    def encoder_arguments(self) -> list:
+        return self.encoder_profile.arguments()
+
+    def stream_copy_arguments(
+        self, source_video: str, input_index: int, output_video: str
+    ) -> list:
+        # Maps the upscaled video of input 0 and copies the audio, subtitles,
+        # metadata and chapters of the source, given as input input_index
+        info = self.probe(source_video)
+        arguments = ["-map", "0:v:0", "-map", f"{input_index}:a?"]
+        extension = os.path.splitext(output_video)[1].lower()
+        supported = SUBTITLE_CODECS_BY_EXTENSION.get(extension)
+        for position, codec_name in enumerate(info.subtitle_codecs):
+            if supported is None or codec_name in supported:
+                arguments += ["-map", f"{input_index}:s:{position}"]
+            else:
+                logging.warning(
+                    f"Dropping {codec_name} subtitle stream {position} of "
+                    f"{source_video}, {extension} files cannot store it"
+                )
+        if extension in (".mkv", ".mka"):
+            # Fonts used by ASS subtitles
+            arguments += ["-map", f"{input_index}:t?"]
+        arguments += [
+            "-c:a",
+            "copy",
+            "-c:s",
+            "copy",
+            "-c:t",
+            "copy",
+            "-map_metadata",
+            str(input_index),
+            "-map_chapters",
+            str(input_index),
+        ]
+        return arguments
+
+    def color_arguments(self, source_video: str) -> list:
+        # Convert RGB back to YUV with the matrix and range of the source and
+        # tag the output like the source, so that colors do not shift
+        info = self.probe(source_video)
+        arguments = []
+        if self.encoder_profile.rgb:
+            # No YUV matrix involved, only the transfer and primaries apply
+            for option, value in (
+                ("-color_primaries", info.color_primaries),
+                ("-color_trc", info.color_transfer),
+            ):
+                if value and value != "unknown":
+                    arguments += [option, value]
+            return arguments
+        matrix = COLOR_MATRICES.get(info.color_space)
+        if matrix is not None or info.color_range in ("tv", "pc"):
+            options = []
+            if matrix is not None:
+                options.append(f"out_color_matrix={matrix}")
+            if info.color_range in ("tv", "pc"):
+                options.append(f"out_range={info.color_range}")
+            arguments += ["-vf", "scale=" + ":".join(options)]
+        for option, value in (
+            ("-color_primaries", info.color_primaries),
+            ("-color_trc", info.color_transfer),
+            ("-colorspace", info.color_space),
+            ("-color_range", info.color_range),
+        ):
+            if value and value != "unknown":
+                arguments += [option, value]
+        return arguments
+
+    def concat_videos(
+        self,
+        segment_videos: List[str],
+        output_video: str,
+        source_video: Optional[str] = None,
+    ):
+        # Join independently encoded segments with the concat demuxer, without
+        # re-encoding. The other streams of source_video are copied in the
+        # same pass.
+        list_file = output_video + ".concat.txt"
+        with open(list_file, "w") as f:
+            for segment_video in segment_videos:
+                escaped = os.path.abspath(segment_video).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        ffmpeg_command = [
+            "ffmpeg",
+            "-y",
+            "-v",
+            "error",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            list_file,
+        ]
+        if source_video is not None:
+            ffmpeg_command += [
+                "-i",
+                source_video,
+                *self.stream_copy_arguments(source_video, 1, output_video),
+            ]
+        ffmpeg_command += ["-c", "copy", output_video]
+        logging.info(f"Running FFmpeg command: {' '.join(ffmpeg_command)}")
+        try:
+            subprocess.run(ffmpeg_command, capture_output=True, text=True, check=True)
+        finally:
+            os.remove(list_file)
 
     def reassemble_video(
-        self, original_video: str, frame_folder: str, destination_folder: str
+        self,
+        original_video: str,
+        store: FrameStore,
+        output_video: str,
+        progress_callback=None,
     ):
-        upscaled_video = os.path.join(
-            destination_folder, "upscaled_" + os.path.basename(original_video)
-        )
+        # Encodes the frames of the store, with the audio and subtitles of the
+        # original video copied in the same pass
         frame_rate = self.get_frame_rate(original_video)
+        frame_input = store.ffmpeg_input(frame_rate)
+        if frame_input is None:
+            encoder = self.open_encoder(
+                output_video,
+                store.width,
+                store.height,
+                frame_rate,
+                source_video=original_video,
+            )
+            for frame_count, frame in enumerate(store.frames(), 1):
+                encoder.stdin.write(frame.data)
+                if progress_callback:
+                    progress_callback(frame_count)
+            encoder.stdin.close()
+            check_process(encoder)
+            return
         ffmpeg_command = [
             "ffmpeg",
-            "-r",
-            frame_rate,
+            "-y",
+            *frame_input,
             "-i",
-            os.path.join(frame_folder, "frame_%04d.png"),
-            "-c:v",
-            "libx264",
-            "-pix_fmt",
-            "yuv420p",
-            "-crf",
-            "18",
-            upscaled_video,
+            original_video,
+            *self.stream_copy_arguments(original_video, 1, output_video),
+            *self.color_arguments(original_video),
+            *self.encoder_arguments(),
+            output_video,
         ]
-        self.run_subprocess(ffmpeg_command)
+        logging.info(f"Running FFmpeg command: {' '.join(ffmpeg_command)}")
+        self.run_subprocess(ffmpeg_command, progress_callback)
+
+
+# Tail of the error output kept per process, in chunks of STDERR_CHUNK bytes
+STDERR_CHUNK = 64 * 1024
+STDERR_CHUNKS = 16
+
+
+def drain_stderr(process: subprocess.Popen) -> subprocess.Popen:
+    # Reads the stderr pipe of a process on a thread, so that a chatty
+    # FFmpeg cannot fill it and block while only its stdin or stdout is
+    # served. check_process gets the tail of the output from it.
+    chunks = collections.deque(maxlen=STDERR_CHUNKS)
+
+    def drain():
+        with process.stderr:
+            for chunk in iter(lambda: process.stderr.read1(STDERR_CHUNK), b""):
+                chunks.append(chunk)
+
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+    process.stderr_drain = (thread, chunks)
+    return process
+
+
+def check_process(process: subprocess.Popen):
+    # Waits for an FFmpeg process fed or read through pipes, its stderr
+    # becomes part of the error
+    return_code = process.wait()
+    drain = getattr(process, "stderr_drain", None)
+    if drain is not None:
+        thread, chunks = drain
+        thread.join()
+        stderr = b"".join(chunks).decode(errors="replace")
+    else:
+        stderr = process.stderr.read().decode(errors="replace")
+        process.stderr.close()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, process.args, stderr=stderr)
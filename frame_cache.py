@@ -0,0 +1,163 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import numpy as np
+
+
+class FrameDeduplicator:
+    """Skip upscaling of frames that repeat a recently upscaled frame.
+
+    Wraps a batch upscale function. Every frame is hashed and looked up in a
+    small LRU cache of upscaled outputs. With a threshold above zero, a frame
+    whose mean absolute error against the last upscaled frame is at most the
+    threshold (in 8-bit levels, measured on every ``sample_step``-th pixel)
+    reuses that frame's output as well, which catches held animation frames
+    that only differ by encoding noise.
+    """
+
+    def __init__(
+        self,
+        upscale: Callable[[List[np.ndarray]], List[np.ndarray]],
+        threshold: float = 0.0,
+        cache_size: int = 16,
+        sample_step: int = 4,
+    ):
+        self.upscale = upscale
+        self.threshold = threshold
+        self.cache_size = cache_size
+        self.sample_step = sample_step
+        self.cache = OrderedDict()
+        self.reference = None
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def __call__(self, frames: List[np.ndarray]) -> List[np.ndarray]:
+        outputs = [None] * len(frames)
+        # Index in `pending` of the upscale job each frame waits on
+        waiting = {}
+        pending = []
+        pending_keys = {}
+        for index, frame in enumerate(frames):
+            key = self.hash_frame(frame)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                outputs[index] = self.cache[key]
+                self.exact_hits += 1
+            elif key in pending_keys:
+                waiting[index] = pending_keys[key]
+                self.exact_hits += 1
+            elif self.is_near_reference(frame):
+                reference_key, reference_job = self.reference[1], self.reference[2]
+                if reference_job is None:
+                    outputs[index] = self.cache[reference_key]
+                else:
+                    waiting[index] = reference_job
+                self.near_hits += 1
+            else:
+                pending_keys[key] = len(pending)
+                waiting[index] = len(pending)
+                pending.append((key, frame))
+                self.reference = (self.sample(frame), key, len(pending) - 1)
+                self.misses += 1
+
+        results = self.upscale([frame for _, frame in pending]) if pending else []
+        for (key, _), result in zip(pending, results):
+            self.store(key, result)
+        for index, job in waiting.items():
+            outputs[index] = results[job]
+        if self.reference is not None:
+            # Later batches find the reference output in the cache
+            self.reference = (self.reference[0], self.reference[1], None)
+        return outputs
+
+    def hash_frame(self, frame: np.ndarray) -> bytes:
+        frame = np.ascontiguousarray(frame)
+        digest = hashlib.blake2b(frame.data, digest_size=16)
+        digest.update(repr(frame.shape).encode())
+        return digest.digest()
+
+    def sample(self, frame: np.ndarray) -> np.ndarray:
+        return frame[:: self.sample_step, :: self.sample_step].astype(np.int16)
+
+    def is_near_reference(self, frame: np.ndarray) -> bool:
+        if self.threshold <= 0 or self.reference is None:
+            return False
+        reference = self.reference[0]
+        sample = self.sample(frame)
+        if sample.shape != reference.shape:
+            return False
+        if self.reference[2] is None and self.reference[1] not in self.cache:
+            return False
+        return float(np.abs(sample - reference).mean()) <= self.threshold
+
+    def store(self, key: bytes, output: np.ndarray):
+        self.cache[key] = output
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def reset(self):
+        self.cache.clear()
+        self.reference = None
+
+    def start_shot(self):
+        # The next frame starts a new shot, it is not compared with the last
+        # upscaled frame. Exact repeats are still found in the cache.
+        self.reference = None
+
+    @property
+    def hits(self) -> int:
+        return self.exact_hits + self.near_hits
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self, video_file: Optional[str] = None):
+        logging.info(
+            f"Frame dedup{' for ' + video_file if video_file else ''}: "
+            f"{self.hits}/{self.hits + self.misses} frames reused "
+            f"({self.hit_rate:.1%}, {self.exact_hits} exact, {self.near_hits} near)"
+        )
+
+
+class DirtyTileUpscaler:
+    """Upscale only the tiles that changed since the previous frames.
+
+    A batch upscale function for the in-process upscaler of ``esrgan_handler``
+    that keeps the upscaled tiles of the frames it has seen. A tile is
+    upscaled again when a block of its padded input differs from the input of
+    its cached output by more than ``threshold`` (in 8-bit levels, averaged
+    over 8x8 blocks), the other tiles are reused. Screen recordings,
+    slideshows, talking heads and anime backgrounds only change in a few
+    tiles per frame. The frames must come in video order, one instance per
+    stream.
+    """
+
+    def __init__(self, esrgan_handler, threshold: float = 2.0, tile_size: int = 128):
+        from realesrgan.tiling import TileCache
+
+        self.esrgan_handler = esrgan_handler
+        self.tile_cache = TileCache(tile_size, threshold / 255)
+
+    def __call__(self, frames: List[np.ndarray]) -> List[np.ndarray]:
+        return self.esrgan_handler.upscale_batch(frames, tile_cache=self.tile_cache)
+
+    def reset(self):
+        self.tile_cache.reset()
+
+    def start_shot(self):
+        # Nothing of the previous shot is worth keeping
+        self.tile_cache.reset()
+
+    def report(self, video_file: Optional[str] = None):
+        cache = self.tile_cache
+        logging.info(
+            f"Dirty tiles{' for ' + video_file if video_file else ''}: "
+            f"{cache.tiles_run}/{cache.tiles_run + cache.tiles_reused} tiles "
+            f"upscaled ({cache.reuse_rate:.1%} reused)"
+        )
@@ -0,0 +1,262 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Iterator, List, Optional
+
+import cv2
+import numpy as np
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Intermediate frame formats of the disk-based mode. "png0" is PNG without
+# zlib compression, "raw" one memory-mapped file of BGR frames, "lz4" raw
+# frames with fast compression (needs the lz4 package). Only the image
+# formats can be read by the ncnn executable.
+FRAME_FORMATS = ("png", "png0", "jpg", "raw", "lz4")
+
+# ffmpeg numbers image sequences from 1, zero-padded so that the names sort
+FRAME_PATTERN = "frame_%08d"
+
+
+class FrameStore(ABC):
+    """Frames of one video exchanged between the disk-based stages.
+
+    Frames are BGR uint8 arrays, read back in the order they were appended.
+    Stores that ffmpeg can read or write directly return its arguments from
+    ``ffmpeg_input`` and ``ffmpeg_output``, the others return None and the
+    frames go through a pipe.
+    """
+
+    frame_format = None
+
+    def __init__(self, folder: str, width: int, height: int):
+        self.folder = folder
+        self.width = width
+        self.height = height
+        os.makedirs(folder, exist_ok=True)
+
+    @property
+    def frame_bytes(self) -> int:
+        return self.width * self.height * 3
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def frames(self) -> Iterator[np.ndarray]:
+        pass
+
+    @abstractmethod
+    def open_writer(self) -> "FrameWriter":
+        pass
+
+    def ffmpeg_output(self) -> Optional[List[str]]:
+        return None
+
+    def ffmpeg_input(self, frame_rate: str) -> Optional[List[str]]:
+        return None
+
+
+class FrameWriter(ABC):
+    """Appends frames to a store, use it as a context manager."""
+
+    @abstractmethod
+    def append(self, frame: np.ndarray):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ImageFrameStore(FrameStore):
+    """One image file per frame, readable by ffmpeg and the ncnn executable."""
+
+    # Per format: extension, cv2.imwrite parameters and ffmpeg output options
+    FORMATS = {
+        "png": (".png", [], []),
+        # Level 0 stores the pixels deflate-free, about 10x faster to write
+        "png0": (
+            ".png",
+            [cv2.IMWRITE_PNG_COMPRESSION, 0],
+            ["-compression_level", "0"],
+        ),
+        "jpg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 95], ["-q:v", "2"]),
+    }
+
+    def __init__(self, folder: str, width: int, height: int, frame_format="png"):
+        super().__init__(folder, width, height)
+        self.frame_format = frame_format
+        self.extension, self.params, self.ffmpeg_options = self.FORMATS[frame_format]
+        self.pattern = os.path.join(folder, FRAME_PATTERN + self.extension)
+
+    def path(self, index: int) -> str:
+        return self.pattern % (index + 1)
+
+    def paths(self) -> List[str]:
+        return [self.path(index) for index in range(len(self))]
+
+    def __len__(self) -> int:
+        return sum(
+            1 for name in os.listdir(self.folder) if name.endswith(self.extension)
+        )
+
+    def frames(self) -> Iterator[np.ndarray]:
+        from realesrgan.utils import ImageReaderPool
+
+        with ImageReaderPool(self.paths(), flags=cv2.IMREAD_COLOR) as reader:
+            for _, frame in reader:
+                yield frame
+
+    def open_writer(self) -> FrameWriter:
+        return _ImageWriter(self)
+
+    def ffmpeg_output(self) -> List[str]:
+        return [*self.ffmpeg_options, self.pattern]
+
+    def ffmpeg_input(self, frame_rate: str) -> List[str]:
+        return ["-r", frame_rate, "-i", self.pattern]
+
+
+class _ImageWriter(FrameWriter):
+    def __init__(self, store: ImageFrameStore):
+        from realesrgan.utils import ImageWriterPool
+
+        self.store = store
+        self.index = len(store)
+        self.pool = ImageWriterPool()
+
+    def append(self, frame: np.ndarray):
+        self.pool.put(self.store.path(self.index), frame, self.store.params)
+        self.index += 1
+
+    def close(self):
+        self.pool.close()
+
+
+class RawFrameStore(FrameStore):
+    """All frames in one file at a fixed stride, read through a memory map.
+
+    No encoding at all: ffmpeg writes and reads the file as rawvideo, and a
+    frame is a view into the page cache.
+    """
+
+    frame_format = "raw"
+
+    def __init__(self, folder: str, width: int, height: int):
+        super().__init__(folder, width, height)
+        self.path = os.path.join(folder, "frames.bgr24")
+
+    def __len__(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // self.frame_bytes
+
+    def frames(self) -> Iterator[np.ndarray]:
+        count = len(self)
+        if count == 0:
+            return
+        frames = np.memmap(
+            self.path,
+            dtype=np.uint8,
+            mode="r",
+            shape=(count, self.height, self.width, 3),
+        )
+        yield from frames
+
+    def open_writer(self) -> FrameWriter:
+        return _RawWriter(self)
+
+    def ffmpeg_output(self) -> List[str]:
+        return ["-f", "rawvideo", "-pix_fmt", "bgr24", self.path]
+
+    def ffmpeg_input(self, frame_rate: str) -> List[str]:
+        return [
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "bgr24",
+            "-s",
+            f"{self.width}x{self.height}",
+            "-r",
+            frame_rate,
+            "-i",
+            self.path,
+        ]
+
+
+class _RawWriter(FrameWriter):
+    def __init__(self, store: RawFrameStore):
+        self.store = store
+        self.file = open(store.path, "ab")
+
+    def append(self, frame: np.ndarray):
+        if frame.shape != (self.store.height, self.store.width, 3):
+            raise ValueError(
+                f"Frame of shape {frame.shape} in a "
+                f"{self.store.width}x{self.store.height} store"
+            )
+        self.file.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+
+    def close(self):
+        self.file.close()
+
+
+class Lz4FrameStore(FrameStore):
+    """One LZ4-compressed raw frame per file, cheap to compress and inflate."""
+
+    frame_format = "lz4"
+
+    def __init__(self, folder: str, width: int, height: int):
+        if lz4 is None:
+            raise ImportError("The lz4 frame format needs the lz4 package")
+        super().__init__(folder, width, height)
+        self.pattern = os.path.join(folder, FRAME_PATTERN + ".lz4")
+
+    def __len__(self) -> int:
+        return sum(1 for name in os.listdir(self.folder) if name.endswith(".lz4"))
+
+    def frames(self) -> Iterator[np.ndarray]:
+        shape = (self.height, self.width, 3)
+        for index in range(len(self)):
+            with open(self.pattern % (index + 1), "rb") as file:
+                data = lz4.frame.decompress(file.read())
+            yield np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+    def open_writer(self) -> FrameWriter:
+        return _Lz4Writer(self)
+
+
+class _Lz4Writer(FrameWriter):
+    def __init__(self, store: Lz4FrameStore):
+        self.store = store
+        self.index = len(store)
+
+    def append(self, frame: np.ndarray):
+        data = lz4.frame.compress(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        self.index += 1
+        with open(self.store.pattern % self.index, "wb") as file:
+            file.write(data)
+
+
+def create_frame_store(
+    frame_format: str, folder: str, width: int, height: int
+) -> FrameStore:
+    if frame_format in ImageFrameStore.FORMATS:
+        return ImageFrameStore(folder, width, height, frame_format)
+    if frame_format == "raw":
+        return RawFrameStore(folder, width, height)
+    if frame_format == "lz4":
+        return Lz4FrameStore(folder, width, height)
+    raise ValueError(
+        f"Unknown frame format {frame_format}, expected one of "
+        f"{', '.join(FRAME_FORMATS)}"
+    )
@@ -18,15 +18,20 @@ import logging
 
 
 class VideoProcessingThread(QThread):
-    progress_signal = pyqtSignal(str)  # Signal for progress updates
+    # Qt adapter over the processor events, so that they reach the GUI thread
+    progress_signal = pyqtSignal(int)  # Signal for progress updates
+    progress_detail_signal = pyqtSignal(str, object)
+    video_started_signal = pyqtSignal(str)
 
     def __init__(self, processor):
         QThread.__init__(self)
         self.processor = processor
-        self.processor.set_progress_callback(self.progress_signal.emit)
+        self.processor.progress_updated.connect(self.progress_signal.emit)
+        self.processor.progress_detail.connect(self.progress_detail_signal.emit)
+        self.processor.video_started.connect(self.video_started_signal.emit)
 
     def run(self):
-        print("Video processing thread started")
+        logging.debug("Video processing thread started")
         self.processor.run()
         self.finished.emit()
 
@@ -106,20 +111,28 @@ class MainWindow(QMainWindow):
             logging.info(f"Upscaling videos: {video_files} to {destination_folder}")
 
             self.video_processor = VideoProcessor(destination_folder, video_files)
-            self.video_processor.progress_updated.connect(self.update_progress)
-            print("Progress signal connected")
 
             self.processing_thread = VideoProcessingThread(self.video_processor)
+            self.processing_thread.progress_signal.connect(self.update_progress)
+            self.processing_thread.progress_detail_signal.connect(
+                self.on_progress_detail
+            )
+            self.processing_thread.video_started_signal.connect(self.on_video_started)
             self.processing_thread.finished.connect(self.on_processing_finished)
             self.processing_thread.start()
         else:
             self.status_label.setText("No videos selected or destination not set.")
 
+    def on_video_started(self, video_file):
+        self.status_label.setText(f"Upscaling {video_file}")
+
+    def on_progress_detail(self, video_file, report):
+        self.status_label.setText(f"Upscaling {video_file}: {report.describe()}")
+
     def on_processing_finished(self):
         self.status_label.setText("Upscaling Completed.")
 
     def update_progress(self, progress):
-        print(f"Updating progress bar: {progress}%")
         self.progress_bar.setValue(progress)
 
     def select_files(self):
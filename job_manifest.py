@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+# Bytes hashed at each end of the source file for its fingerprint
+FINGERPRINT_BYTES = 1 << 20
+
+
+def fingerprint_file(path: str) -> dict:
+    # Size, mtime and a hash of both ends of the file. Hashing whole multi-GB
+    # sources would cost as much as decoding them.
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        if stat.st_size > 2 * FINGERPRINT_BYTES:
+            f.seek(-FINGERPRINT_BYTES, os.SEEK_END)
+            digest.update(f.read(FINGERPRINT_BYTES))
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "hash": digest.hexdigest(),
+    }
+
+
+def _normalize(value):
+    # Round trip through JSON so that stored and fresh settings compare equal
+    return json.loads(json.dumps(value, sort_keys=True, default=str))
+
+
+class JobManifest:
+    """JSON-lines record of the progress of one upscaling job.
+
+    The first line describes the job: the source fingerprint, the settings and
+    the segment plan. Every finished segment appends a line, and a final line
+    marks the whole job as done. A rerun of the same job on the same source
+    skips the segments already recorded, so only the remainder is processed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.job = None
+        self.segments = {}
+        self.done = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash, everything before it stands
+                    break
+                if record["type"] == "job":
+                    self.job = record
+                elif record["type"] == "segment":
+                    self.segments[record["index"]] = record
+                elif record["type"] == "done":
+                    self.done = True
+
+    def matches(self, source: dict, settings: dict) -> bool:
+        return (
+            self.job is not None
+            and self.job["source"] == _normalize(source)
+            and self.job["settings"] == _normalize(settings)
+        )
+
+    def start(self, source: dict, settings: dict, plan: List[list]):
+        self.job = {
+            "type": "job",
+            "source": _normalize(source),
+            "settings": _normalize(settings),
+            "plan": _normalize(plan),
+        }
+        self.segments = {}
+        self.done = False
+        with open(self.path, "w") as f:
+            f.write(json.dumps(self.job) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    @property
+    def plan(self) -> Optional[List[list]]:
+        return self.job["plan"] if self.job else None
+
+    def completed_segments(self) -> Dict[int, dict]:
+        # Only segments whose output file survived count as completed
+        return {
+            index: record
+            for index, record in self.segments.items()
+            if os.path.exists(record["path"])
+        }
+
+    def mark_segment(self, index: int, path: str, frames: int):
+        record = {"type": "segment", "index": index, "path": path, "frames": frames}
+        self.segments[index] = record
+        self.append(record)
+
+    def mark_done(self, output_video: str):
+        self.done = True
+        self.append({"type": "done", "output": output_video})
+        logging.info(f"Job complete: {output_video}")
+
+    def append(self, record: dict):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
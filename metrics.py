@@ -0,0 +1,331 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence
+
+# Upper bounds, in seconds, of the default histogram buckets. They cover a
+# fast decode of a small frame up to a tiled 4K frame on a CPU.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+
+class Counter:
+    """Monotonically increasing total, e.g. frames or bytes."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str = ""):
+        self.name = name
+        self.help_text = help_text
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            self._value = 0
+
+
+class Gauge:
+    """Value that goes up and down, e.g. a queue depth."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str = ""):
+        self.name = name
+        self.help_text = help_text
+        self._value = 0
+
+    def set(self, value: float):
+        self._value = value
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+    def reset(self):
+        self._value = 0
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str = "",
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # The last slot counts the values above every bucket
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def quantile(self, q: float) -> Optional[float]:
+        # Upper bound of the bucket holding the q-th value, None when empty
+        # or when the value is above the largest bucket
+        with self._lock:
+            counts = list(self._counts)
+            total = self._count
+        if total == 0:
+            return None
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self._counts)
+            total, value_sum = self._count, self._sum
+        cumulative = []
+        running = 0
+        for count in counts[:-1]:
+            running += count
+            cumulative.append(running)
+        return {
+            "count": total,
+            "sum": value_sum,
+            "buckets": dict(zip((str(b) for b in self.buckets), cumulative)),
+        }
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._sum = 0.0
+            self._count = 0
+
+
+class MetricsRegistry:
+    """Named metrics shared by the pipeline stages.
+
+    Metrics are created on first use, so instrumented code does not have to
+    know whether anything reads them. Updating a metric only takes a lock
+    and an addition, cheap enough for per-frame use.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_type, name: str, help_text: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_type(name, help_text, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_type):
+                raise TypeError(f"Metric {name} is a {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help_text: str = "") -> Counter:
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name: str, help_text: str = "") -> Gauge:
+        return self._get(Gauge, name, help_text)
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str = "",
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def metrics(self) -> list:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self) -> dict:
+        return {metric.name: metric.snapshot() for metric in self.metrics()}
+
+    def reset(self):
+        for metric in self.metrics():
+            metric.reset()
+
+    def to_prometheus(self) -> str:
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+        for metric in self.metrics():
+            if metric.help_text:
+                lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            snapshot = metric.snapshot()
+            if isinstance(metric, Histogram):
+                for bound, count in snapshot["buckets"].items():
+                    lines.append(f'{metric.name}_bucket{{le="{bound}"}} {count}')
+                lines.append(f'{metric.name}_bucket{{le="+Inf"}} {snapshot["count"]}')
+                lines.append(f"{metric.name}_sum {snapshot['sum']}")
+                lines.append(f"{metric.name}_count {snapshot['count']}")
+            else:
+                lines.append(f"{metric.name} {snapshot}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry used by the pipeline
+REGISTRY = MetricsRegistry()
+
+
+class LogSink:
+    """Writes a one-line summary of the metrics to the log."""
+
+    def __init__(self, level: int = logging.INFO):
+        self.level = level
+
+    def write(self, registry: MetricsRegistry):
+        values = []
+        for metric in registry.metrics():
+            if isinstance(metric, Histogram):
+                if metric.count:
+                    median = metric.quantile(0.5)
+                    values.append(
+                        f"{metric.name}: n={metric.count} p50<={median}"
+                        if median is not None
+                        else f"{metric.name}: n={metric.count}"
+                    )
+            else:
+                values.append(f"{metric.name}={metric.value}")
+        logging.log(self.level, "Metrics: " + ", ".join(values))
+
+    def close(self):
+        pass
+
+
+class JsonFileSink:
+    """Appends a timestamped JSON snapshot of the metrics per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a")
+
+    def write(self, registry: MetricsRegistry):
+        record = {"time": time.time(), "metrics": registry.snapshot()}
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class PrometheusEndpoint:
+    """Serves the registry in the Prometheus text format on a local port."""
+
+    def __init__(
+        self,
+        registry: MetricsRegistry = REGISTRY,
+        port: int = 9400,
+        host: str = "127.0.0.1",
+    ):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"Metrics request: {format % args}")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        host, port = self.server.server_address[:2]
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsReporter:
+    """Pushes the registry to the sinks at a fixed interval and on close."""
+
+    def __init__(
+        self,
+        sinks: List,
+        registry: MetricsRegistry = REGISTRY,
+        interval: float = 10.0,
+    ):
+        self.sinks = sinks
+        self.registry = registry
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        for sink in self.sinks:
+            try:
+                sink.write(self.registry)
+            except Exception:
+                logging.exception(f"Metrics sink {sink!r} failed")
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
@@ -0,0 +1,146 @@
+import os
+from typing import NamedTuple, Optional
+
+MODELS_FOLDER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "realesrgan", "models"
+)
+RELEASES_URL = "https://github.com/xinntao/Real-ESRGAN/releases/download"
+
+
+class ModelSpec(NamedTuple):
+    """An upscaling model and where to find its weights.
+
+    ``native_scale`` is the scale the network outputs, other target scales
+    are reached with a resize afterwards. ``ncnn_param`` is a bundled ncnn
+    graph, usable in process only if its .bin is bundled too. ``ncnn_name``
+    and ``ncnn_scale`` are the -n and -s arguments of the ncnn executable.
+    """
+
+    name: str
+    family: str
+    arch: str
+    native_scale: int
+    url: Optional[str]
+    ncnn_param: Optional[str] = None
+    ncnn_name: Optional[str] = None
+    ncnn_scale: Optional[int] = None
+    num_feat: int = 64
+    num_conv: int = 16
+    num_block: int = 23
+
+    @property
+    def bundled(self) -> bool:
+        # Runs in process from the bundled files, without a download
+        return (
+            self.ncnn_param is not None
+            and os.path.exists(self.ncnn_param)
+            and os.path.exists(os.path.splitext(self.ncnn_param)[0] + ".bin")
+        )
+
+    def weights(self) -> str:
+        return self.ncnn_param if self.bundled else self.url
+
+
+def _bundled(file_name: str) -> str:
+    return os.path.join(MODELS_FOLDER, file_name)
+
+
+MODELS = {
+    spec.name: spec
+    for spec in (
+        # The bundled x2 and x3 graphs are the x4 network followed by a
+        # bicubic downscale, their cost is the one of the x4 network
+        ModelSpec(
+            "realesr-animevideov3-x2",
+            "realesr-animevideov3",
+            "srvgg",
+            2,
+            None,
+            _bundled("realesr-animevideov3-x2.param"),
+            "realesr-animevideov3",
+            2,
+        ),
+        ModelSpec(
+            "realesr-animevideov3-x3",
+            "realesr-animevideov3",
+            "srvgg",
+            3,
+            None,
+            _bundled("realesr-animevideov3-x3.param"),
+            "realesr-animevideov3",
+            3,
+        ),
+        ModelSpec(
+            "realesr-animevideov3",
+            "realesr-animevideov3",
+            "srvgg",
+            4,
+            f"{RELEASES_URL}/v0.2.5.0/realesr-animevideov3.pth",
+            _bundled("realesr-animevideov3-x4.param"),
+            "realesr-animevideov3",
+            4,
+        ),
+        ModelSpec(
+            "realesr-general-x4v3",
+            "realesr-general",
+            "srvgg",
+            4,
+            f"{RELEASES_URL}/v0.2.5.0/realesr-general-x4v3.pth",
+            num_conv=32,
+        ),
+        # The bundled x4plus graphs have no .bin, they only serve the ncnn
+        # executable
+        ModelSpec(
+            "RealESRGAN_x4plus",
+            "realesrgan-x4plus",
+            "rrdb",
+            4,
+            f"{RELEASES_URL}/v0.1.0/RealESRGAN_x4plus.pth",
+            _bundled("realesrgan-x4plus.param"),
+            "realesrgan-x4plus",
+            4,
+        ),
+        ModelSpec(
+            "RealESRGAN_x2plus",
+            "realesrgan-x4plus",
+            "rrdb",
+            2,
+            f"{RELEASES_URL}/v0.2.1/RealESRGAN_x2plus.pth",
+        ),
+        ModelSpec(
+            "RealESRGAN_x4plus_anime_6B",
+            "realesrgan-x4plus-anime",
+            "rrdb",
+            4,
+            f"{RELEASES_URL}/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth",
+            _bundled("realesrgan-x4plus-anime.param"),
+            "realesrgan-x4plus-anime",
+            4,
+            num_block=6,
+        ),
+    )
+}
+
+DEFAULT_MODEL = "realesr-animevideov3"
+
+
+def select_model(name: str, scale: int) -> ModelSpec:
+    """Pick the model of the family of ``name`` that best fits ``scale``.
+
+    A model whose native scale is the target needs no resize. Otherwise the
+    smallest larger scale is downscaled, which keeps the detail the network
+    adds, and only when every model is smaller is the output upscaled.
+    Models that run from the bundled files win ties.
+    """
+    if name not in MODELS:
+        raise ValueError(
+            f"Unknown model {name}, expected one of {', '.join(sorted(MODELS))}"
+        )
+    family = [spec for spec in MODELS.values() if spec.family == MODELS[name].family]
+
+    def cost(spec: ModelSpec):
+        if spec.native_scale >= scale:
+            return (spec.native_scale - scale, not spec.bundled)
+        return (100 + scale - spec.native_scale, not spec.bundled)
+
+    return min(family, key=cost)
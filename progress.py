@@ -0,0 +1,142 @@
+import threading
+import time
+from typing import Callable, Dict, NamedTuple, Optional
+
+# Share of the work done by each stage of a pipeline. Stages report how many
+# frames they are done with, the overall progress is the weighted average.
+STREAMING_STAGES = {"decode": 0.05, "upscale": 0.9, "encode": 0.05}
+CHUNKED_STAGES = {"decode": 0.04, "upscale": 0.9, "encode": 0.04, "concat": 0.02}
+FRAME_STORE_STAGES = {"extract": 0.05, "upscale": 0.9, "encode": 0.05}
+
+# Keys of the blocks written by "ffmpeg -progress", a block ends with the
+# "progress" key
+FFMPEG_PROGRESS_KEYS = {
+    "frame",
+    "fps",
+    "bitrate",
+    "total_size",
+    "out_time_us",
+    "out_time_ms",
+    "out_time",
+    "dup_frames",
+    "drop_frames",
+    "speed",
+    "progress",
+}
+
+
+class ProgressReport(NamedTuple):
+    fraction: float
+    frames: int
+    total_frames: int
+    fps: float
+    eta: Optional[float]
+    stage: str
+
+    @property
+    def percent(self) -> int:
+        return int(self.fraction * 100)
+
+    def describe(self) -> str:
+        text = f"{self.percent}% ({self.frames}/{self.total_frames} frames"
+        if self.fps:
+            text += f", {self.fps:.2f} fps"
+        if self.eta is not None:
+            text += f", {format_duration(self.eta)} left"
+        return text + ")"
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+class ProgressTracker:
+    """Combines the frame counts of the pipeline stages into one progress.
+
+    ``update`` may be called for every frame and from any thread. The callback
+    gets a ProgressReport at most once per ``min_interval`` seconds, plus a
+    final one from ``finish``. The frame count and fps of the reports are
+    those of the stage with the largest weight, the upscaler.
+    """
+
+    def __init__(
+        self,
+        total_frames: int,
+        stages: Dict[str, float],
+        callback: Optional[Callable[[ProgressReport], None]] = None,
+        min_interval: float = 0.25,
+    ):
+        self.total_frames = max(1, total_frames)
+        self.stages = stages
+        self.main_stage = max(stages, key=stages.get)
+        self.callback = callback
+        self.min_interval = min_interval
+        self.done = {stage: 0 for stage in stages}
+        self.started = time.monotonic()
+        self._last_report = float("-inf")
+        self._lock = threading.Lock()
+
+    def update(self, stage: str, frames: int):
+        with self._lock:
+            self.done[stage] = min(frames, self.total_frames)
+            now = time.monotonic()
+            if now - self._last_report < self.min_interval:
+                return
+            self._last_report = now
+            # Called under the lock, so that reports arrive in order
+            if self.callback:
+                self.callback(self.report(stage, now))
+
+    def finish(self):
+        with self._lock:
+            for stage in self.done:
+                self.done[stage] = self.total_frames
+            if self.callback:
+                self.callback(self.report(self.main_stage, time.monotonic()))
+
+    def report(self, stage: str, now: float) -> ProgressReport:
+        fraction = sum(
+            weight * self.done[name] / self.total_frames
+            for name, weight in self.stages.items()
+        ) / sum(self.stages.values())
+        elapsed = now - self.started
+        frames = self.done[self.main_stage]
+        fps = frames / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if 0 < fraction < 1:
+            eta = elapsed * (1 - fraction) / fraction
+        elif fraction >= 1:
+            eta = 0.0
+        return ProgressReport(fraction, frames, self.total_frames, fps, eta, stage)
+
+
+class FFmpegProgressParser:
+    """Reads the key=value stream of "ffmpeg -progress pipe:1".
+
+    Lines are fed one by one, ``callback`` gets the frame number at the end
+    of every block. Other output interleaved with the stream is ignored.
+    """
+
+    def __init__(self, callback: Callable[[int], None]):
+        self.callback = callback
+        self.values = {}
+
+    def feed(self, line: str) -> bool:
+        # Returns whether the line was part of the progress stream
+        key, separator, value = line.strip().partition("=")
+        if not separator or (
+            key not in FFMPEG_PROGRESS_KEYS and not key.startswith("stream_")
+        ):
+            return False
+        self.values[key] = value
+        if key == "progress":
+            try:
+                self.callback(int(self.values.get("frame", 0)))
+            except ValueError:
+                pass
+            self.values = {}
+        return True
@@ -2,5 +2,6 @@
 from .archs import *
 from .data import *
 from .models import *
+from .tiling import *
 from .utils import *
 from .version import *
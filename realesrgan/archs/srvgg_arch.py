@@ -1,6 +1,7 @@
+import copy
+import torch
 from basicsr.utils.registry import ARCH_REGISTRY
 from torch import nn as nn
-from torch.nn import functional as F
 
 
 @ARCH_REGISTRY.register()
@@ -59,11 +60,61 @@ class SRVGGNetCompact(nn.Module):
 
     def forward(self, x):
         out = x
-        for i in range(0, len(self.body)):
-            out = self.body[i](out)
+        for layer in self.body:
+            out = layer(out)
 
-        out = self.upsampler(out)
-        # add the nearest upsampled image, so that the network learns the residual
-        base = F.interpolate(x, scale_factor=self.upscale, mode='nearest')
-        out += base
+        # add the nearest upsampled image, so that the network learns the residual.
+        # Adding the input to each of the upscale * upscale sub-pixel channels before the pixel shuffle gives the same
+        # result as adding the nearest upsampled image after it, without allocating that full resolution image.
+        n, _, h, w = out.size()
+        out = out.view(n, self.num_out_ch, self.upscale * self.upscale, h, w)
+        out.add_(x.unsqueeze(2))
+        out = self.upsampler(out.view(n, self.num_out_ch * self.upscale * self.upscale, h, w))
         return out
+
+    def optimize_for_inference(self, mode='script', channels_last=True):
+        """Return a copy of the network prepared for inference. See :func:`optimize_for_inference`."""
+        return optimize_for_inference(self, mode=mode, channels_last=channels_last)
+
+
+class _ChannelsLast(nn.Module):
+    """Feed the wrapped network with channels_last inputs."""
+
+    def __init__(self, net):
+        super(_ChannelsLast, self).__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net(x.contiguous(memory_format=torch.channels_last))
+
+
+def optimize_for_inference(model, mode='script', channels_last=True):
+    """Return a copy of a network prepared for inference only.
+
+    The copy has no gradients and, with ``channels_last``, uses the NHWC memory format that oneDNN convolutions prefer
+    on CPU. The input is converted on the way in.
+
+    Args:
+        model (nn.Module): The network, e.g. SRVGGNetCompact.
+        mode (str): 'script' freezes a TorchScript graph, which folds the constants and lets
+            ``torch.jit.optimize_for_inference`` fuse the convolutions with their activations for oneDNN.
+            'compile' uses ``torch.compile``. 'eager' only applies the memory format. Default: 'script'.
+        channels_last (bool): Use the channels_last memory format. Default: True.
+
+    Returns:
+        nn.Module: The optimized network.
+    """
+    if mode not in ('script', 'compile', 'eager'):
+        raise ValueError(f'Unknown inference mode {mode}, options: script, compile, eager.')
+    model = copy.deepcopy(model).eval()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    if channels_last:
+        model = _ChannelsLast(model.to(memory_format=torch.channels_last)).eval()
+
+    if mode == 'script':
+        with torch.no_grad():
+            model = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.script(model)))
+    elif mode == 'compile':
+        model = torch.compile(model, mode='max-autotune-no-cudagraphs')
+    return model
@@ -0,0 +1,206 @@
+import numpy as np
+import os
+import torch
+from collections import namedtuple
+from torch import nn as nn
+from torch.nn import functional as F
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
+NCNN_MAGIC = 7767517
+# storage tags in front of the weight blobs of the .bin file
+FP32_TAG = 0x00000000
+FP16_TAG = 0x01306B47
+INT8_TAG = 0x000D4B38
+# ncnn Interp resize types
+INTERP_NEAREST = 1
+INTERP_BICUBIC = 3
+
+NCNNLayer = namedtuple('NCNNLayer', ['type', 'name', 'inputs', 'outputs', 'params'])
+
+
+def parse_param(param_path):
+    """Parse a ncnn .param graph file.
+
+    Args:
+        param_path (str): Path to the .param file.
+
+    Returns:
+        list[NCNNLayer]: The layers, in file order, with their params keyed by the integer param id.
+    """
+    with open(param_path) as f:
+        lines = [line.split() for line in f if line.strip()]
+    if int(lines[0][0]) != NCNN_MAGIC:
+        raise ValueError(f'{param_path} is not a ncnn param file.')
+    layer_count = int(lines[1][0])
+    layers = []
+    for fields in lines[2:2 + layer_count]:
+        layer_type, name, num_inputs, num_outputs = fields[0], fields[1], int(fields[2]), int(fields[3])
+        inputs = fields[4:4 + num_inputs]
+        outputs = fields[4 + num_inputs:4 + num_inputs + num_outputs]
+        params = {}
+        for item in fields[4 + num_inputs + num_outputs:]:
+            key, value = item.split('=')
+            params[int(key)] = float(value) if ('.' in value or 'e' in value) else int(value)
+        layers.append(NCNNLayer(layer_type, name, inputs, outputs, params))
+    return layers
+
+
+class NCNNModelBin():
+    """Sequential reader over a memory-mapped ncnn .bin weight blob."""
+
+    def __init__(self, bin_path):
+        self.path = bin_path
+        self.data = np.memmap(bin_path, dtype=np.uint8, mode='r')
+        self.offset = 0
+
+    def read(self, count, tagged=True):
+        """Read ``count`` values as float32.
+
+        Args:
+            count (int): Number of values.
+            tagged (bool): Whether the blob starts with a storage tag (weights) or is raw float32 (bias, slopes).
+        """
+        tag = FP32_TAG
+        if tagged:
+            tag = int(np.frombuffer(self.data, dtype='<u4', count=1, offset=self.offset)[0])
+            self.offset += 4
+        if tag == FP32_TAG:
+            values = np.frombuffer(self.data, dtype='<f4', count=count, offset=self.offset)
+            self.offset += count * 4
+        elif tag == FP16_TAG:
+            values = np.frombuffer(self.data, dtype='<f2', count=count, offset=self.offset)
+            # fp16 blobs are padded to 4 bytes
+            self.offset += (count * 2 + 3) // 4 * 4
+        elif tag == INT8_TAG:
+            raise ValueError(f'{self.path}: int8 quantized ncnn weights are not supported, use a fp32 or fp16 model.')
+        else:
+            raise ValueError(f'{self.path}: unknown ncnn weight storage tag {tag:#x} at offset {self.offset - 4}.')
+        return values.astype(np.float32)
+
+    def check_consumed(self):
+        if self.offset != len(self.data):
+            raise ValueError(
+                f'{self.path}: {len(self.data) - self.offset} bytes of the ncnn weights were not consumed.')
+
+
+class ResizedOutput(nn.Module):
+    """Wrap a network whose output is resized by a fixed factor, as the ncnn x2/x3 video models do.
+
+    Args:
+        net (nn.Module): The upsampling network.
+        resize (float): Resize factor applied to the network output.
+        mode (str): Interpolation mode. Default: 'bicubic'.
+    """
+
+    def __init__(self, net, resize, mode='bicubic'):
+        super(ResizedOutput, self).__init__()
+        self.net = net
+        self.resize = resize
+        self.mode = mode
+        self.upscale = int(round(net.upscale * resize))
+        self.num_feat = net.num_feat
+
+    def forward(self, x):
+        out = self.net(x)
+        return F.interpolate(out, scale_factor=self.resize, mode=self.mode, align_corners=False)
+
+
+def get_ncnn_scale(param_path):
+    """Overall upsampling scale of a ncnn SRVGGNetCompact graph: the PixelShuffle factor times the output resize."""
+    scale = 1.0
+    for layer in parse_param(param_path):
+        if layer.type == 'PixelShuffle':
+            scale *= layer.params[0]
+        elif layer.type == 'Interp' and layer.params.get(0) == INTERP_BICUBIC:
+            scale *= layer.params[1]
+    return int(round(scale))
+
+
+def _activation(layer):
+    if layer.type == 'PReLU':
+        return 'prelu'
+    if layer.type == 'ReLU':
+        return 'leakyrelu' if layer.params.get(0, 0.0) != 0 else 'relu'
+    return None
+
+
+def load_ncnn_srvgg(param_path, bin_path=None):
+    """Build a SRVGGNetCompact from a ncnn .param/.bin pair, such as the bundled realesr-animevideov3 models.
+
+    The graph must be the exported SRVGGNetCompact: convolutions with activations, a last convolution, PixelShuffle,
+    the nearest upsampled input added as residual, and optionally a final resize of the output.
+
+    Args:
+        param_path (str): Path to the .param file.
+        bin_path (str): Path to the .bin file. Default: None, the .param path with the .bin extension.
+
+    Returns:
+        nn.Module: The network in eval mode, a SRVGGNetCompact or a ResizedOutput around it.
+    """
+    if bin_path is None:
+        bin_path = os.path.splitext(param_path)[0] + '.bin'
+    layers = [layer for layer in parse_param(param_path) if layer.type not in ('Input', 'Split')]
+
+    convs, act_type = [], None
+    index = 0
+    while index < len(layers) and layers[index].type == 'Convolution':
+        conv = layers[index]
+        if conv.params.get(1, 1) != 3 or conv.params.get(3, 1) != 1 or conv.params.get(4, 0) != 1:
+            raise ValueError(f'{conv.name}: only 3x3 stride 1 pad 1 convolutions are supported.')
+        activation = layers[index + 1] if index + 1 < len(layers) else None
+        if activation is not None and _activation(activation) is not None:
+            act_type = _activation(activation)
+            convs.append((conv, activation))
+            index += 2
+        else:
+            convs.append((conv, None))
+            index += 1
+    tail = [layer.type for layer in layers[index:]]
+    if len(convs) < 2 or convs[-1][1] is not None or tail[:3] != ['PixelShuffle', 'Interp', 'BinaryOp']:
+        raise ValueError(f'{param_path} is not a SRVGGNetCompact graph.')
+    pixel_shuffle, residual = layers[index], layers[index + 1]
+    if residual.params.get(0) != INTERP_NEAREST or layers[index + 2].params.get(0, 0) != 0:
+        raise ValueError(f'{param_path}: the residual should be a nearest upsampled input added to the output.')
+
+    upscale = pixel_shuffle.params[0]
+    num_feat = convs[0][0].params[0]
+    num_in_ch = convs[0][0].params[6] // (num_feat * 9)
+    num_out_ch = convs[-1][0].params[0] // (upscale * upscale)
+    net = SRVGGNetCompact(
+        num_in_ch=num_in_ch,
+        num_out_ch=num_out_ch,
+        num_feat=num_feat,
+        num_conv=len(convs) - 2,
+        upscale=upscale,
+        act_type=act_type or 'prelu')
+
+    # weights are stored in layer order: conv weight (tagged), conv bias, activation slopes
+    model_bin = NCNNModelBin(bin_path)
+    state_dict = {}
+    body_index = 0
+    for conv, activation in convs:
+        out_ch, weight_size = conv.params[0], conv.params[6]
+        in_ch = weight_size // (out_ch * 9)
+        weight = model_bin.read(weight_size).reshape(out_ch, in_ch, 3, 3)
+        state_dict[f'body.{body_index}.weight'] = torch.from_numpy(weight)
+        if conv.params.get(5, 0):
+            state_dict[f'body.{body_index}.bias'] = torch.from_numpy(model_bin.read(out_ch, tagged=False))
+        else:
+            state_dict[f'body.{body_index}.bias'] = torch.zeros(out_ch)
+        body_index += 1
+        if activation is not None:
+            if activation.type == 'PReLU':
+                slopes = model_bin.read(activation.params.get(0, 1), tagged=False)
+                state_dict[f'body.{body_index}.weight'] = torch.from_numpy(slopes)
+            body_index += 1
+    model_bin.check_consumed()
+    net.load_state_dict(state_dict, strict=True)
+    net.eval()
+
+    resize = layers[index + 3] if len(layers) > index + 3 else None
+    if resize is not None and resize.type == 'Interp':
+        if resize.params.get(0) != INTERP_BICUBIC:
+            raise ValueError(f'{resize.name}: only a bicubic output resize is supported.')
+        return ResizedOutput(net, resize.params[1]).eval()
+    return net
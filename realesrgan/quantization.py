@@ -0,0 +1,238 @@
+import argparse
+import cv2
+import copy
+import json
+import numpy as np
+import time
+import torch
+from torch import nn as nn
+from torch.ao import quantization as tq
+
+from realesrgan.ncnn_loader import ResizedOutput, load_ncnn_srvgg
+
+
+class QuantizableSRVGG(nn.Module):
+    """SRVGGNetCompact with int8 quantization stubs around its body.
+
+    The convolutions and PReLU activations of the body run in int8 once converted. The pixel shuffle, the residual
+    add of the input and the optional output resize stay in float32, which keeps the low-resolution residual from
+    being quantized twice.
+
+    Args:
+        net (nn.Module): A SRVGGNetCompact, or a ResizedOutput around one (the bundled ncnn x2/x3 models).
+        float_convs (list[int]): Indices of the body convolutions (0 is the first one) kept in float32 together with
+            their activations, for the layers whose outliers do not survive int8. Default: None.
+    """
+
+    def __init__(self, net, float_convs=None):
+        super(QuantizableSRVGG, self).__init__()
+        self.resize = 1.0
+        if isinstance(net, ResizedOutput):
+            self.resize = net.resize
+            net = net.net
+        net = copy.deepcopy(net)
+        self.num_out_ch = net.num_out_ch
+        self.num_feat = net.num_feat
+        self.net_upscale = net.upscale
+        self.upscale = int(round(net.upscale * self.resize))
+        self.upsampler = net.upsampler
+
+        # group the body into conv + activation stages, the float ones are wrapped in dequant/quant stubs
+        float_convs = set(float_convs or [])
+        stages, conv_index = [], -1
+        for layer in net.body:
+            if isinstance(layer, nn.Conv2d):
+                conv_index += 1
+                stages.append([layer])
+            else:
+                stages[-1].append(layer)
+        self.body = nn.ModuleList()
+        for index, stage in enumerate(stages):
+            if index in float_convs:
+                stage = [tq.DeQuantStub()] + stage + [tq.QuantStub()]
+                for layer in stage[1:-1]:
+                    layer.qconfig = None
+            self.body.append(nn.Sequential(*stage))
+        self.quant = tq.QuantStub()
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        out = self.quant(x)
+        for stage in self.body:
+            out = stage(out)
+        out = self.dequant(out)
+
+        n, _, h, w = out.size()
+        r = self.net_upscale
+        out = out.view(n, self.num_out_ch, r * r, h, w) + x.unsqueeze(2)
+        out = self.upsampler(out.view(n, self.num_out_ch * r * r, h, w))
+        if self.resize != 1.0:
+            out = nn.functional.interpolate(out, scale_factor=self.resize, mode='bicubic', align_corners=False)
+        return out
+
+
+def frame_to_tensor(frame):
+    """HWC BGR uint8 frame to a (1, 3, h, w) RGB float tensor in [0, 1]."""
+    return torch.from_numpy(np.ascontiguousarray(frame[:, :, ::-1].transpose(2, 0, 1))).float().div_(255).unsqueeze(0)
+
+
+def tensor_to_frame(tensor):
+    """(1, 3, h, w) RGB float tensor to a HWC BGR uint8 frame."""
+    frame = tensor.squeeze(0).clamp(0, 1).mul(255).round().byte().permute(1, 2, 0).numpy()
+    return np.ascontiguousarray(frame[:, :, ::-1])
+
+
+@torch.no_grad()
+def quantize_srvgg(net, calibration_frames, backend='x86', float_convs=None):
+    """Post-training static int8 quantization of a SRVGGNetCompact.
+
+    The weights are quantized per output channel, the activation ranges are observed on the calibration frames.
+
+    Args:
+        net (nn.Module): A SRVGGNetCompact, or a ResizedOutput around one.
+        calibration_frames (list[ndarray]): HWC BGR uint8 frames representative of the content. A few dozen small
+            crops are usually enough.
+        backend (str): Quantized engine, 'x86', 'fbgemm' or 'qnnpack' (ARM). Default: 'x86'.
+        float_convs (list[int]): Body convolutions kept in float32, see QuantizableSRVGG. Default: None.
+
+    Returns:
+        nn.Module: The quantized network, it runs on the CPU only.
+    """
+    torch.backends.quantized.engine = backend
+    model = QuantizableSRVGG(net, float_convs=float_convs).eval()
+    # the activations of these networks have long tails, a histogram observer over the full int8 range clips them
+    # with the least error
+    model.qconfig = tq.QConfig(
+        activation=tq.HistogramObserver.with_args(reduce_range=False),
+        weight=tq.default_per_channel_weight_observer)
+    for module in model.body.modules():
+        if isinstance(module, nn.PReLU) and not hasattr(module, 'qconfig'):
+            # the slopes are a 1D tensor, they get one scale for the whole tensor
+            module.qconfig = tq.QConfig(activation=model.qconfig.activation, weight=tq.default_weight_observer)
+    prepared = tq.prepare(model)
+    for frame in calibration_frames:
+        prepared(frame_to_tensor(frame))
+    return tq.convert(prepared)
+
+
+def save_quantized(model, path):
+    """Save a quantized network as a TorchScript archive, which keeps the int8 packed weights."""
+    torch.jit.save(torch.jit.script(model), path)
+
+
+def load_quantized(path, backend='x86'):
+    """Load a network saved by ``save_quantized``."""
+    torch.backends.quantized.engine = backend
+    return torch.jit.load(path, map_location='cpu').eval()
+
+
+def psnr(img1, img2):
+    """PSNR in dB between two uint8 images."""
+    mse = np.mean((img1.astype(np.float64) - img2.astype(np.float64))**2)
+    return float('inf') if mse == 0 else float(10 * np.log10(255.0**2 / mse))
+
+
+def ssim(img1, img2):
+    """Mean SSIM over the channels of two uint8 images, with the usual 11x11 Gaussian window."""
+    c1, c2 = (0.01 * 255)**2, (0.03 * 255)**2
+    img1, img2 = img1.astype(np.float64), img2.astype(np.float64)
+    if img1.ndim == 2:
+        img1, img2 = img1[..., None], img2[..., None]
+    values = []
+    for c in range(img1.shape[2]):
+        x, y = img1[..., c], img2[..., c]
+        mu_x, mu_y = cv2.GaussianBlur(x, (11, 11), 1.5), cv2.GaussianBlur(y, (11, 11), 1.5)
+        sigma_x = cv2.GaussianBlur(x * x, (11, 11), 1.5) - mu_x**2
+        sigma_y = cv2.GaussianBlur(y * y, (11, 11), 1.5) - mu_y**2
+        sigma_xy = cv2.GaussianBlur(x * y, (11, 11), 1.5) - mu_x * mu_y
+        ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / ((mu_x**2 + mu_y**2 + c1) *
+                                                                     (sigma_x + sigma_y + c2))
+        values.append(ssim_map[5:-5, 5:-5].mean())
+    return float(np.mean(values))
+
+
+@torch.no_grad()
+def quality_report(float_model, quantized_model, frames):
+    """Compare the quantized network against the float32 one.
+
+    Returns:
+        dict: Mean, minimum PSNR and SSIM of the quantized outputs against the float32 outputs, and the mean seconds
+            per frame of both networks.
+    """
+    psnrs, ssims = [], []
+    float_time = quantized_time = 0.0
+    for frame in frames:
+        img = frame_to_tensor(frame)
+        start = time.perf_counter()
+        reference = tensor_to_frame(float_model(img))
+        float_time += time.perf_counter() - start
+        start = time.perf_counter()
+        output = tensor_to_frame(quantized_model(img))
+        quantized_time += time.perf_counter() - start
+        psnrs.append(psnr(reference, output))
+        ssims.append(ssim(reference, output))
+    return {
+        'frames': len(frames),
+        'psnr_mean': float(np.mean(psnrs)),
+        'psnr_min': float(np.min(psnrs)),
+        'ssim_mean': float(np.mean(ssims)),
+        'ssim_min': float(np.min(ssims)),
+        'float_seconds_per_frame': float_time / len(frames),
+        'int8_seconds_per_frame': quantized_time / len(frames),
+        'speedup': float_time / quantized_time,
+    }
+
+
+def read_frames(video_path, count, step=1):
+    """Read up to ``count`` frames from a video, keeping every ``step``-th frame."""
+    capture = cv2.VideoCapture(video_path)
+    frames = []
+    index = 0
+    while len(frames) < count:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        if index % step == 0:
+            frames.append(frame)
+        index += 1
+    capture.release()
+    return frames
+
+
+def main():
+    """Quantize a ncnn SRVGGNetCompact model and report its quality on a reference clip.
+
+    Example:
+        python -m realesrgan.quantization -i realesrgan/models/realesr-animevideov3-x4.param -c clip.mp4 -o x4_int8.pt
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', required=True, help='ncnn .param of the float32 model')
+    parser.add_argument('-c', '--clip', required=True, help='Reference clip for calibration and the report')
+    parser.add_argument('-o', '--output', required=True, help='Path of the quantized TorchScript archive')
+    parser.add_argument('--calibration_frames', type=int, default=32)
+    parser.add_argument('--report_frames', type=int, default=16)
+    parser.add_argument('--step', type=int, default=10, help='Keep every step-th frame of the clip')
+    parser.add_argument('--backend', default='x86')
+    parser.add_argument(
+        '--float_convs', type=int, nargs='*', default=None, help='Body convolutions kept in float32, 0 is the first')
+    parser.add_argument('--report', default=None, help='Also write the report to this JSON file')
+    args = parser.parse_args()
+
+    float_model = load_ncnn_srvgg(args.input)
+    frames = read_frames(args.clip, args.calibration_frames + args.report_frames, args.step)
+    calibration, reference = frames[:args.calibration_frames], frames[args.calibration_frames:]
+    if not reference:
+        # short clip, report on the calibration frames
+        reference = calibration
+    quantized_model = quantize_srvgg(float_model, calibration, backend=args.backend, float_convs=args.float_convs)
+    save_quantized(quantized_model, args.output)
+
+    report = quality_report(float_model, load_quantized(args.output, backend=args.backend), reference)
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+import functools
+import torch
+from torch.nn import functional as F
+
+
+class TileGrid():
+    """The tile layout of an image, computed once per resolution.
+
+    All the padded tile windows share the same size, so that they can be stacked into one batch: the last row and
+    column of tiles are shifted back inside the image instead of being cropped, and the padding of the tiles along the
+    image border is taken from the inside of the image.
+
+    Args:
+        height (int): Height of the image.
+        width (int): Width of the image.
+        tile_size (int): Size of the square tiles, before padding.
+        tile_pad (int): The pad size on each side of a tile.
+    """
+
+    def __init__(self, height, width, tile_size, tile_pad):
+        self.height = height
+        self.width = width
+        self.tile_h = min(tile_size, height)
+        self.tile_w = min(tile_size, width)
+        self.window_h = min(self.tile_h + 2 * tile_pad, height)
+        self.window_w = min(self.tile_w + 2 * tile_pad, width)
+        # (tile start, window start) along each axis
+        self.rows = self._spans(height, self.tile_h, self.window_h, tile_pad)
+        self.cols = self._spans(width, self.tile_w, self.window_w, tile_pad)
+        # (row, col) indices of the tiles, row by row
+        self.tiles = [(r, c) for r in range(len(self.rows)) for c in range(len(self.cols))]
+
+    @staticmethod
+    def _spans(length, tile, window, tile_pad):
+        starts = list(range(0, length - tile, tile)) + [length - tile]
+        return [(start, min(max(start - tile_pad, 0), length - window)) for start in starts]
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def feather(self, scale, device=None):
+        """Blending weights of the upsampled windows, as 1D weights per row and per column.
+
+        The weights are 1 on the tile itself and fall off linearly across its padding, so overlapping tiles fade into
+        each other instead of meeting at a hard seam.
+        """
+        rows = [_ramp(self.window_h, self.tile_h, start - window, scale, device) for start, window in self.rows]
+        cols = [_ramp(self.window_w, self.tile_w, start - window, scale, device) for start, window in self.cols]
+        return rows, cols
+
+
+def _ramp(window, tile, offset, scale, device):
+    position = torch.arange(window * scale, device=device, dtype=torch.float32) + 0.5
+    start, end = offset * scale, (offset + tile) * scale
+    weight = torch.ones_like(position)
+    if start > 0:
+        weight[:start] = position[:start] / start
+    if end < window * scale:
+        weight[end:] = (window * scale - position[end:]) / (window * scale - end)
+    return weight
+
+
+@functools.lru_cache(maxsize=32)
+def get_tile_grid(height, width, tile_size, tile_pad):
+    """Return the cached TileGrid for the given resolution and tile settings."""
+    return TileGrid(height, width, tile_size, tile_pad)
+
+
+def gather_tiles(img, grid, keys):
+    """Stack the padded tile windows ``keys`` ((frame, row, col) tuples) of a NCHW tensor into one batch."""
+    windows = []
+    for i, r, c in keys:
+        y, x = grid.rows[r][1], grid.cols[c][1]
+        windows.append(img[i, :, y:y + grid.window_h, x:x + grid.window_w])
+    return torch.stack(windows)
+
+
+class TileCache():
+    """The upsampled tiles of the previous frames of a video, so that ``tile_forward`` skips the unchanged tiles.
+
+    A tile runs through the model again only when its padded input window differs from the window its cached output
+    was computed from, that is when the mean absolute difference over one of its ``block_size`` square blocks exceeds
+    ``threshold``. Comparing with that window instead of the previous frame keeps slow changes from piling up below
+    the threshold, and as the padding is part of the window, a change next to a tile refreshes it too so the seams
+    stay consistent. The frames of successive calls must be successive frames of one video: one cache per stream.
+
+    Args:
+        tile_size (int): Size of the square tiles, before padding. Default: 128.
+        threshold (float): Largest block difference of a reused tile, in the [0, 1] range of the input.
+            Default: 2 / 255.
+        block_size (int): Size of the blocks the difference is averaged over. Default: 8.
+    """
+
+    def __init__(self, tile_size=128, threshold=2 / 255, block_size=8):
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.block_size = block_size
+        self.tiles_run = 0
+        self.tiles_reused = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the cached tiles, the next frame runs whole."""
+        self.layout = None
+        # per (row, col): the input window and the output of the last tile that ran
+        self.windows = {}
+        self.outputs = {}
+
+    @property
+    def reuse_rate(self):
+        total = self.tiles_run + self.tiles_reused
+        return self.tiles_reused / total if total else 0.0
+
+    def scan(self, img, grid, layout):
+        """Find the tiles of a NCHW tensor that need to run, and keep their windows as the new references.
+
+        Args:
+            img (Tensor): Input with shape (n, c, h, w).
+            grid (TileGrid): The tile layout of ``img``.
+            layout (tuple): Everything besides the input that the cached outputs depend on, the cache is reset when
+                it changes.
+
+        Returns:
+            list[tuple]: The (frame, row, col) keys of all the tiles, tile by tile and in frame order for each tile.
+            set[tuple]: The keys of the tiles to run.
+        """
+        if layout != self.layout:
+            self.reset()
+            self.layout = layout
+        n = img.shape[0]
+        keys, dirty = [], set()
+        for r, c in grid.tiles:
+            y, x = grid.rows[r][1], grid.cols[c][1]
+            windows = img[:, :, y:y + grid.window_h, x:x + grid.window_w]
+            reference = self.windows.get((r, c))
+            start, changed = 0, None
+            while start < n:
+                change = 0 if reference is None else self._first_change(windows[start:], reference)
+                if change is None:
+                    break
+                changed = start + change
+                dirty.add((changed, r, c))
+                reference = windows[changed]
+                start = changed + 1
+            if changed is not None:
+                # the input tensor may be a buffer that the next call overwrites
+                self.windows[(r, c)] = reference.clone()
+            keys.extend((i, r, c) for i in range(n))
+        self.tiles_run += len(dirty)
+        self.tiles_reused += len(keys) - len(dirty)
+        return keys, dirty
+
+    def _first_change(self, windows, reference):
+        # index of the first window that differs from the reference, one device sync for all of them
+        diff = (windows - reference).abs_().amax(dim=1, keepdim=True).float()
+        blocks = F.avg_pool2d(diff, self.block_size, ceil_mode=True).flatten(1).amax(dim=1)
+        changed = torch.nonzero(blocks > self.threshold)
+        return int(changed[0]) if len(changed) else None
+
+
+def _output_tiles(model, img, grid, keys, trim, tile_batch_size, cache=None, dirty=None):
+    """Yield the trimmed output tile of every key in order.
+
+    Without a cache, every tile runs through the model. With one, only the ``dirty`` tiles do and the others repeat
+    the output of their tile in the cache, which the dirty tiles replace as they come in order.
+    """
+    if cache is None:
+        for start in range(0, len(keys), tile_batch_size):
+            batch_keys = keys[start:start + tile_batch_size]
+            for (i, r, c), output_tile in zip(batch_keys, model(gather_tiles(img, grid, batch_keys))):
+                yield (i, r, c), trim(r, c, output_tile)
+        return
+
+    pending, batch_keys = [], []
+    for key in keys + [None]:
+        if key is not None:
+            pending.append(key)
+            if key in dirty:
+                batch_keys.append(key)
+            if len(batch_keys) < tile_batch_size:
+                continue
+        output_tiles = iter(model(gather_tiles(img, grid, batch_keys)) if batch_keys else ())
+        for i, r, c in pending:
+            if (i, r, c) in dirty:
+                # a copy, so that the cache does not hold on to the whole batch
+                cache.outputs[(r, c)] = trim(r, c, next(output_tiles)).clone()
+            yield (i, r, c), cache.outputs[(r, c)]
+        pending, batch_keys = [], []
+
+
+@torch.no_grad()
+def tile_forward(model, img, scale, tile_size, tile_pad=10, tile_batch_size=4, blend=False, cache=None):
+    """Tiled inference on a NCHW tensor.
+
+    The tiles of all the images in the batch are gathered and run through the model in micro-batches of
+    ``tile_batch_size``, then scattered back into the output. No state is kept outside this call, so several threads
+    may share one model, unless a ``cache`` is given.
+
+    Args:
+        model (nn.Module): The upsampling network.
+        img (Tensor): Input with shape (n, c, h, w).
+        scale (int): Upsampling scale of the network.
+        tile_size (int): Size of the square tiles, before padding.
+        tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
+        tile_batch_size (int): Number of tiles per forward pass. Default: 4.
+        blend (bool): Feather the overlapping tile paddings into each other instead of cutting them off.
+            Default: False.
+        cache (TileCache): For the successive frames of a video: only the tiles that changed since the previous
+            frames run through the model, the others reuse the cached output. Default: None.
+
+    Returns:
+        Tensor: Output with shape (n, c_out, h * scale, w * scale).
+    """
+    n, _, h, w = img.shape
+    grid = get_tile_grid(h, w, tile_size, tile_pad)
+    tile_h, tile_w = grid.tile_h * scale, grid.tile_w * scale
+    window_h, window_w = grid.window_h * scale, grid.window_w * scale
+    if cache is None:
+        keys, dirty = [(i, r, c) for i in range(n) for r, c in grid.tiles], None
+    else:
+        layout = (tuple(img.shape[1:]), img.dtype, img.device, tile_size, tile_pad, scale, blend)
+        keys, dirty = cache.scan(img, grid, layout)
+
+    def trim(r, c, output_tile):
+        # the part of the upsampled window that goes into the output
+        if blend:
+            return output_tile
+        ofs_y, ofs_x = (grid.rows[r][0] - grid.rows[r][1]) * scale, (grid.cols[c][0] - grid.cols[c][1]) * scale
+        return output_tile[:, ofs_y:ofs_y + tile_h, ofs_x:ofs_x + tile_w]
+
+    output = weight = None
+    try:
+        for (i, r, c), output_tile in _output_tiles(model, img, grid, keys, trim, tile_batch_size, cache, dirty):
+            if output is None:
+                output_shape = (n, output_tile.shape[0], h * scale, w * scale)
+                if blend:
+                    # accumulate in float32 for precision
+                    output = img.new_zeros(output_shape, dtype=torch.float32)
+                    weight = img.new_zeros((n, 1, h * scale, w * scale), dtype=torch.float32)
+                    row_weights, col_weights = grid.feather(scale, device=img.device)
+                else:
+                    output = img.new_zeros(output_shape, dtype=output_tile.dtype)
+
+            if blend:
+                y, x = grid.rows[r][1] * scale, grid.cols[c][1] * scale
+                feather = row_weights[r][:, None] * col_weights[c][None, :]
+                output[i, :, y:y + window_h, x:x + window_w] += output_tile.float() * feather
+                weight[i, 0, y:y + window_h, x:x + window_w] += feather
+            else:
+                y, x = grid.rows[r][0] * scale, grid.cols[c][0] * scale
+                output[i, :, y:y + tile_h, x:x + tile_w] = output_tile
+    except BaseException:
+        if cache is not None:
+            # the references were taken for tiles that never made it into the cache
+            cache.reset()
+        raise
+
+    if blend:
+        output = output.div_(weight).to(img.dtype)
+    return output
@@ -1,14 +1,77 @@
+import collections
+import concurrent.futures
 import cv2
-import math
+import hashlib
+import logging
 import numpy as np
 import os
-import queue
 import threading
+import time
 import torch
 from basicsr.utils.download_util import load_file_from_url
 from torch.nn import functional as F
 
+from realesrgan.archs.srvgg_arch import optimize_for_inference
+from realesrgan.ncnn_loader import load_ncnn_srvgg
+from realesrgan.quantization import load_quantized
+from realesrgan.tiling import TileCache, tile_forward
+
+logger = logging.getLogger(__name__)
+
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DNI_CACHE_DIR = os.path.join(ROOT_DIR, 'weights', 'dni')
+
+# prepared networks shared by the RealESRGANer instances of the process, least recently used first
+MODEL_CACHE_SIZE = 4
+_model_cache = collections.OrderedDict()
+_model_cache_lock = threading.Lock()
+# futures of the networks being loaded, so that the lock is not held while loading and a network is loaded once
+_model_loads = {}
+# (model key, shape) pairs that warmup already ran
+_warm_shapes = set()
+
+
+def load_checkpoint(path):
+    """Load a checkpoint onto the CPU, memory-mapped when its format allows it.
+
+    The tensors of a memory-mapped checkpoint are read from the page cache when the model copies them, instead of
+    reading the whole file into a buffer first. Checkpoints in the legacy format are read the usual way.
+    """
+    try:
+        return torch.load(path, map_location=torch.device('cpu'), mmap=True)
+    except (RuntimeError, TypeError):
+        # TypeError: torch older than 2.1 has no mmap argument
+        return torch.load(path, map_location=torch.device('cpu'))
+
+
+def _file_key(path):
+    """Identify the contents of a weights file by its path, size and modification time. URLs are their own key."""
+    if not os.path.isfile(path):
+        return path
+    stat = os.stat(path)
+    return os.path.realpath(path), stat.st_size, stat.st_mtime_ns
+
+
+def _model_key(scale, model_path, dni_weight, model, half, device, inference_mode, quantized):
+    """Key of a prepared network in the model cache."""
+    if isinstance(model_path, list):
+        source = tuple(_file_key(path) for path in model_path)
+    elif model_path.endswith('.param'):
+        # the weights of an ncnn model are in the .bin next to the graph
+        source = (_file_key(model_path), _file_key(os.path.splitext(model_path)[0] + '.bin'))
+    else:
+        source = _file_key(model_path)
+    # the architecture of the network the weights are loaded into, ncnn and quantized models bring their own
+    arch = None if quantized or model is None else repr(model)
+    return (scale, source, tuple(dni_weight) if dni_weight is not None else None, arch, bool(half),
+            str(torch.device(device)), inference_mode, quantized)
+
+
+def clear_model_cache():
+    """Drop the networks shared by the RealESRGANer instances, e.g. to free the device memory."""
+    with _model_cache_lock:
+        _model_cache.clear()
+        _warm_shapes.clear()
 
 
 class RealESRGANer():
@@ -17,13 +80,28 @@ class RealESRGANer():
     Args:
         scale (int): Upsampling scale factor used in the networks. It is usually 2 or 4.
         model_path (str): The path to the pretrained model. It can be urls (will first download it automatically).
-        model (nn.Module): The defined network. Default: None.
+            A ncnn .param file (with its .bin next to it) builds the network from the graph instead.
+        model (nn.Module): The defined network. Not used for ncnn models. Default: None.
         tile (int): As too large images result in the out of GPU memory issue, so this tile option will first crop
             input images into tiles, and then process each of them. Finally, they will be merged into one image.
             0 denotes for do not use tile. Default: 0.
         tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
         pre_pad (int): Pad the input images to avoid border artifacts. Default: 10.
         half (float): Whether to use half precision during inference. Default: False.
+        tile_batch_size (int): Number of tiles stacked into one forward pass. Default: 4.
+        tile_blend (bool): Feather the tile paddings into the neighbouring tiles instead of hard seams.
+            Default: False.
+        inference_mode (str): Prepare the network with ``optimize_for_inference``: 'script', 'compile' or 'eager'.
+            None keeps the network as it is. Default: None.
+        quantized (bool): model_path is an int8 TorchScript archive made by ``realesrgan.quantization``. It runs on the
+            CPU only, in float32 for the parts that are not quantized. Default: False.
+        batch_size (int): Number of frames stacked into one forward pass by ``enhance_batch``. None denotes for
+            choosing it from the free memory of the device. Default: None.
+        cache_model (bool): Share the prepared network with the other instances of the process that load the same
+            weights (same files, dni weights, architecture, precision, device and inference mode), instead of loading
+            it again. The shared network is only ever run, never modified. Default: True.
+        dni_cache_dir (str): Folder where interpolated dni checkpoints are kept for the next runs. None disables it.
+            Default: the weights/dni folder.
     """
 
     def __init__(self,
@@ -36,13 +114,25 @@ class RealESRGANer():
                  pre_pad=10,
                  half=False,
                  device=None,
-                 gpu_id=None):
+                 gpu_id=None,
+                 batch_size=None,
+                 tile_batch_size=4,
+                 tile_blend=False,
+                 inference_mode=None,
+                 quantized=False,
+                 cache_model=True,
+                 dni_cache_dir=DNI_CACHE_DIR):
         self.scale = scale
         self.tile_size = tile
         self.tile_pad = tile_pad
         self.pre_pad = pre_pad
         self.mod_scale = None
         self.half = half
+        self.batch_size = batch_size
+        self.tile_batch_size = tile_batch_size
+        self.tile_blend = tile_blend
+        # per-thread buffers of enhance_batch_into
+        self._buffers = threading.local()
 
         # initialize model
         if gpu_id:
@@ -51,38 +141,126 @@ class RealESRGANer():
         else:
             self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
 
+        if cache_model:
+            self.model_key = _model_key(scale, model_path, dni_weight, model, self.half, self.device, inference_mode,
+                                        quantized)
+            entry = self._cached_model(model_path, dni_weight, model, inference_mode, quantized, dni_cache_dir)
+        else:
+            self.model_key = None
+            entry = self._load_model(model_path, dni_weight, model, inference_mode, quantized, dni_cache_dir)
+        self.model, self.device, self.half = entry
+
+    def _cached_model(self, model_path, dni_weight, model, inference_mode, quantized, dni_cache_dir):
+        """Get the network of ``self.model_key`` from the model cache, loading it on a miss.
+
+        The cache lock is only held to look up and insert, never while loading (which may download weights). Instances
+        asking for a network that another thread is loading wait for that load instead of starting their own.
+        """
+        with _model_cache_lock:
+            entry = _model_cache.get(self.model_key)
+            if entry is not None:
+                logger.debug('Reusing the loaded network of %s', model_path)
+                _model_cache.move_to_end(self.model_key)
+                return entry
+            future = _model_loads.get(self.model_key)
+            loading = future is None
+            if loading:
+                future = _model_loads[self.model_key] = concurrent.futures.Future()
+        if not loading:
+            return future.result()
+
+        try:
+            entry = self._load_model(model_path, dni_weight, model, inference_mode, quantized, dni_cache_dir)
+        except BaseException as error:
+            with _model_cache_lock:
+                del _model_loads[self.model_key]
+            future.set_exception(error)
+            raise
+        with _model_cache_lock:
+            del _model_loads[self.model_key]
+            _model_cache[self.model_key] = entry
+            while len(_model_cache) > MODEL_CACHE_SIZE:
+                evicted, _ = _model_cache.popitem(last=False)
+                _warm_shapes.difference_update([key for key in _warm_shapes if key[0] == evicted])
+        future.set_result(entry)
+        return entry
+
+    def _load_model(self, model_path, dni_weight, model, inference_mode, quantized, dni_cache_dir):
+        """Load the weights into the network and prepare it for inference.
+
+        Returns:
+            tuple: The network, its device and whether it runs in half precision.
+        """
+        device, half = self.device, self.half
         if isinstance(model_path, list):
             # dni
             assert len(model_path) == len(dni_weight), 'model_path and dni_weight should have the save length.'
-            loadnet = self.dni(model_path[0], model_path[1], dni_weight)
+            loadnet = self.dni(model_path[0], model_path[1], dni_weight, cache_dir=dni_cache_dir)
+        elif quantized:
+            model = load_quantized(model_path)
+            loadnet = None
+            if model.upscale != self.scale:
+                raise ValueError(f'{model_path} upsamples by {model.upscale}, not by {self.scale}.')
+            # quantized kernels only exist on the CPU
+            device = torch.device('cpu')
+            half = False
+            inference_mode = None
+        elif model_path.endswith('.param'):
+            # ncnn model, the weights are read from the memory-mapped .bin file
+            model = load_ncnn_srvgg(model_path)
+            loadnet = None
+            if model.upscale != self.scale:
+                raise ValueError(f'{model_path} upsamples by {model.upscale}, not by {self.scale}.')
         else:
             # if the model_path starts with https, it will first download models to the folder: weights
             if model_path.startswith('https://'):
                 model_path = load_file_from_url(
                     url=model_path, model_dir=os.path.join(ROOT_DIR, 'weights'), progress=True, file_name=None)
-            loadnet = torch.load(model_path, map_location=torch.device('cpu'))
+            loadnet = load_checkpoint(model_path)
 
-        # prefer to use params_ema
-        if 'params_ema' in loadnet:
-            keyname = 'params_ema'
-        else:
-            keyname = 'params'
-        model.load_state_dict(loadnet[keyname], strict=True)
+        if loadnet is not None:
+            # prefer to use params_ema
+            if 'params_ema' in loadnet:
+                keyname = 'params_ema'
+            else:
+                keyname = 'params'
+            model.load_state_dict(loadnet[keyname], strict=True)
 
         model.eval()
-        self.model = model.to(self.device)
-        if self.half:
-            self.model = self.model.half()
-
-    def dni(self, net_a, net_b, dni_weight, key='params', loc='cpu'):
+        model = model.to(device)
+        if half:
+            model = model.half()
+        if inference_mode is not None:
+            model = optimize_for_inference(model, mode=inference_mode)
+        return model, device, half
+
+    def dni(self, net_a, net_b, dni_weight, key='params', loc='cpu', cache_dir=None):
         """Deep network interpolation.
 
         ``Paper: Deep Network Interpolation for Continuous Imagery Effect Transition``
+
+        With ``cache_dir``, the interpolated checkpoint is saved there and loaded back, memory-mapped, by the next calls
+        with the same two files and weights.
         """
+        cache_path = None
+        if cache_dir is not None:
+            digest = hashlib.sha1(repr((_file_key(net_a), _file_key(net_b), tuple(dni_weight), key)).encode())
+            cache_path = os.path.join(cache_dir, f'dni_{digest.hexdigest()}.pth')
+            if os.path.exists(cache_path):
+                return load_checkpoint(cache_path)
         net_a = torch.load(net_a, map_location=torch.device(loc))
         net_b = torch.load(net_b, map_location=torch.device(loc))
         for k, v_a in net_a[key].items():
             net_a[key][k] = dni_weight[0] * v_a + dni_weight[1] * net_b[key][k]
+        if cache_path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                # written under a temporary name, so that a cache file only exists complete
+                partial_path = f'{cache_path}.{os.getpid()}.partial'
+                torch.save(net_a, partial_path)
+                os.replace(partial_path, cache_path)
+            except OSError as error:
+                logger.warning('Could not cache the interpolated network in %s: %s', cache_dir, error)
         return net_a
 
     def pre_process(self, img):
@@ -92,112 +270,119 @@ class RealESRGANer():
         self.img = img.unsqueeze(0).to(self.device)
         if self.half:
             self.img = self.img.half()
+        self.img, self.mod_pad_h, self.mod_pad_w = self.pad(self.img)
+        self.mod_scale = self.get_mod_scale()
 
+    def get_mod_scale(self):
+        if self.scale == 2:
+            return 2
+        elif self.scale == 1:
+            return 4
+        return None
+
+    def pad(self, img):
+        """Pre-pad and mod pad a NCHW tensor without touching the instance state.
+
+        Returns:
+            tuple: The padded tensor, mod_pad_h and mod_pad_w.
+        """
         # pre_pad
         if self.pre_pad != 0:
-            self.img = F.pad(self.img, (0, self.pre_pad, 0, self.pre_pad), 'reflect')
+            img = F.pad(img, (0, self.pre_pad, 0, self.pre_pad), 'reflect')
         # mod pad for divisible borders
-        if self.scale == 2:
-            self.mod_scale = 2
-        elif self.scale == 1:
-            self.mod_scale = 4
-        if self.mod_scale is not None:
-            self.mod_pad_h, self.mod_pad_w = 0, 0
-            _, _, h, w = self.img.size()
-            if (h % self.mod_scale != 0):
-                self.mod_pad_h = (self.mod_scale - h % self.mod_scale)
-            if (w % self.mod_scale != 0):
-                self.mod_pad_w = (self.mod_scale - w % self.mod_scale)
-            self.img = F.pad(self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), 'reflect')
+        mod_scale = self.get_mod_scale()
+        mod_pad_h, mod_pad_w = 0, 0
+        if mod_scale is not None:
+            _, _, h, w = img.size()
+            if (h % mod_scale != 0):
+                mod_pad_h = (mod_scale - h % mod_scale)
+            if (w % mod_scale != 0):
+                mod_pad_w = (mod_scale - w % mod_scale)
+            img = F.pad(img, (0, mod_pad_w, 0, mod_pad_h), 'reflect')
+        return img, mod_pad_h, mod_pad_w
+
+    def unpad(self, output, mod_pad_h, mod_pad_w):
+        """Remove the mod pad and the pre pad from an upsampled NCHW tensor."""
+        # remove extra pad
+        _, _, h, w = output.size()
+        output = output[:, :, 0:h - mod_pad_h * self.scale, 0:w - mod_pad_w * self.scale]
+        # remove prepad
+        if self.pre_pad != 0:
+            _, _, h, w = output.size()
+            output = output[:, :, 0:h - self.pre_pad * self.scale, 0:w - self.pre_pad * self.scale]
+        return output
 
     def process(self):
         # model inference
         self.output = self.model(self.img)
 
+    def infer(self, img, tile_cache=None):
+        """Run the model on a padded NCHW tensor, with tiles if tile_size is set or a tile cache is given."""
+        if tile_cache is not None:
+            return tile_forward(
+                self.model,
+                img,
+                self.scale,
+                tile_cache.tile_size,
+                tile_pad=self.tile_pad,
+                tile_batch_size=self.tile_batch_size,
+                blend=self.tile_blend,
+                cache=tile_cache)
+        if self.tile_size > 0:
+            return self.tile_forward(img)
+        return self.model(img)
+
     def tile_process(self):
         """It will first crop input images to tiles, and then process each tile.
         Finally, all the processed tiles are merged into one images.
 
         Modified from: https://github.com/ata4/esrgan-launcher
         """
-        batch, channel, height, width = self.img.shape
-        output_height = height * self.scale
-        output_width = width * self.scale
-        output_shape = (batch, channel, output_height, output_width)
-
-        # start with black image
-        self.output = self.img.new_zeros(output_shape)
-        tiles_x = math.ceil(width / self.tile_size)
-        tiles_y = math.ceil(height / self.tile_size)
-
-        # loop over all tiles
-        for y in range(tiles_y):
-            for x in range(tiles_x):
-                # extract tile from input image
-                ofs_x = x * self.tile_size
-                ofs_y = y * self.tile_size
-                # input tile area on total image
-                input_start_x = ofs_x
-                input_end_x = min(ofs_x + self.tile_size, width)
-                input_start_y = ofs_y
-                input_end_y = min(ofs_y + self.tile_size, height)
-
-                # input tile area on total image with padding
-                input_start_x_pad = max(input_start_x - self.tile_pad, 0)
-                input_end_x_pad = min(input_end_x + self.tile_pad, width)
-                input_start_y_pad = max(input_start_y - self.tile_pad, 0)
-                input_end_y_pad = min(input_end_y + self.tile_pad, height)
-
-                # input tile dimensions
-                input_tile_width = input_end_x - input_start_x
-                input_tile_height = input_end_y - input_start_y
-                tile_idx = y * tiles_x + x + 1
-                input_tile = self.img[:, :, input_start_y_pad:input_end_y_pad, input_start_x_pad:input_end_x_pad]
-
-                # upscale tile
-                try:
-                    with torch.no_grad():
-                        output_tile = self.model(input_tile)
-                except RuntimeError as error:
-                    print('Error', error)
-                print(f'\tTile {tile_idx}/{tiles_x * tiles_y}')
-
-                # output tile area on total image
-                output_start_x = input_start_x * self.scale
-                output_end_x = input_end_x * self.scale
-                output_start_y = input_start_y * self.scale
-                output_end_y = input_end_y * self.scale
-
-                # output tile area without padding
-                output_start_x_tile = (input_start_x - input_start_x_pad) * self.scale
-                output_end_x_tile = output_start_x_tile + input_tile_width * self.scale
-                output_start_y_tile = (input_start_y - input_start_y_pad) * self.scale
-                output_end_y_tile = output_start_y_tile + input_tile_height * self.scale
-
-                # put tile into output image
-                self.output[:, :, output_start_y:output_end_y,
-                            output_start_x:output_end_x] = output_tile[:, :, output_start_y_tile:output_end_y_tile,
-                                                                       output_start_x_tile:output_end_x_tile]
+        self.output = self.tile_forward(self.img)
+
+    def tile_forward(self, img):
+        """Tiled inference on a padded NCHW tensor, returns the upsampled tensor."""
+        return tile_forward(
+            self.model,
+            img,
+            self.scale,
+            self.tile_size,
+            tile_pad=self.tile_pad,
+            tile_batch_size=self.tile_batch_size,
+            blend=self.tile_blend)
 
     def post_process(self):
-        # remove extra pad
-        if self.mod_scale is not None:
-            _, _, h, w = self.output.size()
-            self.output = self.output[:, :, 0:h - self.mod_pad_h * self.scale, 0:w - self.mod_pad_w * self.scale]
-        # remove prepad
-        if self.pre_pad != 0:
-            _, _, h, w = self.output.size()
-            self.output = self.output[:, :, 0:h - self.pre_pad * self.scale, 0:w - self.pre_pad * self.scale]
+        self.output = self.unpad(self.output, self.mod_pad_h, self.mod_pad_w)
         return self.output
 
+    def upsample(self, img):
+        """Upsample a HWC RGB float image in [0, 1], returns the HWC BGR float output.
+
+        It keeps all the intermediate tensors local, so that it is safe to call from several threads.
+        """
+        img = torch.from_numpy(np.transpose(img, (2, 0, 1))).float()
+        img = img.unsqueeze(0).to(self.device)
+        if self.half:
+            img = img.half()
+        img, mod_pad_h, mod_pad_w = self.pad(img)
+        output = self.unpad(self.infer(img), mod_pad_h, mod_pad_w)
+        output = output.data.squeeze().float().cpu().clamp_(0, 1).numpy()
+        return np.transpose(output[[2, 1, 0], :, :], (1, 2, 0))
+
     @torch.no_grad()
-    def enhance(self, img, outscale=None, alpha_upsampler='realesrgan'):
+    def enhance(self, img, outscale=None, alpha_upsampler='realesrgan', bit_depth=None):
+        """Upsample one image, gray, BGR or BGRA.
+
+        ``bit_depth`` (8 or 16) skips the scan of the whole image that otherwise guesses it.
+        """
         h_input, w_input = img.shape[0:2]
         # img: numpy
         img = img.astype(np.float32)
-        if np.max(img) > 256:  # 16-bit image
+        if bit_depth is not None:
+            max_range = 2**bit_depth - 1
+        elif np.max(img) > 256:  # 16-bit image
             max_range = 65535
-            print('\tInput is a 16-bit image')
+            logger.debug('Input is a 16-bit image')
         else:
             max_range = 255
         img = img / max_range
@@ -216,28 +401,14 @@ class RealESRGANer():
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
         # ------------------- process image (without the alpha channel) ------------------- #
-        self.pre_process(img)
-        if self.tile_size > 0:
-            self.tile_process()
-        else:
-            self.process()
-        output_img = self.post_process()
-        output_img = output_img.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-        output_img = np.transpose(output_img[[2, 1, 0], :, :], (1, 2, 0))
+        output_img = self.upsample(img)
         if img_mode == 'L':
             output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
 
         # ------------------- process the alpha channel if necessary ------------------- #
         if img_mode == 'RGBA':
             if alpha_upsampler == 'realesrgan':
-                self.pre_process(alpha)
-                if self.tile_size > 0:
-                    self.tile_process()
-                else:
-                    self.process()
-                output_alpha = self.post_process()
-                output_alpha = output_alpha.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-                output_alpha = np.transpose(output_alpha[[2, 1, 0], :, :], (1, 2, 0))
+                output_alpha = self.upsample(alpha)
                 output_alpha = cv2.cvtColor(output_alpha, cv2.COLOR_BGR2GRAY)
             else:  # use the cv2 resize for alpha channel
                 h, w = alpha.shape[0:2]
@@ -262,52 +433,498 @@ class RealESRGANer():
 
         return output, img_mode
 
+    def estimate_batch_size(self, height, width, max_batch_size=16):
+        """Estimate how many frames of the given size fit in the free memory of the device.
 
-class PrefetchReader(threading.Thread):
-    """Prefetch images.
+        Only half of the free memory is budgeted, the rest is left for the allocator and the other pipeline stages.
+        """
+        bytes_per_value = 2 if self.half else 4
+        if self.tile_size > 0:
+            height, width = min(height, self.tile_size), min(width, self.tile_size)
+            height, width = height + 2 * self.tile_pad, width + 2 * self.tile_pad
+        else:
+            height, width = height + self.pre_pad + 4, width + self.pre_pad + 4
+        num_feat = getattr(self.model, 'num_feat', 64)
+        # the input, two live feature maps and the upsampled output (plus its residual)
+        values = height * width * (3 + 2 * num_feat + 2 * 3 * self.scale**2)
+        budget = available_memory(self.device) // 2
+        return int(max(1, min(max_batch_size, budget // (values * bytes_per_value))))
+
+    def warmup(self, height, width, bit_depth=8, tile_size=None):
+        """Run the network on blank frames of the given size, so that the first frames of a video run at full speed.
+
+        The first passes of an input shape select and build the oneDNN (or cuDNN) kernels, and a TorchScript network
+        is only optimized after a profiling pass. A network shared through the model cache is warmed once per shape.
+
+        Args:
+            height (int): Height of the frames given to ``enhance_batch_into``.
+            width (int): Width of the frames.
+            bit_depth (int): Bits per sample of the frames. Default: 8.
+            tile_size (int): The frames go through a ``TileCache`` of this tile size. Default: None.
+
+        Returns:
+            bool: Whether it ran, False when the network was already warm for the shape.
+        """
+        batch_size = self.batch_size or self.estimate_batch_size(height, width)
+        shape = (batch_size, height, width, bit_depth, self.tile_size, tile_size)
+        key = (self.model_key if self.model_key is not None else id(self.model), shape)
+        if key in _warm_shapes:
+            return False
+        frames = np.zeros((batch_size, height, width, 3), dtype=np.uint8 if bit_depth <= 8 else np.uint16)
+        # the profiling pass of a TorchScript network does not run the optimized graph yet
+        passes = 2 if isinstance(self.model, torch.jit.ScriptModule) else 1
+        for _ in range(passes):
+            tile_cache = TileCache(tile_size) if tile_size else None
+            self.enhance_batch_into(frames, bit_depth=bit_depth, tile_cache=tile_cache)
+        _warm_shapes.add(key)
+        return True
 
-    Args:
-        img_list (list[str]): A image list of image paths to be read.
-        num_prefetch_queue (int): Number of prefetch queue.
-    """
+    @torch.no_grad()
+    def enhance_batch(self, frames, outscale=None, batch_size=None):
+        """Upsample a list of BGR frames sharing the same shape.
 
-    def __init__(self, img_list, num_prefetch_queue):
-        super().__init__()
-        self.que = queue.Queue(num_prefetch_queue)
-        self.img_list = img_list
+        The frames are stacked into NCHW tensors and each batch goes through one pad, inference and unpad pass.
+        Unlike ``enhance``, no state is stored on the instance, so frames from several threads may share one model.
 
-    def run(self):
-        for img_path in self.img_list:
-            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-            self.que.put(img)
+        Args:
+            frames (list[ndarray]): HWC BGR frames with the same shape and dtype, uint8 or uint16.
+            outscale (float): The final upsampling scale. Default: None.
+            batch_size (int): Frames per forward pass. Default: None, uses ``self.batch_size`` or the estimate.
 
-        self.que.put(None)
+        Returns:
+            list[ndarray]: The upsampled frames, in the input order.
+        """
+        if len(frames) == 0:
+            return []
+        h_input, w_input = frames[0].shape[0:2]
+        if any(frame.shape != frames[0].shape for frame in frames):
+            raise ValueError('All frames in a batch should have the same shape.')
+        if frames[0].ndim != 3 or frames[0].shape[2] != 3:
+            raise ValueError('enhance_batch only supports 3-channel BGR frames, use enhance for other images.')
+        max_range = 65535 if frames[0].dtype == np.uint16 else 255
+        if batch_size is None:
+            batch_size = self.batch_size or self.estimate_batch_size(h_input, w_input)
+
+        outputs = []
+        for start in range(0, len(frames), batch_size):
+            img, mod_pad_h, mod_pad_w = self.frames_to_tensor(frames[start:start + batch_size])
+            output = self.infer(img)
+            outputs.extend(self.tensor_to_frames(output, mod_pad_h, mod_pad_w, max_range, outscale))
+        return outputs
+
+    def frames_to_tensor(self, frames):
+        """Stack HWC BGR frames into a padded NCHW RGB tensor in [0, 1], on the model device.
+
+        Returns:
+            tuple: The padded tensor, mod_pad_h and mod_pad_w.
+        """
+        max_range = 65535 if frames[0].dtype == np.uint16 else 255
+        batch = np.stack(frames)
+        if batch.dtype == np.uint16:
+            # torch has no uint16 tensors before 2.3, int32 holds every value
+            batch = batch.astype(np.int32)
+        batch = torch.from_numpy(batch).to(self.device)
+        # NHWC BGR -> NCHW RGB in [0, 1]
+        img = batch.permute(0, 3, 1, 2).flip(1)
+        img = img.half() if self.half else img.float()
+        img = img / max_range
+        return self.pad(img)
 
-    def __next__(self):
-        next_item = self.que.get()
-        if next_item is None:
-            raise StopIteration
-        return next_item
+    def tensor_to_frames(self, output, mod_pad_h, mod_pad_w, max_range=255, outscale=None):
+        """Convert the model output for a ``frames_to_tensor`` batch back to HWC BGR frames.
+
+        Args:
+            output (Tensor): NCHW RGB model output.
+            mod_pad_h (int): mod_pad_h returned by ``frames_to_tensor``.
+            mod_pad_w (int): mod_pad_w returned by ``frames_to_tensor``.
+            max_range (int): 255 for uint8 frames, 65535 for uint16 frames. Default: 255.
+            outscale (float): The final upsampling scale. Default: None.
+
+        Returns:
+            list[ndarray]: The upsampled frames.
+        """
+        output = self.unpad(output, mod_pad_h, mod_pad_w)
+        # NCHW RGB -> NHWC BGR
+        output = output.float().clamp_(0, 1).flip(1).permute(0, 2, 3, 1)
+        output = (output * max_range).round_().cpu().numpy()
+        outputs = list(output.astype(np.uint16 if max_range == 65535 else np.uint8))
+
+        if outscale is not None and outscale != float(self.scale):
+            h_output, w_output = outputs[0].shape[0:2]
+            size = (int(w_output / self.scale * outscale), int(h_output / self.scale * outscale))
+            outputs = [cv2.resize(output, size, interpolation=cv2.INTER_LANCZOS4) for output in outputs]
+        return outputs
+
+
+    def pad_indices(self, size):
+        """Source indices of the rows (or columns) of an image of ``size`` after ``pad``.
+
+        Composes the reflect pre pad and the reflect mod pad, so that one gather gives the same padded image.
+
+        Returns:
+            tuple: The indices and the mod pad.
+        """
+        indices = np.arange(size + self.pre_pad)
+        indices[size:] = 2 * (size - 1) - indices[size:]
+        mod_scale = self.get_mod_scale()
+        mod_pad = 0
+        if mod_scale is not None and len(indices) % mod_scale != 0:
+            mod_pad = mod_scale - len(indices) % mod_scale
+            padded = len(indices)
+            indices = np.concatenate([indices, indices[2 * (padded - 1) - np.arange(padded, padded + mod_pad)]])
+        if indices.min() < 0:
+            raise ValueError(f'Images of size {size} are too small for a pre pad of {self.pre_pad}.')
+        return indices, mod_pad
+
+    def _batch_buffers(self, n, h, w, dtype):
+        """Buffers of ``enhance_batch_into`` for one batch shape, kept per thread and reused across calls."""
+        cache = getattr(self._buffers, 'cache', None)
+        if cache is None:
+            cache = self._buffers.cache = {}
+        key = (n, h, w, dtype)
+        if key not in cache:
+            if len(cache) >= 4:
+                cache.clear()
+            rows, mod_pad_h = self.pad_indices(h)
+            cols, mod_pad_w = self.pad_indices(w)
+            # torch has no uint16 tensors before 2.3, 16-bit frames are padded into int32
+            padded = np.empty((n, len(rows), len(cols), 3), dtype=np.int32 if dtype == np.uint16 else dtype)
+            img = torch.empty((n, 3, len(rows), len(cols)),
+                              dtype=torch.half if self.half else torch.float32,
+                              device=self.device)
+            cache[key] = {
+                'rows': rows[h:],
+                'cols': cols[w:],
+                'mod_pad_h': mod_pad_h,
+                'mod_pad_w': mod_pad_w,
+                'padded': padded,
+                'padded_tensor': torch.from_numpy(padded),
+                'device_padded': None,
+                'img': img,
+                # the output of the model converted to float32 on the CPU, when it is not already
+                'staging': None,
+                # the upsampled frames before the resize to outscale
+                'native': None,
+            }
+        return cache[key]
+
+    @torch.no_grad()
+    def enhance_batch_into(self, frames, outputs=None, bit_depth=8, outscale=None, tile_cache=None):
+        """Upsample BGR video frames sharing one shape into preallocated output frames.
+
+        A faster ``enhance_batch`` for frames whose bit depth is known: no scan for the range, one padding gather and
+        buffers that are reused for every batch of the same shape, so that a steady stream of frames allocates little
+        more than the network output. Buffers are kept per thread, several threads may share the instance.
+
+        Args:
+            frames (list[ndarray] | ndarray): HWC BGR frames, or one NHWC array. uint8 for a bit depth of 8, uint16
+                above.
+            outputs (list[ndarray] | ndarray): Arrays the upsampled frames are written to, of the output shape and the
+                input dtype. Default: None, allocates one NHWC array.
+            bit_depth (int): Bits per sample of the frames. Default: 8.
+            outscale (float): The final upsampling scale. Default: None.
+            tile_cache (TileCache): The frames are the next frames of a video, upsample only the tiles that changed
+                since the previous ones. Default: None.
+
+        Returns:
+            list[ndarray] | ndarray: ``outputs``.
+        """
+        n = len(frames)
+        if n == 0:
+            return outputs if outputs is not None else []
+        h, w = frames[0].shape[0:2]
+        if any(frame.shape != (h, w, 3) for frame in frames):
+            raise ValueError('enhance_batch_into only supports 3-channel BGR frames sharing one shape.')
+        dtype = np.uint8 if bit_depth <= 8 else np.uint16
+        max_range = 2**bit_depth - 1
+        h_native, w_native = h * self.scale, w * self.scale
+        if outscale is not None and outscale != float(self.scale):
+            size = (int(w * outscale), int(h * outscale))
+        else:
+            size = (w_native, h_native)
+        if outputs is None:
+            outputs = np.empty((n, size[1], size[0], 3), dtype=dtype)
+
+        batch_size = self.batch_size or self.estimate_batch_size(h, w)
+        for start in range(0, n, batch_size):
+            chunk = frames[start:start + batch_size]
+            buffers = self._batch_buffers(len(chunk), h, w, dtype)
+            padded = buffers['padded']
+            rows, cols = buffers['rows'], buffers['cols']
+            # pre pad and mod pad in one pass over the frames
+            for index, frame in enumerate(chunk):
+                padded[index, :h, :w] = frame
+                padded[index, :h, w:] = frame[:, cols]
+                padded[index, h:] = padded[index, rows]
+
+            # NHWC BGR -> NCHW RGB in [0, 1], converted while copying
+            img = buffers['img']
+            source = buffers['padded_tensor']
+            if img.device.type != 'cpu':
+                if buffers['device_padded'] is None:
+                    buffers['device_padded'] = torch.empty_like(source, device=img.device)
+                source = buffers['device_padded'].copy_(source, non_blocking=True)
+            for channel in range(3):
+                img[:, channel].copy_(source[..., 2 - channel])
+            img.div_(max_range)
+
+            output = self.unpad(self.infer(img, tile_cache), buffers['mod_pad_h'], buffers['mod_pad_w'])
+            if output.device.type != 'cpu' or output.dtype != torch.float32:
+                if buffers['staging'] is None:
+                    buffers['staging'] = torch.empty(output.shape, dtype=torch.float32)
+                output = buffers['staging'].copy_(output)
+            # exact integers after the round, so the cast below does not truncate anything
+            output.clamp_(0, 1).mul_(max_range).round_()
+
+            if size == (w_native, h_native):
+                targets = outputs[start:start + len(chunk)]
+            else:
+                if buffers['native'] is None:
+                    buffers['native'] = np.empty((len(chunk), h_native, w_native, 3), dtype=dtype)
+                targets = buffers['native']
+            for index, target in enumerate(targets):
+                if target.dtype == np.uint16:
+                    # no uint16 tensor to copy into, numpy casts while assigning
+                    target[...] = output[index].numpy()[::-1].transpose(1, 2, 0)
+                    continue
+                target_tensor = torch.from_numpy(target)
+                for channel in range(3):
+                    # NCHW RGB -> HWC BGR
+                    target_tensor[..., channel].copy_(output[index, 2 - channel])
+            if size != (w_native, h_native):
+                for index, target in enumerate(targets):
+                    cv2.resize(target, size, dst=outputs[start + index], interpolation=cv2.INTER_LANCZOS4)
+        return outputs
+
+def available_memory(device):
+    """Free memory in bytes on the given torch device."""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        # no sysconf on Windows, assume a modest 4 GB
+        return 4 * 1024**3
+
+
+class ImageReaderPool():
+    """Read images on several threads and yield them in the input order.
+
+    Decoded images wait in memory until the caller takes them. Readers block once the waiting images reach
+    ``max_bytes``, except for the image the caller needs next, so a large image never deadlocks the pool. Up to one
+    more image per thread is held while being decoded. A failed read is raised from ``__next__`` at the position of
+    its path. Use the pool as a context manager, or call ``close``, to stop the threads early.
+
+    Args:
+        paths (list[str]): Image paths to read.
+        num_threads (int): Reader threads. Default: 4.
+        max_bytes (int): Bytes of decoded images that may wait for the caller. Default: 256 MB.
+        flags (int): cv2.imread flags. Default: cv2.IMREAD_UNCHANGED.
+
+    Attributes:
+        peak_bytes (int): Largest amount of decoded images waiting at once.
+        backpressure_seconds (float): Time readers were blocked on a full pool, summed over the threads.
+        stall_seconds (float): Time the caller waited for an image to be read.
+    """
+
+    def __init__(self, paths, num_threads=4, max_bytes=256 * 1024**2, flags=cv2.IMREAD_UNCHANGED):
+        self.paths = list(paths)
+        self.max_bytes = max_bytes
+        self.flags = flags
+        self.bytes_queued = 0
+        self.peak_bytes = 0
+        self.backpressure_seconds = 0.0
+        self.stall_seconds = 0.0
+        self._results = {}
+        self._next_read = 0
+        self._next_yield = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._read_loop, name=f'image-reader-{i}', daemon=True)
+            for i in range(max(1, min(num_threads, len(self.paths))))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _read_loop(self):
+        while True:
+            with self._condition:
+                if self._closed or self._next_read >= len(self.paths):
+                    return
+                index = self._next_read
+                self._next_read += 1
+            try:
+                img = cv2.imread(self.paths[index], self.flags)
+                if img is None:
+                    raise IOError(f'Cannot read image {self.paths[index]}')
+                result, nbytes = img, img.nbytes
+            except Exception as error:
+                result, nbytes = error, 0
+            with self._condition:
+                start = time.monotonic()
+                while (not self._closed and index != self._next_yield and self.bytes_queued
+                       and self.bytes_queued + nbytes > self.max_bytes):
+                    self._condition.wait()
+                self.backpressure_seconds += time.monotonic() - start
+                if self._closed:
+                    return
+                self._results[index] = (result, nbytes)
+                self.bytes_queued += nbytes
+                self.peak_bytes = max(self.peak_bytes, self.bytes_queued)
+                self._condition.notify_all()
 
     def __iter__(self):
         return self
 
+    def __next__(self):
+        """Returns the next (path, image) pair."""
+        with self._condition:
+            if self._closed or self._next_yield >= len(self.paths):
+                raise StopIteration
+            index = self._next_yield
+            start = time.monotonic()
+            while index not in self._results:
+                self._condition.wait()
+            self.stall_seconds += time.monotonic() - start
+            result, nbytes = self._results.pop(index)
+            self._next_yield += 1
+            self.bytes_queued -= nbytes
+            self._condition.notify_all()
+        if isinstance(result, Exception):
+            raise result
+        return self.paths[index], result
+
+    def __len__(self):
+        return len(self.paths)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._results.clear()
+            self.bytes_queued = 0
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ImageWriterPool():
+    """Write images on several threads while the caller keeps working.
 
-class IOConsumer(threading.Thread):
+    ``put`` blocks once the images waiting to be written reach ``max_bytes``. Writes may finish out of order, but
+    ``callback`` gets the paths in the order they were put, each once every earlier image is on disk. The first write
+    error is raised from the next ``put`` or from ``close``, and the images still waiting are dropped. ``close`` waits
+    for the queued writes, using the pool as a context manager calls it.
 
-    def __init__(self, opt, que, qid):
-        super().__init__()
-        self._queue = que
-        self.qid = qid
-        self.opt = opt
+    Args:
+        num_threads (int): Writer threads. Default: 2.
+        max_bytes (int): Bytes of images that may wait to be written. Default: 256 MB.
+        callback (callable): Called with each written path, in order. Default: None.
+
+    Attributes:
+        peak_bytes (int): Largest amount of images waiting at once.
+        backpressure_seconds (float): Time ``put`` was blocked on a full pool.
+    """
 
-    def run(self):
+    def __init__(self, num_threads=2, max_bytes=256 * 1024**2, callback=None):
+        self.max_bytes = max_bytes
+        self.callback = callback
+        self.bytes_queued = 0
+        self.peak_bytes = 0
+        self.backpressure_seconds = 0.0
+        self._pending = collections.deque()
+        self._written = {}
+        self._next_put = 0
+        self._next_done = 0
+        self._error = None
+        self._closing = False
+        self._condition = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._write_loop, name=f'image-writer-{i}', daemon=True)
+            for i in range(max(1, num_threads))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, path, img, params=None):
+        """Queue ``img`` to be written to ``path`` with the given cv2.imwrite params."""
+        with self._condition:
+            if self._closing:
+                raise RuntimeError('The writer pool is closed')
+            start = time.monotonic()
+            while self._error is None and self.bytes_queued and self.bytes_queued + img.nbytes > self.max_bytes:
+                self._condition.wait()
+            self.backpressure_seconds += time.monotonic() - start
+            if self._error is not None:
+                raise self._error
+            self._pending.append((self._next_put, path, img, params))
+            self._next_put += 1
+            self.bytes_queued += img.nbytes
+            self.peak_bytes = max(self.peak_bytes, self.bytes_queued)
+            self._condition.notify_all()
+
+    def _write_loop(self):
         while True:
-            msg = self._queue.get()
-            if isinstance(msg, str) and msg == 'quit':
-                break
-
-            output = msg['output']
-            save_path = msg['save_path']
-            cv2.imwrite(save_path, output)
-        print(f'IO worker {self.qid} is done.')
+            with self._condition:
+                while not self._pending and not self._closing:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                index, path, img, params = self._pending.popleft()
+            try:
+                if not cv2.imwrite(path, img, params or []):
+                    raise IOError(f'Cannot write image {path}')
+                error = None
+            except Exception as e:
+                error = e
+            with self._condition:
+                self.bytes_queued -= img.nbytes
+                if error is not None:
+                    if self._error is None:
+                        self._error = error
+                    for item in self._pending:
+                        self.bytes_queued -= item[2].nbytes
+                    self._pending.clear()
+                self._written[index] = path
+                self._notify_written()
+                self._condition.notify_all()
+
+    def _notify_written(self):
+        # Runs under the lock, so that the callback sees the paths in order
+        while self._next_done in self._written:
+            path = self._written.pop(self._next_done)
+            self._next_done += 1
+            if self.callback is not None and self._error is None:
+                self.callback(path)
+
+    def close(self):
+        """Wait for the queued images and stop the threads."""
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # Do not hide the caller's exception behind a write error
+        try:
+            self.close()
+        except Exception as error:
+            if error is not exc_value:
+                logger.exception('Image writer failed while handling another error')
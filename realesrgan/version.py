@@ -0,0 +1,4 @@
+# GENERATED VERSION FILE
+__version__ = '0.3.0'
+__gitsha__ = 'unknown'
+version_info = (0, 3, 0)
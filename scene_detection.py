@@ -0,0 +1,150 @@
+import bisect
+from typing import Callable, Iterable, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+# Frames are analysed as downscaled luma: enough to tell shots apart, and
+# cheap to decode and compare
+ANALYSIS_WIDTH = 128
+ANALYSIS_HEIGHT = 72
+HISTOGRAM_BINS = 32
+
+
+class ShotIndex(NamedTuple):
+    """Shots of a video, as the first frame of every shot after the first."""
+
+    cuts: Tuple[int, ...]
+    frame_count: int
+
+    def shots(self) -> List[Tuple[int, int]]:
+        # (first frame, end frame) of every shot
+        return list(zip((0, *self.cuts), (*self.cuts, self.frame_count)))
+
+    def cut_times(self, fps: float) -> List[float]:
+        return [cut / fps for cut in self.cuts]
+
+
+def luma_histograms(frames: np.ndarray, bins: int = HISTOGRAM_BINS) -> np.ndarray:
+    # Normalized histograms of a (n, height, width) uint8 array, one bincount
+    # for all the frames
+    count = len(frames)
+    values = frames.reshape(count, -1) // (256 // bins)
+    values = values + (np.arange(count, dtype=np.intp) * bins)[:, None]
+    histograms = np.bincount(values.ravel(), minlength=count * bins)
+    return histograms.reshape(count, bins) / values.shape[1]
+
+
+class SceneCutDetector:
+    """Find the shot cuts in a stream of downscaled luma frames.
+
+    A frame starts a new shot when the mean absolute difference of its pixels
+    from the previous frame reaches ``sad_threshold`` (in 8-bit levels), and
+    either the distance between their luma histograms (half the sum of the
+    absolute bin differences, from 0 to 1) reaches ``histogram_threshold`` or
+    the difference is ``spike_ratio`` times its average over the previous
+    ``history_frames``. Histograms change little with motion, and motion
+    raises the difference over many frames rather than one, so that only a
+    change of picture fires. A cut closer than ``min_shot_frames`` to the
+    previous one is dropped, so that flashes do not split shots.
+    """
+
+    def __init__(
+        self,
+        sad_threshold: float = 6.0,
+        histogram_threshold: float = 0.3,
+        spike_ratio: float = 4.0,
+        history_frames: int = 24,
+        min_shot_frames: int = 12,
+    ):
+        self.sad_threshold = sad_threshold
+        self.histogram_threshold = histogram_threshold
+        self.spike_ratio = spike_ratio
+        self.history_frames = history_frames
+        self.min_shot_frames = min_shot_frames
+        self.cuts = []
+        self.frame_count = 0
+        self.previous = None
+        self.previous_histogram = None
+        # Differences of the last history_frames frames
+        self.history = np.zeros(0)
+
+    def feed(self, frames: np.ndarray):
+        # A (n, height, width) uint8 array of the next frames
+        if len(frames) == 0:
+            return
+        histograms = luma_histograms(frames)
+        if self.previous is None:
+            # The first frame of the video starts the first shot, compare it
+            # with itself
+            self.previous, self.previous_histogram = frames[0], histograms[0]
+        previous = np.concatenate([self.previous[None], frames[:-1]])
+        previous_histograms = np.concatenate(
+            [self.previous_histogram[None], histograms[:-1]]
+        )
+        histogram_distance = np.abs(histograms - previous_histograms).sum(axis=1) / 2
+        difference = frames.astype(np.int16) - previous.astype(np.int16)
+        sad = np.abs(difference).mean(axis=(1, 2))
+
+        # Average difference over the history_frames before each frame
+        history = np.concatenate([self.history, sad])
+        sums = np.concatenate([[0.0], np.cumsum(history)])
+        ends = np.arange(len(self.history), len(history))
+        starts = np.maximum(ends - self.history_frames, 0)
+        averages = (sums[ends] - sums[starts]) / np.maximum(ends - starts, 1)
+        self.history = history[-self.history_frames :]
+
+        changed = (histogram_distance >= self.histogram_threshold) | (
+            (ends > starts) & (sad >= self.spike_ratio * averages)
+        )
+        candidates = np.flatnonzero(changed & (sad >= self.sad_threshold))
+        last_cut = self.cuts[-1] if self.cuts else 0
+        for index in candidates + self.frame_count:
+            if index - last_cut >= self.min_shot_frames:
+                self.cuts.append(int(index))
+                last_cut = index
+        self.frame_count += len(frames)
+        self.previous = frames[-1].copy()
+        self.previous_histogram = histograms[-1]
+
+    def finish(self) -> ShotIndex:
+        return ShotIndex(tuple(self.cuts), self.frame_count)
+
+
+class ShotSplitter:
+    """Start every shot of a video with fresh caches.
+
+    Wraps a batch upscale function and splits its batches at the shot cuts.
+    Before the first frame of every shot, ``start_shot`` is called on each of
+    ``stages`` (a FrameDeduplicator, a DirtyTileUpscaler) so that they stop
+    matching frames against the previous shot. ``first_frame`` is the index
+    in the video of the first frame it gets.
+    """
+
+    def __init__(
+        self,
+        upscale: Callable[[List[np.ndarray]], List[np.ndarray]],
+        cuts: Sequence[int],
+        first_frame: int = 0,
+        stages: Iterable = (),
+    ):
+        self.upscale = upscale
+        self.cuts = sorted(cuts)
+        self.frame_index = first_frame
+        self.stages = [stage for stage in stages if stage is not None]
+
+    def __call__(self, frames: List[np.ndarray]) -> List[np.ndarray]:
+        outputs = []
+        start = 0
+        while start < len(frames):
+            index = self.frame_index + start
+            position = bisect.bisect_right(self.cuts, index)
+            if position and self.cuts[position - 1] == index:
+                for stage in self.stages:
+                    stage.start_shot()
+            end = len(frames)
+            if position < len(self.cuts):
+                end = min(end, self.cuts[position] - self.frame_index)
+            outputs.extend(self.upscale(frames[start:end]))
+            start = end
+        self.frame_index += len(frames)
+        return outputs
@@ -0,0 +1,359 @@
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from typing import Dict, List, Optional
+
+from encoding import EncoderProfile, split_threads
+from events import Signal
+from ffmpeg_integration import FFmpegHandler, VideoInfo
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# A job at this many pixels per frame gets the largest share of the CPU
+# budget, smaller ones a proportional share
+FULL_BUDGET_PIXELS = 3840 * 2160
+# Largest share of the budget a job gets, the rest is left to smaller ones
+MAX_JOB_SHARE = 0.75
+
+# Model, interpreter and FFmpeg processes of a job, on top of its frames
+BASE_JOB_MEMORY = 768 * 1024**2
+
+
+class Job:
+    """One video in the scheduler queue."""
+
+    def __init__(
+        self,
+        job_id: int,
+        video_file: str,
+        info: VideoInfo,
+        priority: int = 0,
+        max_retries: int = 1,
+    ):
+        self.job_id = job_id
+        self.video_file = video_file
+        self.info = info
+        self.priority = priority
+        self.max_retries = max_retries
+        self.state = QUEUED
+        self.attempts = 0
+        self.progress = 0.0
+        self.output = None
+        self.error = None
+        # Filled in by JobScheduler.estimate
+        self.cost = 0
+        self.threads = 1
+        self.memory = 0
+
+    def __repr__(self):
+        return f"Job({self.job_id}, {self.video_file!r}, {self.state})"
+
+
+def system_memory() -> Optional[int]:
+    # Physical memory in bytes, None where sysconf does not report it
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _terminate(process: multiprocessing.Process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (AttributeError, ProcessLookupError, PermissionError):
+        # No process group yet, or not on POSIX
+        process.terminate()
+
+
+def _run_job(
+    job_id: int,
+    video_file: str,
+    destination_folder: str,
+    esrgan_settings: dict,
+    encoder_profile: EncoderProfile,
+    processor_options: dict,
+    events,
+):
+    # Runs in a worker process: one VideoProcessor for one video, its events
+    # are forwarded to the scheduler
+    from esrgan_integration import ESRGANHandler
+    from utils import setup_logging
+    from video_processor import VideoProcessor
+
+    if hasattr(os, "setpgrp"):
+        # Cancelling the job then also stops its FFmpeg and pool processes
+        os.setpgrp()
+    setup_logging()
+    processor = VideoProcessor(
+        destination_folder,
+        [video_file],
+        esrgan_handler=ESRGANHandler(**esrgan_settings),
+        encoder_profile=encoder_profile,
+        **processor_options,
+    )
+    processor.progress_detail.connect(
+        lambda video, report: events.put(("progress", job_id, report.fraction))
+    )
+    try:
+        processor.run()
+    except Exception as error:
+        events.put(("failed", job_id, f"{type(error).__name__}: {error}"))
+        return
+    events.put(("done", job_id, processor.get_output_path(video_file)))
+
+
+class JobScheduler:
+    """Runs a queue of videos on worker processes within a CPU and memory budget.
+
+    Every job gets a share of the cores from its frame size, so that several
+    small clips run side by side while a 4K one holds most of the cores, and
+    an estimate of its memory. Jobs start in order of priority, the most
+    costly (pixels times frames) first among equal priorities, as long as
+    their threads and memory fit in what the running jobs leave. A job that
+    fits in no budget runs alone. Failed jobs are retried up to ``max_retries``
+    times, queued and running jobs can be cancelled.
+    """
+
+    def __init__(
+        self,
+        destination_folder: str,
+        esrgan_settings: Optional[dict] = None,
+        encoder_profile: Optional[EncoderProfile] = None,
+        cpu_budget: Optional[int] = None,
+        memory_budget: Optional[int] = None,
+        probe_cache_folder: Optional[str] = None,
+        **processor_options,
+    ):
+        # Events with the Job: queued, started, progress (with the fraction
+        # of the job done), finished, failed (with the error) and cancelled
+        self.job_queued = Signal()
+        self.job_started = Signal()
+        self.job_progress = Signal()
+        self.job_finished = Signal()
+        self.job_failed = Signal()
+        self.job_cancelled = Signal()
+
+        self.destination_folder = destination_folder
+        os.makedirs(destination_folder, exist_ok=True)
+        self.esrgan_settings = dict(esrgan_settings or {})
+        self.encoder_profile = encoder_profile or EncoderProfile()
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        memory = system_memory()
+        self.memory_budget = memory_budget or (int(memory * 0.8) if memory else None)
+        self.processor_options = dict(
+            processor_options, probe_cache_folder=probe_cache_folder
+        )
+        self.ffmpeg_handler = FFmpegHandler(probe_cache_folder)
+
+        self.jobs: List[Job] = []
+        self._job_ids = itertools.count()
+        self._running: Dict[int, multiprocessing.Process] = {}
+        self._lock = threading.RLock()
+        self._context = multiprocessing.get_context("spawn")
+        self._events = self._context.Queue()
+
+    def submit(self, video_file: str, priority: int = 0, max_retries: int = 1) -> Job:
+        # Higher priorities start first
+        job = Job(
+            next(self._job_ids),
+            video_file,
+            self.ffmpeg_handler.probe(video_file),
+            priority,
+            max_retries,
+        )
+        self.estimate(job)
+        with self._lock:
+            self.jobs.append(job)
+        logging.info(
+            f"Queued {video_file}: {job.threads} threads, "
+            f"{job.memory / 1024**2:.0f} MiB"
+        )
+        self.job_queued.emit(job)
+        return job
+
+    def estimate(self, job: Job):
+        info = job.info
+        scale = self.esrgan_settings.get("scale", 2)
+        workers = self.processor_options.get("workers", 1)
+        pixels = info.width * info.height
+        job.cost = pixels * info.frame_count
+        share = MAX_JOB_SHARE * min(1.0, pixels / FULL_BUDGET_PIXELS)
+        job.threads = min(
+            self.cpu_budget, max(workers, math.ceil(self.cpu_budget * share))
+        )
+        # Per pipeline: the queued input and output frames, two float feature
+        # maps of the network and the model
+        frame_bytes = pixels * 3
+        queued = 8 * frame_bytes * (1 + scale**2)
+        features = 2 * 64 * pixels * 4
+        job.memory = workers * (BASE_JOB_MEMORY + queued + features)
+
+    def cancel(self, job: Job):
+        with self._lock:
+            if job.state == QUEUED:
+                job.state = CANCELLED
+            elif job.state == RUNNING:
+                job.state = CANCELLED
+                process = self._running.get(job.job_id)
+                if process is not None:
+                    _terminate(process)
+            else:
+                return
+        logging.info(f"Cancelled {job.video_file}")
+        self.job_cancelled.emit(job)
+
+    def run(self):
+        # Blocks until every job is done, failed or cancelled
+        try:
+            while True:
+                with self._lock:
+                    self._start_jobs()
+                    if not self._running and not self._queued():
+                        break
+                self._handle_event()
+                self._reap_processes()
+        finally:
+            self.shutdown()
+
+    def shutdown(self, timeout: float = 10.0):
+        # Stops the jobs still running, e.g. when run is interrupted. Job
+        # processes are not daemonic, so they are not killed on exit
+        with self._lock:
+            processes = list(self._running.items())
+            self._running.clear()
+        for job_id, process in processes:
+            if process.is_alive():
+                _terminate(process)
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            job = next(job for job in self.jobs if job.job_id == job_id)
+            if job.state == RUNNING:
+                job.state = CANCELLED
+                self.job_cancelled.emit(job)
+
+    def _queued(self) -> List[Job]:
+        jobs = [job for job in self.jobs if job.state == QUEUED]
+        return sorted(jobs, key=lambda job: (-job.priority, -job.cost, job.job_id))
+
+    def _start_jobs(self):
+        running = [job for job in self.jobs if job.job_id in self._running]
+        free_threads = self.cpu_budget - sum(job.threads for job in running)
+        free_memory = None
+        if self.memory_budget is not None:
+            free_memory = self.memory_budget - sum(job.memory for job in running)
+        for job in self._queued():
+            fits = job.threads <= free_threads and (
+                free_memory is None or job.memory <= free_memory
+            )
+            if not fits and running:
+                # Later jobs wait too, so that the first one is not starved
+                # by smaller ones that keep fitting
+                break
+            self._start(job)
+            running.append(job)
+            free_threads -= job.threads
+            if free_memory is not None:
+                free_memory -= job.memory
+
+    def _start(self, job: Job):
+        workers = self.processor_options.get("workers", 1)
+        upscaler_threads, encoder_threads = split_threads(job.threads, workers)
+        esrgan_settings = dict(self.esrgan_settings)
+        if esrgan_settings.get("threads") is None:
+            esrgan_settings["threads"] = upscaler_threads
+        encoder_profile = self.encoder_profile
+        if encoder_profile.threads is None:
+            encoder_profile = encoder_profile._replace(threads=encoder_threads)
+
+        job.state = RUNNING
+        job.attempts += 1
+        job.progress = 0.0
+        process = self._context.Process(
+            target=_run_job,
+            args=(
+                job.job_id,
+                job.video_file,
+                self.destination_folder,
+                esrgan_settings,
+                encoder_profile,
+                self.processor_options,
+                self._events,
+            ),
+            # A daemonic process may not start the segment worker pool
+            daemon=False,
+        )
+        process.start()
+        self._running[job.job_id] = process
+        logging.info(
+            f"Started {job.video_file} (attempt {job.attempts}) "
+            f"with {job.threads} threads"
+        )
+        self.job_started.emit(job)
+
+    def _handle_event(self):
+        try:
+            kind, job_id, value = self._events.get(timeout=0.2)
+        except queue.Empty:
+            return
+        with self._lock:
+            job = next(job for job in self.jobs if job.job_id == job_id)
+            if job.state != RUNNING:
+                # Late event of a cancelled job
+                return
+            if kind == "progress":
+                job.progress = value
+                self.job_progress.emit(job, value)
+            elif kind == "done":
+                self._finish(job)
+                job.state = DONE
+                job.progress = 1.0
+                job.output = value
+                self.job_finished.emit(job)
+            elif kind == "failed":
+                self._finish(job)
+                self._fail(job, value)
+
+    def _reap_processes(self):
+        # Jobs whose process exited without reporting, e.g. killed by the OS
+        with self._lock:
+            for job_id, process in list(self._running.items()):
+                if process.is_alive():
+                    continue
+                job = next(job for job in self.jobs if job.job_id == job_id)
+                if job.state == RUNNING and not self._pending_events():
+                    self._finish(job)
+                    self._fail(job, f"Worker exited with code {process.exitcode}")
+                elif job.state == CANCELLED:
+                    self._finish(job)
+
+    def _pending_events(self) -> bool:
+        try:
+            return not self._events.empty()
+        except NotImplementedError:
+            return False
+
+    def _finish(self, job: Job):
+        process = self._running.pop(job.job_id, None)
+        if process is not None:
+            process.join()
+
+    def _fail(self, job: Job, error: str):
+        if job.attempts <= job.max_retries:
+            logging.warning(f"{job.video_file} failed, retrying: {error}")
+            job.state = QUEUED
+            return
+        logging.error(f"{job.video_file} failed: {error}")
+        job.state = FAILED
+        job.error = error
+        self.job_failed.emit(job, error)
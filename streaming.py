@@ -0,0 +1,275 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from ffmpeg_integration import FFmpegHandler, check_process
+from metrics import REGISTRY
+
+# Marks the end of the frame stream between stages
+_END_OF_STREAM = object()
+
+FRAMES_DECODED = REGISTRY.counter("frames_decoded_total", "Frames read from FFmpeg")
+FRAMES_UPSCALED = REGISTRY.counter("frames_upscaled_total", "Frames upscaled")
+FRAMES_ENCODED = REGISTRY.counter("frames_encoded_total", "Frames sent to FFmpeg")
+BYTES_DECODED = REGISTRY.counter(
+    "decoded_bytes_total", "Raw frame bytes read from the decoder"
+)
+BYTES_ENCODED = REGISTRY.counter(
+    "encoded_bytes_total", "Raw frame bytes written to the encoder"
+)
+DECODED_QUEUE_DEPTH = REGISTRY.gauge(
+    "decoded_queue_depth", "Decoded frames waiting for the upscaler"
+)
+UPSCALED_QUEUE_DEPTH = REGISTRY.gauge(
+    "upscaled_queue_depth", "Upscaled frames waiting for the encoder"
+)
+INFERENCE_SECONDS = REGISTRY.histogram(
+    "inference_seconds_per_frame", "Upscaling time per frame, batches are averaged"
+)
+
+
+class StreamingPipeline:
+    """Decode, upscale and encode a video without writing intermediate frames.
+
+    FFmpeg decodes to raw frames on a pipe, the frames are upscaled in process
+    and written to a second FFmpeg process encoding from its stdin. The stages
+    are connected with bounded queues so memory use does not grow with the
+    length of the video. Up to ``batch_size`` decoded frames are handed to
+    ``upscale`` at once.
+    """
+
+    def __init__(
+        self,
+        ffmpeg_handler: FFmpegHandler,
+        upscale: Callable[[List[np.ndarray]], List[np.ndarray]],
+        queue_size: int = 8,
+        batch_size: int = 1,
+    ):
+        self.ffmpeg_handler = ffmpeg_handler
+        self.upscale = upscale
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+
+    def run(
+        self,
+        video_file: str,
+        output_video: str,
+        progress_callback: Optional[Callable[[str, int], None]] = None,
+        start: Optional[float] = None,
+        frames: Optional[int] = None,
+        copy_streams: bool = True,
+    ) -> int:
+        # With copy_streams, the audio, subtitles, chapters and metadata of
+        # video_file are copied into output_video by the encoder
+        width, height = self.ffmpeg_handler.get_frame_size(video_file)
+        frame_rate = self.ffmpeg_handler.get_frame_rate(video_file)
+
+        self._stop = threading.Event()
+        self._progress_callback = progress_callback
+        self._errors = []
+        self._processes = []
+        self._processes_lock = threading.Lock()
+        decoded = queue.Queue(self.queue_size)
+        upscaled = queue.Queue(self.queue_size)
+
+        reader = threading.Thread(
+            target=self._guard,
+            args=(
+                self._read_frames,
+                video_file,
+                width,
+                height,
+                decoded,
+                start,
+                frames,
+            ),
+            daemon=True,
+        )
+        writer = threading.Thread(
+            target=self._guard,
+            args=(
+                self._write_frames,
+                video_file,
+                output_video,
+                frame_rate,
+                upscaled,
+                copy_streams,
+            ),
+            daemon=True,
+        )
+        reader.start()
+        writer.start()
+
+        frame_count = 0
+        try:
+            end_of_stream = False
+            while not end_of_stream:
+                batch, end_of_stream = self._get_batch(decoded)
+                DECODED_QUEUE_DEPTH.set(decoded.qsize())
+                if not batch:
+                    continue
+                started = time.perf_counter()
+                upscaled_frames = self.upscale(batch)
+                per_frame = (time.perf_counter() - started) / len(batch)
+                for _ in batch:
+                    INFERENCE_SECONDS.observe(per_frame)
+                FRAMES_UPSCALED.inc(len(batch))
+                for frame in upscaled_frames:
+                    self._put(upscaled, frame)
+                UPSCALED_QUEUE_DEPTH.set(upscaled.qsize())
+                frame_count += len(batch)
+                self._report("upscale", frame_count)
+            self._put(upscaled, _END_OF_STREAM)
+        except BaseException as error:
+            self._abort(error)
+
+        reader.join()
+        writer.join()
+        DECODED_QUEUE_DEPTH.set(0)
+        UPSCALED_QUEUE_DEPTH.set(0)
+        if self._errors:
+            raise self._errors[0]
+        logging.info(f"Streamed {frame_count} frames from {video_file}")
+        return frame_count
+
+    def _read_frames(
+        self,
+        video_file: str,
+        width: int,
+        height: int,
+        decoded,
+        start: Optional[float],
+        frames: Optional[int],
+    ):
+        decoder = self.ffmpeg_handler.open_decoder(
+            video_file, start=start, frames=frames
+        )
+        self._register(decoder)
+        frame_bytes = width * height * 3
+        frame_count = 0
+        while True:
+            buffer = decoder.stdout.read(frame_bytes)
+            if len(buffer) < frame_bytes:
+                break
+            frame = np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+            self._put(decoded, frame)
+            FRAMES_DECODED.inc()
+            BYTES_DECODED.inc(frame_bytes)
+            DECODED_QUEUE_DEPTH.set(decoded.qsize())
+            frame_count += 1
+            self._report("decode", frame_count)
+        decoder.stdout.close()
+        check_process(decoder)
+        self._put(decoded, _END_OF_STREAM)
+
+    def _write_frames(
+        self,
+        video_file: str,
+        output_video: str,
+        frame_rate: str,
+        upscaled,
+        copy_streams: bool,
+    ):
+        encoder = None
+        frame_count = 0
+        while True:
+            frame = self._get(upscaled)
+            if frame is _END_OF_STREAM:
+                break
+            if encoder is None:
+                # The output size is only known once the first frame is upscaled
+                height, width = frame.shape[:2]
+                encoder = self.ffmpeg_handler.open_encoder(
+                    output_video,
+                    width,
+                    height,
+                    frame_rate,
+                    source_video=video_file,
+                    copy_streams=copy_streams,
+                )
+                self._register(encoder)
+            data = np.ascontiguousarray(frame).data
+            try:
+                encoder.stdin.write(data)
+            except BrokenPipeError:
+                # The encoder quit, its error output says why
+                check_process(encoder)
+                raise
+            FRAMES_ENCODED.inc()
+            BYTES_ENCODED.inc(data.nbytes)
+            UPSCALED_QUEUE_DEPTH.set(upscaled.qsize())
+            frame_count += 1
+            self._report("encode", frame_count)
+        if encoder is not None:
+            encoder.stdin.close()
+            check_process(encoder)
+
+    def _report(self, stage: str, frame_count: int):
+        if self._progress_callback:
+            self._progress_callback(stage, frame_count)
+
+    def _guard(self, stage, *args):
+        try:
+            stage(*args)
+        except BaseException as error:
+            self._abort(error)
+
+    def _register(self, process):
+        # Tracked before the first read or write, so that an abort kills it.
+        # A process started after an abort went over the list is killed here.
+        with self._processes_lock:
+            self._processes.append(process)
+            stopped = self._stop.is_set()
+        if stopped:
+            process.kill()
+            process.wait()
+            raise _PipelineStopped()
+
+    def _abort(self, error: BaseException):
+        with self._processes_lock:
+            if not self._stop.is_set():
+                self._errors.append(error)
+                self._stop.set()
+            processes = list(self._processes)
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+
+    def _put(self, stage_queue, item):
+        while not self._stop.is_set():
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise _PipelineStopped()
+
+    def _get(self, stage_queue):
+        while not self._stop.is_set():
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        raise _PipelineStopped()
+
+    def _get_batch(self, stage_queue):
+        # Block for the first frame, then take whatever is already decoded
+        frames = []
+        item = self._get(stage_queue)
+        while item is not _END_OF_STREAM:
+            frames.append(item)
+            if len(frames) == self.batch_size:
+                return frames, False
+            try:
+                item = stage_queue.get_nowait()
+            except queue.Empty:
+                return frames, False
+        return frames, True
+
+
+class _PipelineStopped(Exception):
+    pass
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The application modules live at the top of the repository, next to the
+# realesrgan package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
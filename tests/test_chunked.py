@@ -0,0 +1,107 @@
+import queue
+
+import chunked
+from chunked import (
+    ChunkedProcessor,
+    Segment,
+    _QueueProgress,
+    _SegmentProgress,
+    cut_keyframes,
+    plan_segments,
+)
+from ffmpeg_integration import FFmpegHandler
+
+
+def test_segments_start_at_the_closest_keyframes():
+    keyframes = [0.0, 2.0, 4.0, 6.0, 8.0, 10.0]
+    segments = plan_segments(keyframes, 12.0, 3)
+    assert segments == [
+        Segment(0, 0.0, 4.0),
+        Segment(1, 4.0, 8.0),
+        Segment(2, 8.0, None),
+    ]
+
+
+def test_segments_are_contiguous_and_cover_the_video():
+    keyframes = [i * 1.3 for i in range(50)]
+    segments = plan_segments(keyframes, 65.0, 7)
+    assert segments[0].start == 0.0
+    assert segments[-1].end is None
+    for segment, following in zip(segments, segments[1:]):
+        assert segment.end == following.start
+        assert following.start in keyframes
+    assert [segment.index for segment in segments] == list(range(len(segments)))
+
+
+def test_sparse_keyframes_give_fewer_segments():
+    # Two targets share the keyframe at 5 s, no empty segment is planned
+    segments = plan_segments([0.0, 5.0], 12.0, 4)
+    assert segments == [Segment(0, 0.0, 5.0), Segment(1, 5.0, None)]
+
+
+def test_without_keyframes_the_video_is_one_segment():
+    assert plan_segments([], 12.0, 4) == [Segment(0, 0.0, None)]
+
+
+def test_preferred_keyframes_win_within_the_slack():
+    keyframes = [0.0, 2.0, 4.0, 5.0, 6.0, 8.0]
+    # The target is 6 s, the slack a quarter of a segment: 1.5 s
+    segments = plan_segments(keyframes, 12.0, 2, preferred_times=[5.0])
+    assert segments[1].start == 5.0
+    segments = plan_segments(keyframes, 12.0, 2, preferred_times=[2.0])
+    assert segments[1].start == 6.0
+
+
+def test_cut_keyframes_within_tolerance():
+    keyframes = [0.0, 2.0, 4.02, 6.0]
+    cuts = [1.0, 2.01, 4.0, 7.0]
+    assert cut_keyframes(keyframes, cuts, 0.05) == [2.0, 4.02]
+
+
+def test_segment_progress_sums_the_segments():
+    reports = []
+    progress = _SegmentProgress(lambda stage, frames: reports.append((stage, frames)))
+    progress.finish(0, 100)
+    progress.update(1, "decode", 30)
+    progress.update(2, "decode", 20)
+    progress.update(1, "upscale", 10)
+    assert reports[-3:] == [("decode", 130), ("decode", 150), ("upscale", 110)]
+    progress.finish(1, 50)
+    # A late count of a finished segment does not move the progress back
+    progress.update(1, "upscale", 40)
+    assert progress.total("upscale") == 150
+    assert progress.total("decode") == 170
+
+
+def test_queue_progress_throttles_and_flushes(monkeypatch):
+    messages = queue.Queue()
+    progress = _QueueProgress(messages, 3)
+    for frames in range(1, 11):
+        progress("upscale", frames)
+    progress.flush()
+    sent = []
+    while not messages.empty():
+        sent.append(messages.get())
+    assert sent[0] == (3, "upscale", 1)
+    assert sent[-1] == (3, "upscale", 10)
+    assert len(sent) < 10
+
+
+def test_single_worker_reports_every_frame(monkeypatch, tmp_path):
+    def upscale_segment(video_file, segment, segment_video, *arguments, **options):
+        for frames in range(1, 4):
+            for stage in ("decode", "upscale", "encode"):
+                options["progress_callback"](stage, frames)
+        return 3
+
+    monkeypatch.setattr(chunked, "_upscale_segment", upscale_segment)
+    processor = ChunkedProcessor(FFmpegHandler(), {}, workers=1)
+    reports = []
+    progress = _SegmentProgress(lambda stage, frames: reports.append((stage, frames)))
+    pending = [(Segment(0, 0.0, 1.0), "a.mp4"), (Segment(1, 1.0, None), "b.mp4")]
+    for segment, _, frames in processor.upscale_segments(
+        "video.mp4", pending, progress.update
+    ):
+        progress.finish(segment.index, frames)
+    upscale_reports = [frames for stage, frames in reports if stage == "upscale"]
+    assert upscale_reports == [1, 2, 3, 3, 4, 5, 6, 6]
@@ -0,0 +1,24 @@
+import pytest
+
+from cli import parse_args
+
+
+def test_quantized_needs_a_model_path(capsys):
+    with pytest.raises(SystemExit) as error:
+        parse_args(["video.mp4", "-o", "out", "--quantized"])
+    assert error.value.code == 2
+    assert "--quantized needs --model-path" in capsys.readouterr().err
+
+
+def test_quantized_with_a_model_path():
+    args = parse_args(
+        ["video.mp4", "-o", "out", "--quantized", "--model-path", "model.int8.pt"]
+    )
+    assert args.quantized
+    assert args.model_path == "model.int8.pt"
+
+
+def test_float_model_without_a_path():
+    args = parse_args(["video.mp4", "-o", "out"])
+    assert not args.quantized
+    assert args.model_path is None
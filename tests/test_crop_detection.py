@@ -0,0 +1,42 @@
+import numpy as np
+
+from crop_detection import CropBox, CroppedUpscaler, parse_cropdetect, union
+
+CROPDETECT_OUTPUT = """\
+[Parsed_cropdetect_0 @ 0x1] x1:0 x2:-1 y1:0 y2:-1 w:-16 h:-16 x:8 y:8 pts:0 t:0.000000 crop=-16:-16:8:8
+[Parsed_cropdetect_0 @ 0x1] x1:0 x2:1919 y1:138 y2:941 w:1920 h:800 x:0 y:140 pts:1 t:0.041708 crop=1920:800:0:140
+[Parsed_cropdetect_0 @ 0x1] x1:0 x2:1919 y1:132 y2:947 w:1920 h:816 x:0 y:132 pts:2 t:0.083417 crop=1920:816:0:132
+"""
+
+
+def test_parse_cropdetect_takes_the_last_box():
+    assert parse_cropdetect(CROPDETECT_OUTPUT) == CropBox(0, 132, 1920, 816)
+
+
+def test_parse_cropdetect_skips_black_frames():
+    lines = CROPDETECT_OUTPUT.splitlines()
+    assert parse_cropdetect(lines[0]) is None
+    assert parse_cropdetect("") is None
+
+
+def test_union_keeps_every_box():
+    box = union([CropBox(0, 140, 1920, 800), CropBox(10, 100, 1800, 820)])
+    assert box == CropBox(0, 100, 1920, 840)
+    assert box.area == 1920 * 840
+    assert box.describe() == "1920x840+0+100"
+
+
+def test_cropped_upscaler_puts_the_output_back_in_place():
+    frame = np.zeros((8, 10, 3), np.uint8)
+    frame[2:6, 1:9] = 200
+    seen = []
+
+    def upscale(frames):
+        seen.extend(frame.shape for frame in frames)
+        return [frame.repeat(2, axis=0).repeat(2, axis=1) for frame in frames]
+
+    upscaler = CroppedUpscaler(upscale, CropBox(1, 2, 8, 4), 2)
+    (output,) = upscaler([frame])
+    assert seen == [(4, 8, 3)]
+    expected = frame.repeat(2, axis=0).repeat(2, axis=1)
+    assert np.array_equal(output, expected)
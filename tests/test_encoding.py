@@ -0,0 +1,115 @@
+import pytest
+
+from encoding import PROFILES, EncoderProfile, split_threads
+
+
+@pytest.mark.parametrize(
+    "profile, expected",
+    [
+        (
+            EncoderProfile("x264"),
+            ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-preset", "medium"]
+            + ["-crf", "18"],
+        ),
+        (
+            EncoderProfile("x264", preset="veryfast", crf=20, tune="film", threads=3),
+            ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-preset", "veryfast"]
+            + ["-crf", "20", "-tune", "film", "-threads", "3"],
+        ),
+        (
+            EncoderProfile("x264", crf=0, ten_bit=True),
+            ["-c:v", "libx264", "-pix_fmt", "yuv420p10le", "-preset", "medium"]
+            + ["-crf", "0"],
+        ),
+        (
+            EncoderProfile("x265"),
+            ["-c:v", "libx265", "-pix_fmt", "yuv420p", "-preset", "medium"]
+            + ["-crf", "20", "-tag:v", "hvc1"],
+        ),
+        (
+            EncoderProfile("x265", crf=22, threads=4, ten_bit=True),
+            ["-c:v", "libx265", "-pix_fmt", "yuv420p10le", "-preset", "medium"]
+            + ["-crf", "22", "-tag:v", "hvc1", "-x265-params", "pools=4"],
+        ),
+        (
+            EncoderProfile("svt-av1"),
+            ["-c:v", "libsvtav1", "-pix_fmt", "yuv420p", "-preset", "8"]
+            + ["-crf", "30"],
+        ),
+        (
+            EncoderProfile("svt-av1", preset="6", tune="0", threads=2, ten_bit=True),
+            ["-c:v", "libsvtav1", "-pix_fmt", "yuv420p10le", "-preset", "6"]
+            + ["-crf", "30", "-svtav1-params", "tune=0:lp=2"],
+        ),
+        (
+            EncoderProfile("aom-av1", threads=2),
+            ["-c:v", "libaom-av1", "-pix_fmt", "yuv420p", "-cpu-used", "6"]
+            + ["-crf", "30", "-b:v", "0", "-row-mt", "1", "-threads", "2"],
+        ),
+        (
+            EncoderProfile("ffv1"),
+            ["-c:v", "ffv1", "-pix_fmt", "bgr0", "-level", "3", "-slices", "16"]
+            + ["-slicecrc", "1"],
+        ),
+    ],
+)
+def test_encoder_arguments(profile, expected):
+    assert profile.arguments() == expected
+
+
+def test_named_profiles():
+    assert PROFILES["small"].arguments()[:4] == [
+        "-c:v",
+        "libx265",
+        "-pix_fmt",
+        "yuv420p10le",
+    ]
+    assert PROFILES["av1"].arguments()[1] == "libsvtav1"
+    assert PROFILES["lossless"].rgb
+    assert not PROFILES["balanced"].rgb
+
+
+@pytest.mark.parametrize(
+    "codec, path, expected",
+    [
+        ("x264", "out/video.mp4", "out/video.mp4"),
+        ("x264", "out/video.MKV", "out/video.MKV"),
+        ("x264", "out/video.webm", "out/video.mp4"),
+        ("x265", "out/video.avi", "out/video.mp4"),
+        ("svt-av1", "out/video.webm", "out/video.webm"),
+        ("svt-av1", "out/video.mov", "out/video.mp4"),
+        ("aom-av1", "out/video.mkv", "out/video.mkv"),
+        ("ffv1", "out/video.mp4", "out/video.mkv"),
+        ("ffv1", "out/video.avi", "out/video.avi"),
+        ("x264", "out/video", "out/video.mp4"),
+    ],
+)
+def test_output_path_switches_to_a_container_of_the_codec(codec, path, expected):
+    assert EncoderProfile(codec).output_path(path) == expected
+
+
+@pytest.mark.parametrize(
+    "cpu_count, workers, expected",
+    [
+        (1, 1, (1, 1)),
+        (1, 4, (1, 1)),
+        (2, 1, (1, 1)),
+        (2, 4, (1, 1)),
+        (8, 1, (6, 2)),
+        (8, 2, (3, 1)),
+        (16, 1, (12, 4)),
+        (16, 3, (4, 1)),
+        (16, 4, (3, 1)),
+        (32, 2, (12, 4)),
+    ],
+)
+def test_split_threads(cpu_count, workers, expected):
+    assert split_threads(cpu_count, workers) == expected
+
+
+def test_split_threads_uses_every_core_once():
+    for cpu_count in range(4, 65):
+        for workers in range(1, cpu_count // 2 + 1):
+            upscaler, encoder = split_threads(cpu_count, workers)
+            assert (upscaler + encoder) * workers <= cpu_count
+            assert upscaler >= encoder >= 1
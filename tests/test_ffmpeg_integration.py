@@ -0,0 +1,172 @@
+import subprocess
+import sys
+
+import pytest
+
+from esrgan_integration import ESRGANHandler
+from ffmpeg_integration import AudioStream, FFmpegHandler, VideoInfo, parse_probe
+
+
+def probe(**video):
+    stream = {
+        "index": 0,
+        "codec_type": "video",
+        "width": 1920,
+        "height": 1080,
+        "r_frame_rate": "24000/1001",
+        "duration": "10.010000",
+        "nb_frames": "240",
+        "pix_fmt": "yuv420p",
+    }
+    stream.update(video)
+    return {
+        "streams": [
+            stream,
+            {
+                "index": 1,
+                "codec_type": "audio",
+                "codec_name": "aac",
+                "channels": 2,
+                "sample_rate": "48000",
+                "tags": {"language": "eng"},
+            },
+            {"index": 2, "codec_type": "subtitle", "codec_name": "subrip"},
+        ],
+        "format": {"duration": "10.010000", "start_time": "0.000000"},
+    }
+
+
+def test_parse_probe():
+    info = parse_probe(probe())
+    assert (info.width, info.height) == (1920, 1080)
+    assert info.frame_rate == "24000/1001"
+    assert info.fps == pytest.approx(23.976, abs=1e-3)
+    assert info.duration == pytest.approx(10.01)
+    assert info.frame_count == 240
+    assert info.start_time == 0.0
+    assert info.audio_streams[0].language == "eng"
+    assert info.audio_streams[0].sample_rate == 48000
+    assert info.subtitle_codecs == ("subrip",)
+
+
+def test_parse_probe_keeps_the_start_time():
+    # MPEG-TS sources usually start around 1.4 s
+    info = parse_probe(probe(start_time="1.400000"))
+    assert info.start_time == pytest.approx(1.4)
+
+
+def test_parse_probe_estimates_missing_frame_counts():
+    info = parse_probe(probe(nb_frames="N/A", r_frame_rate="25/1", duration="4.0"))
+    assert info.frame_count == 100
+
+
+def test_parse_probe_falls_back_to_the_average_frame_rate():
+    info = parse_probe(probe(r_frame_rate="0/0", avg_frame_rate="30/1"))
+    assert info.frame_rate == "30/1"
+
+
+def test_parse_probe_without_video():
+    with pytest.raises(ValueError):
+        parse_probe({"streams": [{"codec_type": "audio"}]})
+
+
+def test_keyframe_times_count_from_the_start_time(monkeypatch):
+    handler = FFmpegHandler()
+    monkeypatch.setattr(
+        handler, "probe", lambda video_file: parse_probe(probe(start_time="1.4"))
+    )
+    packets = "1.400000,K__\n1.441708,___\n3.400000,K__\nN/A,K__\n2.400000,K__\n"
+    monkeypatch.setattr(
+        subprocess,
+        "run",
+        lambda command, **kwargs: subprocess.CompletedProcess(command, 0, packets, ""),
+    )
+    times = handler.get_keyframe_times("video.ts")
+    assert times == pytest.approx([0.0, 1.0, 2.0])
+
+
+def video_info(subtitle_codecs=()):
+    return VideoInfo(
+        width=1920,
+        height=1080,
+        frame_rate="24/1",
+        duration=10.0,
+        frame_count=240,
+        pix_fmt="yuv420p",
+        color_range=None,
+        color_space=None,
+        color_transfer=None,
+        color_primaries=None,
+        audio_streams=(
+            AudioStream(1, "aac", 2, 48000, "eng"),
+            AudioStream(2, "ac3", 6, 48000, "fra"),
+        ),
+        subtitle_codecs=tuple(subtitle_codecs),
+    )
+
+
+def copy_arguments(monkeypatch, output_video, subtitle_codecs):
+    handler = FFmpegHandler()
+    monkeypatch.setattr(
+        handler, "probe", lambda video_file: video_info(subtitle_codecs)
+    )
+    return handler.stream_copy_arguments("source.mkv", 1, output_video)
+
+
+def mapped(arguments):
+    pairs = zip(arguments, arguments[1:])
+    return [value for option, value in pairs if option == "-map"]
+
+
+def test_stream_copy_maps_audio_metadata_and_chapters(monkeypatch):
+    arguments = copy_arguments(monkeypatch, "out.mp4", ())
+    assert mapped(arguments) == ["0:v:0", "1:a?"]
+    for option, value in (
+        ("-c:a", "copy"),
+        ("-map_metadata", "1"),
+        ("-map_chapters", "1"),
+    ):
+        assert arguments[arguments.index(option) + 1] == value
+
+
+@pytest.mark.parametrize(
+    "output_video, kept",
+    [
+        ("out.mp4", ["1:s:1"]),
+        ("out.MOV", ["1:s:1"]),
+        ("out.webm", ["1:s:3"]),
+        ("out.mkv", ["1:s:0", "1:s:2", "1:s:3", "1:t?"]),
+        ("out.avi", []),
+        ("out.ts", ["1:s:0", "1:s:1", "1:s:2", "1:s:3"]),
+    ],
+)
+def test_stream_copy_keeps_the_subtitles_the_container_stores(
+    monkeypatch, output_video, kept
+):
+    subtitles = ("subrip", "mov_text", "ass", "webvtt")
+    arguments = copy_arguments(monkeypatch, output_video, subtitles)
+    assert mapped(arguments) == ["0:v:0", "1:a?", *kept]
+    assert arguments[arguments.index("-c:s") + 1] == "copy"
+
+
+def test_failing_command_raises_with_the_end_of_its_output():
+    command = [
+        sys.executable,
+        "-c",
+        "import sys; print('frame 1'); "
+        "print('Conversion failed', file=sys.stderr); sys.exit(1)",
+    ]
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        FFmpegHandler().run_subprocess(command)
+    assert error.value.returncode == 1
+    assert "Conversion failed" in error.value.output
+
+
+def test_successful_command_does_not_raise():
+    FFmpegHandler().run_subprocess([sys.executable, "-c", "print('done')"])
+
+
+def test_failing_executable_raises():
+    handler = ESRGANHandler()
+    with pytest.raises(subprocess.CalledProcessError):
+        handler.run_subprocess([sys.executable, "-c", "raise SystemExit(2)"])
@@ -0,0 +1,136 @@
+import numpy as np
+
+from frame_cache import FrameDeduplicator
+from scene_detection import ShotSplitter
+
+
+class CountingUpscaler:
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, frames):
+        self.batches.append(len(frames))
+        return [np.repeat(np.repeat(frame, 2, axis=0), 2, axis=1) for frame in frames]
+
+    @property
+    def frames(self):
+        return sum(self.batches)
+
+
+def picture(seed, shape=(16, 24, 3)):
+    return np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+
+
+def noisy(frame, level, seed=0):
+    # Changes every pixel by exactly `level` 8-bit levels, up or down
+    signs = np.random.default_rng(seed).choice([-1, 1], frame.shape)
+    shifted = frame.astype(np.int16) + signs * level
+    shifted[shifted > 255] -= 2 * level
+    shifted[shifted < 0] += 2 * level
+    return shifted.astype(np.uint8)
+
+
+def test_exact_repeat_reuses_the_output_without_upscaling():
+    upscale = CountingUpscaler()
+    dedup = FrameDeduplicator(upscale)
+    frame = picture(0)
+    first = dedup([frame])
+    second = dedup([frame.copy()])
+    assert second[0] is first[0]
+    assert upscale.batches == [1]
+    assert (dedup.exact_hits, dedup.near_hits, dedup.misses) == (1, 0, 1)
+
+
+def test_different_frames_are_upscaled():
+    upscale = CountingUpscaler()
+    dedup = FrameDeduplicator(upscale)
+    frames = [picture(0), picture(1)]
+    outputs = dedup(frames)
+    assert upscale.batches == [2]
+    for frame, output in zip(frames, outputs):
+        np.testing.assert_array_equal(output, upscale([frame])[0])
+    assert dedup.hits == 0
+    assert dedup.misses == 2
+
+
+def test_near_frame_under_the_threshold_reuses_the_output():
+    upscale = CountingUpscaler()
+    dedup = FrameDeduplicator(upscale, threshold=2.0)
+    frame = picture(0)
+    first = dedup([frame])
+    second = dedup([noisy(frame, 2)])
+    assert second[0] is first[0]
+    assert upscale.batches == [1]
+    assert (dedup.exact_hits, dedup.near_hits, dedup.misses) == (0, 1, 1)
+
+
+def test_near_frame_over_the_threshold_is_upscaled():
+    upscale = CountingUpscaler()
+    dedup = FrameDeduplicator(upscale, threshold=2.0)
+    frame = picture(0)
+    changed = noisy(frame, 3)
+    first = dedup([frame])
+    second = dedup([changed])
+    assert second[0] is not first[0]
+    np.testing.assert_array_equal(second[0], upscale([changed])[0])
+    assert upscale.batches[:2] == [1, 1]
+    assert (dedup.near_hits, dedup.misses) == (0, 2)
+
+
+def test_near_frames_are_not_matched_without_a_threshold():
+    upscale = CountingUpscaler()
+    dedup = FrameDeduplicator(upscale)
+    frame = picture(0)
+    dedup([frame])
+    dedup([noisy(frame, 1)])
+    assert upscale.batches == [1, 1]
+    assert dedup.near_hits == 0
+
+
+def test_duplicates_within_a_batch_are_upscaled_once():
+    upscale = CountingUpscaler()
+    dedup = FrameDeduplicator(upscale, threshold=2.0)
+    held, other = picture(0), picture(1)
+    frames = [held, held.copy(), noisy(held, 1), other, other.copy()]
+    outputs = dedup(frames)
+    assert upscale.batches == [2]
+    assert outputs[0] is outputs[1] is outputs[2]
+    assert outputs[3] is outputs[4]
+    np.testing.assert_array_equal(outputs[0], upscale([held])[0])
+    np.testing.assert_array_equal(outputs[3], upscale([other])[0])
+    assert (dedup.exact_hits, dedup.near_hits, dedup.misses) == (2, 1, 2)
+
+
+def test_cache_keeps_the_most_recent_outputs():
+    upscale = CountingUpscaler()
+    dedup = FrameDeduplicator(upscale, cache_size=2)
+    frames = [picture(seed) for seed in range(3)]
+    dedup(frames)
+    dedup([frames[2], frames[1]])
+    assert upscale.frames == 3
+    dedup([frames[0]])
+    assert upscale.frames == 4
+
+
+def test_shot_cut_resets_the_near_match():
+    upscale = CountingUpscaler()
+    dedup = FrameDeduplicator(upscale, threshold=2.0)
+    splitter = ShotSplitter(dedup, [2], stages=(dedup,))
+    frame = picture(0)
+    # Frame 2 starts a new shot: it is not matched against frame 1
+    outputs = splitter([frame, noisy(frame, 1, seed=1), noisy(frame, 1, seed=2)])
+    assert upscale.batches == [1, 1]
+    assert outputs[1] is outputs[0]
+    assert outputs[2] is not outputs[0]
+    assert (dedup.near_hits, dedup.misses) == (1, 2)
+
+
+def test_exact_repeats_are_found_across_a_shot_cut():
+    upscale = CountingUpscaler()
+    dedup = FrameDeduplicator(upscale, threshold=2.0)
+    splitter = ShotSplitter(dedup, [1, 2], stages=(dedup,))
+    first, second = picture(0), picture(1)
+    outputs = splitter([first, second, first.copy()])
+    assert upscale.batches == [1, 1]
+    assert outputs[2] is outputs[0]
+    assert dedup.exact_hits == 1
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pytest
+
+from frame_store import (
+    FRAME_FORMATS,
+    FrameStore,
+    ImageFrameStore,
+    Lz4FrameStore,
+    RawFrameStore,
+    create_frame_store,
+)
+
+WIDTH, HEIGHT = 10, 6
+
+
+def make_frames(count):
+    # Flat frames survive the JPEG round trip within a level or two
+    return [
+        np.full((HEIGHT, WIDTH, 3), 10 * index + 5, np.uint8) for index in range(count)
+    ]
+
+
+def create(frame_format, folder):
+    if frame_format == "lz4":
+        pytest.importorskip("lz4")
+    return create_frame_store(frame_format, str(folder), WIDTH, HEIGHT)
+
+
+@pytest.mark.parametrize("frame_format", FRAME_FORMATS)
+def test_round_trip(tmp_path, frame_format):
+    store = create(frame_format, tmp_path / "frames")
+    assert len(store) == 0
+    frames = make_frames(12)
+    with store.open_writer() as writer:
+        for frame in frames[:7]:
+            writer.append(frame)
+    # A second writer appends after the frames already there
+    with store.open_writer() as writer:
+        for frame in frames[7:]:
+            writer.append(frame)
+
+    assert len(store) == 12
+    read = list(store.frames())
+    assert len(read) == 12
+    tolerance = 2 if frame_format == "jpg" else 0
+    for frame, expected in zip(read, frames):
+        assert frame.shape == (HEIGHT, WIDTH, 3)
+        assert frame.dtype == np.uint8
+        assert np.abs(frame.astype(int) - expected).max() <= tolerance
+
+
+def test_image_store_arguments(tmp_path):
+    store = create("png0", tmp_path)
+    pattern = os.path.join(str(tmp_path), "frame_%08d.png")
+    assert store.ffmpeg_output() == ["-compression_level", "0", pattern]
+    assert store.ffmpeg_input("24000/1001") == ["-r", "24000/1001", "-i", pattern]
+    # Numbered from 1 like ffmpeg, past 9999 frames too
+    assert store.path(12344).endswith("frame_00012345.png")
+
+
+def test_raw_store_arguments(tmp_path):
+    store = create("raw", tmp_path)
+    output = ["-f", "rawvideo", "-pix_fmt", "bgr24", store.path]
+    assert store.ffmpeg_output() == output
+    assert store.ffmpeg_input("25/1") == [
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "bgr24",
+        "-s",
+        f"{WIDTH}x{HEIGHT}",
+        "-r",
+        "25/1",
+        "-i",
+        store.path,
+    ]
+
+
+def test_raw_store_rejects_frames_of_another_size(tmp_path):
+    store = create("raw", tmp_path)
+    with store.open_writer() as writer:
+        with pytest.raises(ValueError):
+            writer.append(np.zeros((HEIGHT + 1, WIDTH, 3), np.uint8))
+
+
+def test_lz4_store_is_piped(tmp_path):
+    store = create("lz4", tmp_path)
+    assert store.ffmpeg_output() is None
+    assert store.ffmpeg_input("25/1") is None
+
+
+def test_create_frame_store(tmp_path):
+    assert type(create("png", tmp_path / "png")) is ImageFrameStore
+    assert type(create("raw", tmp_path / "raw")) is RawFrameStore
+    assert type(create("lz4", tmp_path / "lz4")) is Lz4FrameStore
+    with pytest.raises(ValueError):
+        create_frame_store("bmp", str(tmp_path), WIDTH, HEIGHT)
+
+
+def test_store_interface_is_abstract(tmp_path):
+    with pytest.raises(TypeError):
+        FrameStore(str(tmp_path), WIDTH, HEIGHT)
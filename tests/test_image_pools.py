@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+import pytest
+
+from realesrgan.utils import ImageReaderPool, ImageWriterPool
+
+
+def write_images(folder, count, size=(6, 8)):
+    paths = []
+    for index in range(count):
+        path = str(folder / f"image_{index}.png")
+        cv2.imwrite(path, np.full((*size, 3), index, np.uint8))
+        paths.append(path)
+    return paths
+
+
+def test_reader_yields_in_order(tmp_path):
+    paths = write_images(tmp_path, 20)
+    with ImageReaderPool(paths, num_threads=4) as reader:
+        results = list(reader)
+    assert [path for path, _ in results] == paths
+    assert [int(image[0, 0, 0]) for _, image in results] == list(range(20))
+
+
+def test_reader_bounds_the_waiting_bytes(tmp_path):
+    paths = write_images(tmp_path, 20)
+    image_bytes = 6 * 8 * 3
+    with ImageReaderPool(paths, num_threads=4, max_bytes=2 * image_bytes) as reader:
+        assert len(list(reader)) == 20
+    # The image the caller needs next may go over the limit
+    assert reader.peak_bytes <= 3 * image_bytes
+
+
+def test_reader_raises_at_the_failed_position(tmp_path):
+    paths = write_images(tmp_path, 3)
+    paths.insert(2, str(tmp_path / "missing.png"))
+    with ImageReaderPool(paths, num_threads=2) as reader:
+        next(reader)
+        next(reader)
+        with pytest.raises(IOError):
+            next(reader)
+
+
+def test_writer_calls_back_in_order(tmp_path):
+    written = []
+    paths = [str(tmp_path / f"out_{index}.png") for index in range(10)]
+    with ImageWriterPool(num_threads=3, callback=written.append) as writer:
+        for index, path in enumerate(paths):
+            writer.put(path, np.full((6, 8, 3), index, np.uint8))
+    assert written == paths
+    assert int(cv2.imread(paths[7])[0, 0, 0]) == 7
+
+
+def test_writer_raises_the_write_error(tmp_path):
+    writer = ImageWriterPool()
+    writer.put(str(tmp_path / "missing" / "out.png"), np.zeros((2, 2, 3), np.uint8))
+    with pytest.raises(IOError):
+        writer.close()
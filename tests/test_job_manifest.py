@@ -0,0 +1,48 @@
+from job_manifest import JobManifest, fingerprint_file
+
+SETTINGS = {"esrgan": {"scale": 2}, "dedup": True}
+
+
+def test_manifest_round_trip(tmp_path):
+    path = str(tmp_path / "job.manifest.jsonl")
+    segment = tmp_path / "segment_00000.mp4"
+    segment.write_bytes(b"video")
+    source = {"size": 1, "mtime": 2, "hash": "ab"}
+
+    manifest = JobManifest(path)
+    assert not manifest.matches(source, SETTINGS)
+    manifest.start(source, SETTINGS, [[0, 0.0, 4.0], [1, 4.0, None]])
+    manifest.mark_segment(0, str(segment), 96)
+    manifest.mark_segment(1, str(tmp_path / "missing.mp4"), 100)
+
+    loaded = JobManifest(path)
+    assert loaded.matches(source, SETTINGS)
+    assert not loaded.matches(source, dict(SETTINGS, dedup=False))
+    assert loaded.plan == [[0, 0.0, 4.0], [1, 4.0, None]]
+    # Only segments whose file is still there count
+    assert list(loaded.completed_segments()) == [0]
+    assert loaded.completed_segments()[0]["frames"] == 96
+    assert not loaded.done
+    loaded.mark_done("out.mp4")
+    assert JobManifest(path).done
+
+
+def test_manifest_ignores_a_truncated_line(tmp_path):
+    path = str(tmp_path / "job.manifest.jsonl")
+    manifest = JobManifest(path)
+    manifest.start({}, SETTINGS, [[0, 0.0, None]])
+    with open(path, "a") as f:
+        f.write('{"type": "segm')
+    loaded = JobManifest(path)
+    assert loaded.matches({}, SETTINGS)
+    assert loaded.segments == {}
+
+
+def test_fingerprint_changes_with_the_contents(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"a" * 1000)
+    first = fingerprint_file(str(path))
+    path.write_bytes(b"b" * 1000)
+    second = fingerprint_file(str(path))
+    assert first["size"] == second["size"]
+    assert first["hash"] != second["hash"]
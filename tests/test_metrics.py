@@ -0,0 +1,71 @@
+import urllib.request
+
+import pytest
+
+from metrics import MetricsRegistry, PrometheusEndpoint
+
+
+def test_prometheus_counter_and_gauge():
+    registry = MetricsRegistry()
+    frames = registry.counter("frames_total", "Frames upscaled")
+    frames.inc()
+    frames.inc(4)
+    registry.gauge("queue_depth").set(3)
+    assert registry.to_prometheus() == (
+        "# HELP frames_total Frames upscaled\n"
+        "# TYPE frames_total counter\n"
+        "frames_total 5\n"
+        "# TYPE queue_depth gauge\n"
+        "queue_depth 3\n"
+    )
+
+
+def test_prometheus_histogram():
+    registry = MetricsRegistry()
+    latency = registry.histogram("latency_seconds", "Batch time", (1.0, 0.25))
+    for value in (0.125, 0.25, 0.5, 2.0):
+        latency.observe(value)
+    # Cumulative buckets, a value on a bound falls in that bucket
+    assert registry.to_prometheus() == (
+        "# HELP latency_seconds Batch time\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="0.25"} 2\n'
+        'latency_seconds_bucket{le="1.0"} 3\n'
+        'latency_seconds_bucket{le="+Inf"} 4\n'
+        "latency_seconds_sum 2.875\n"
+        "latency_seconds_count 4\n"
+    )
+
+
+def test_prometheus_empty_histogram():
+    registry = MetricsRegistry()
+    registry.histogram("decode_seconds", buckets=(0.5,))
+    assert registry.to_prometheus().splitlines() == [
+        "# TYPE decode_seconds histogram",
+        'decode_seconds_bucket{le="0.5"} 0',
+        'decode_seconds_bucket{le="+Inf"} 0',
+        "decode_seconds_sum 0.0",
+        "decode_seconds_count 0",
+    ]
+
+
+def test_metric_names_keep_their_type():
+    registry = MetricsRegistry()
+    assert registry.counter("frames") is registry.counter("frames")
+    with pytest.raises(TypeError):
+        registry.gauge("frames")
+
+
+def test_endpoint_serves_the_registry():
+    registry = MetricsRegistry()
+    registry.counter("frames_total").inc(2)
+    endpoint = PrometheusEndpoint(registry, port=0)
+    endpoint.start()
+    try:
+        url = f"http://127.0.0.1:{endpoint.port}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            body = response.read().decode()
+    finally:
+        endpoint.close()
+    assert body == registry.to_prometheus()
@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+
+import pytest
+import torch
+
+from realesrgan import utils
+from realesrgan.utils import RealESRGANer, _model_key, clear_model_cache
+from test_realesrganer import tiny_model
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    clear_model_cache()
+    yield
+    clear_model_cache()
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    path = str(tmp_path / "tiny_x2.pth")
+    torch.save({"params_ema": tiny_model(2).state_dict()}, path)
+    return path
+
+
+def key(model_path, **options):
+    arguments = dict(
+        scale=2,
+        model_path=model_path,
+        dni_weight=None,
+        model=tiny_model(2),
+        half=False,
+        device="cpu",
+        inference_mode=None,
+        quantized=False,
+    )
+    arguments.update(options)
+    return _model_key(**arguments)
+
+
+def create_upsampler(model_path):
+    return RealESRGANer(
+        scale=2, model_path=model_path, model=tiny_model(2, seed=1), device="cpu"
+    )
+
+
+def test_key_is_stable(model_path):
+    assert key(model_path) == key(model_path)
+    assert key(model_path, device=torch.device("cpu")) == key(model_path)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"scale": 4},
+        {"half": True},
+        {"inference_mode": "eager"},
+        {"quantized": True},
+        {"model": tiny_model(4)},
+        {"dni_weight": [0.5, 0.5]},
+    ],
+)
+def test_key_changes_with_the_options(model_path, options):
+    assert key(model_path, **options) != key(model_path)
+
+
+def test_key_changes_when_the_weights_file_changes(model_path):
+    before = key(model_path)
+    weights = {"params_ema": tiny_model(2, seed=3).state_dict(), "extra": 1}
+    torch.save(weights, model_path)
+    os.utime(model_path, ns=(0, 0))
+    assert key(model_path) != before
+
+
+def test_ncnn_key_follows_the_bin_file(tmp_path):
+    param_path = str(tmp_path / "model.param")
+    bin_path = str(tmp_path / "model.bin")
+    for path in (param_path, bin_path):
+        with open(path, "w") as file:
+            file.write("weights")
+    before = key(param_path, model=None)
+    with open(bin_path, "w") as file:
+        file.write("other weights")
+    assert key(param_path, model=None) != before
+
+
+def count_loads(monkeypatch, load=None):
+    calls = []
+    original = RealESRGANer._load_model
+
+    def counted(self, *args):
+        calls.append(threading.current_thread().name)
+        if load is not None:
+            load(len(calls))
+        return original(self, *args)
+
+    monkeypatch.setattr(RealESRGANer, "_load_model", counted)
+    return calls
+
+
+def test_instances_share_the_cached_network(model_path, monkeypatch):
+    calls = count_loads(monkeypatch)
+    first = create_upsampler(model_path)
+    second = create_upsampler(model_path)
+    assert second.model is first.model
+    assert len(calls) == 1
+    clear_model_cache()
+    third = create_upsampler(model_path)
+    assert third.model is not first.model
+    assert len(calls) == 2
+
+
+def test_concurrent_requests_share_one_load(model_path, monkeypatch):
+    release = threading.Event()
+    calls = count_loads(monkeypatch, lambda count: release.wait(5))
+    upsamplers = []
+
+    def create():
+        upsamplers.append(create_upsampler(model_path))
+
+    threads = [threading.Thread(target=create) for _ in range(4)]
+    threads[0].start()
+    # The others ask for the network while the first thread loads it
+    deadline = time.monotonic() + 5
+    while not utils._model_loads and time.monotonic() < deadline:
+        time.sleep(0.001)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(upsamplers) == 4
+    assert all(upsampler.model is upsamplers[0].model for upsampler in upsamplers)
+    assert not utils._model_loads
+
+
+def test_failed_load_is_not_cached(model_path, monkeypatch):
+    def fail_first(count):
+        if count == 1:
+            raise RuntimeError("download failed")
+
+    calls = count_loads(monkeypatch, fail_first)
+    with pytest.raises(RuntimeError, match="download failed"):
+        create_upsampler(model_path)
+    assert not utils._model_cache
+    assert not utils._model_loads
+    upsampler = create_upsampler(model_path)
+    assert len(calls) == 2
+    assert list(utils._model_cache.values()) == [
+        (upsampler.model, upsampler.device, upsampler.half)
+    ]
+
+
+def test_waiters_get_the_error_of_a_failed_load(model_path, monkeypatch):
+    release = threading.Event()
+
+    def fail_first(count):
+        if count == 1:
+            release.wait(5)
+            raise RuntimeError("download failed")
+
+    calls = count_loads(monkeypatch, fail_first)
+    errors = []
+
+    def create():
+        try:
+            create_upsampler(model_path)
+        except RuntimeError as error:
+            errors.append(error)
+
+    loader = threading.Thread(target=create)
+    loader.start()
+    deadline = time.monotonic() + 5
+    while not utils._model_loads and time.monotonic() < deadline:
+        time.sleep(0.001)
+    waiter = threading.Thread(target=create)
+    waiter.start()
+    time.sleep(0.05)
+    release.set()
+    loader.join()
+    waiter.join()
+    assert len(calls) == 1
+    assert [str(error) for error in errors] == ["download failed"] * 2
+    assert not utils._model_cache
+    assert not utils._model_loads
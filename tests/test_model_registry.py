@@ -0,0 +1,30 @@
+import pytest
+
+from model_registry import MODELS, select_model
+
+
+def test_native_scale_wins():
+    assert select_model("realesr-animevideov3", 2).native_scale == 2
+    assert select_model("realesr-animevideov3-x2", 4).native_scale == 4
+    assert select_model("RealESRGAN_x4plus", 2).name == "RealESRGAN_x2plus"
+
+
+def test_smallest_larger_scale_is_downscaled():
+    assert select_model("realesr-animevideov3", 1).native_scale == 2
+    assert select_model("RealESRGAN_x2plus", 3).native_scale == 4
+
+
+def test_largest_scale_when_every_model_is_smaller():
+    spec = select_model("realesr-general-x4v3", 8)
+    assert spec.native_scale == 4
+
+
+def test_selection_stays_in_the_family():
+    for name in MODELS:
+        for scale in (1, 2, 3, 4, 8):
+            assert select_model(name, scale).family == MODELS[name].family
+
+
+def test_unknown_model():
+    with pytest.raises(ValueError):
+        select_model("unknown", 2)
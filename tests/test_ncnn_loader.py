@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from torch.nn import functional as F
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.ncnn_loader import (
+    INT8_TAG,
+    NCNNModelBin,
+    ResizedOutput,
+    get_ncnn_scale,
+    load_ncnn_srvgg,
+)
+
+MODELS = os.path.join(os.path.dirname(__file__), "..", "realesrgan", "models")
+
+
+def model_param(scale):
+    return os.path.join(MODELS, f"realesr-animevideov3-x{scale}.param")
+
+
+@pytest.mark.parametrize("scale", [2, 3, 4])
+def test_scale_of_the_shipped_models(scale):
+    assert get_ncnn_scale(model_param(scale)) == scale
+
+
+@pytest.mark.parametrize("scale", [2, 3, 4])
+def test_shipped_model_upscales(scale):
+    model = load_ncnn_srvgg(model_param(scale))
+    net = model.net if isinstance(model, ResizedOutput) else model
+    assert isinstance(net, SRVGGNetCompact)
+    assert model.upscale == scale
+    assert not model.training
+
+    # A smooth gradient, which the model should leave mostly unchanged
+    ramp = torch.linspace(0.2, 0.8, 20)
+    image = torch.stack([ramp[None, :].expand(16, 20)] * 3)[None]
+    with torch.no_grad():
+        output = model(image)
+    assert output.shape == (1, 3, 16 * scale, 20 * scale)
+    assert torch.isfinite(output).all()
+    expected = F.interpolate(image, scale_factor=scale, mode="bicubic")
+    assert (output - expected).abs().mean() < 0.05
+
+
+def test_int8_weights_are_rejected_with_the_file_name(tmp_path):
+    path = str(tmp_path / "int8.bin")
+    data = np.array([INT8_TAG], dtype="<u4").tobytes() + bytes(16)
+    with open(path, "wb") as file:
+        file.write(data)
+    with pytest.raises(ValueError, match="int8.bin"):
+        NCNNModelBin(path).read(4)
+
+
+def test_unconsumed_weights_are_reported(tmp_path):
+    path = str(tmp_path / "long.bin")
+    np.zeros(5, dtype="<f4").tofile(path)
+    model_bin = NCNNModelBin(path)
+    np.testing.assert_array_equal(model_bin.read(4, tagged=False), np.zeros(4))
+    with pytest.raises(ValueError, match="4 bytes"):
+        model_bin.check_consumed()
@@ -0,0 +1,58 @@
+from progress import FFmpegProgressParser, ProgressTracker, format_duration
+
+PROGRESS_OUTPUT = """\
+frame=24
+fps=12.00
+stream_0_0_q=28.0
+out_time_us=1001000
+speed=0.5x
+progress=continue
+[libx264 @ 0x1] frame I:1
+frame=48
+fps=12.00
+progress=end
+"""
+
+
+def test_progress_parser_reports_every_block():
+    frames = []
+    parser = FFmpegProgressParser(frames.append)
+    other = [line for line in PROGRESS_OUTPUT.splitlines() if not parser.feed(line)]
+    assert frames == [24, 48]
+    assert other == ["[libx264 @ 0x1] frame I:1"]
+
+
+def test_progress_parser_ignores_bad_frame_numbers():
+    frames = []
+    parser = FFmpegProgressParser(frames.append)
+    parser.feed("frame=N/A")
+    parser.feed("progress=continue")
+    assert frames == []
+
+
+def test_tracker_weights_the_stages():
+    reports = []
+    tracker = ProgressTracker(
+        100, {"decode": 0.25, "upscale": 0.75}, reports.append, min_interval=0
+    )
+    tracker.update("decode", 100)
+    tracker.update("upscale", 50)
+    assert reports[-1].fraction == 0.625
+    assert reports[-1].frames == 50
+    assert reports[-1].percent == 62
+    tracker.finish()
+    assert reports[-1].fraction == 1.0
+    assert reports[-1].eta == 0.0
+
+
+def test_tracker_throttles_reports():
+    reports = []
+    tracker = ProgressTracker(100, {"upscale": 1.0}, reports.append, min_interval=60)
+    for frames in range(1, 11):
+        tracker.update("upscale", frames)
+    assert len(reports) == 1
+
+
+def test_format_duration():
+    assert format_duration(59.6) == "1:00"
+    assert format_duration(3725) == "1:02:05"
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+import torch
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from realesrgan.utils import RealESRGANer
+
+
+def tiny_model(scale, seed=0):
+    torch.manual_seed(seed)
+    return SRVGGNetCompact(
+        num_in_ch=3,
+        num_out_ch=3,
+        num_feat=8,
+        num_conv=2,
+        upscale=scale,
+        act_type="prelu",
+    )
+
+
+def create_upsampler(tmp_path, scale, tile=0, pre_pad=10):
+    model = tiny_model(scale)
+    model_path = str(tmp_path / f"tiny_x{scale}.pth")
+    torch.save({"params_ema": model.state_dict()}, model_path)
+    return RealESRGANer(
+        scale=scale,
+        model_path=model_path,
+        model=tiny_model(scale, seed=1),
+        tile=tile,
+        pre_pad=pre_pad,
+        device="cpu",
+        batch_size=2,
+        cache_model=False,
+    )
+
+
+def random_frames(count, height, width, seed=0):
+    generator = np.random.default_rng(seed)
+    return [
+        generator.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        for _ in range(count)
+    ]
+
+
+@pytest.mark.parametrize("scale", [1, 2, 3, 4])
+@pytest.mark.parametrize("tile", [0, 16])
+@pytest.mark.parametrize("size", [(20, 24), (23, 37)])
+def test_fast_path_matches_enhance_batch(tmp_path, scale, tile, size):
+    upsampler = create_upsampler(tmp_path, scale, tile)
+    frames = random_frames(3, *size)
+    expected = upsampler.enhance_batch(frames)
+    outputs = upsampler.enhance_batch_into(frames)
+    assert outputs.shape == (3, size[0] * scale, size[1] * scale, 3)
+    for output, reference in zip(outputs, expected):
+        assert np.array_equal(output, reference)
+
+
+def test_fast_path_writes_into_the_given_outputs(tmp_path):
+    upsampler = create_upsampler(tmp_path, 2)
+    frames = random_frames(2, 12, 14)
+    outputs = [np.zeros((24, 28, 3), np.uint8) for _ in frames]
+    assert upsampler.enhance_batch_into(frames, outputs) is outputs
+    for output, reference in zip(outputs, upsampler.enhance_batch(frames)):
+        assert np.array_equal(output, reference)
+
+
+@pytest.mark.parametrize("scale", [1, 2, 3, 4])
+@pytest.mark.parametrize("pre_pad", [0, 3, 10])
+@pytest.mark.parametrize("size", [11, 16, 23])
+def test_pad_indices_match_reflect_padding(tmp_path, scale, pre_pad, size):
+    upsampler = create_upsampler(tmp_path, scale, pre_pad=pre_pad)
+    values = np.arange(size)
+    expected = np.pad(values, (0, pre_pad), mode="reflect")
+    mod_scale = upsampler.get_mod_scale()
+    mod_pad = 0
+    if mod_scale is not None and len(expected) % mod_scale:
+        mod_pad = mod_scale - len(expected) % mod_scale
+        expected = np.pad(expected, (0, mod_pad), mode="reflect")
+    indices, pad = upsampler.pad_indices(size)
+    assert pad == mod_pad
+    assert np.array_equal(values[indices], expected)
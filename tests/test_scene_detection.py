@@ -0,0 +1,76 @@
+import numpy as np
+
+from scene_detection import (
+    ANALYSIS_HEIGHT,
+    ANALYSIS_WIDTH,
+    SceneCutDetector,
+    ShotIndex,
+    ShotSplitter,
+)
+
+
+def shots(*lengths, seed=0):
+    # Shots of a still picture with a little noise, alternating between dark
+    # and bright pictures
+    generator = np.random.default_rng(seed)
+    frames = []
+    for number, length in enumerate(lengths):
+        low = 150 if number % 2 else 0
+        picture = generator.integers(low, low + 100, (ANALYSIS_HEIGHT, ANALYSIS_WIDTH))
+        noise = generator.integers(0, 3, (length, ANALYSIS_HEIGHT, ANALYSIS_WIDTH))
+        frames.append((picture + noise).astype(np.uint8))
+    return np.concatenate(frames)
+
+
+def detect(frames, chunk=None, **options):
+    detector = SceneCutDetector(**options)
+    chunk = chunk or len(frames)
+    for start in range(0, len(frames), chunk):
+        detector.feed(frames[start : start + chunk])
+    return detector.finish()
+
+
+def test_cuts_between_shots():
+    shot_index = detect(shots(30, 30, 30))
+    assert shot_index == ShotIndex((30, 60), 90)
+    assert shot_index.shots() == [(0, 30), (30, 60), (60, 90)]
+    assert shot_index.cut_times(30.0) == [1.0, 2.0]
+
+
+def test_cuts_do_not_depend_on_the_chunks():
+    frames = shots(20, 45, 13, 40)
+    assert detect(frames, chunk=7) == detect(frames)
+
+
+def test_short_shots_are_merged():
+    shot_index = detect(shots(30, 5, 30), min_shot_frames=12)
+    assert shot_index.cuts == (30,)
+
+
+def test_noise_alone_is_not_a_cut():
+    assert detect(shots(100)).cuts == ()
+
+
+class Stage:
+    def __init__(self):
+        self.shots_started = 0
+
+    def start_shot(self):
+        self.shots_started += 1
+
+
+def test_shot_splitter_splits_batches_at_the_cuts():
+    batches = []
+
+    def upscale(frames):
+        batches.append(list(frames))
+        return [frame * 2 for frame in frames]
+
+    stage = Stage()
+    splitter = ShotSplitter(upscale, [5, 12], first_frame=3, stages=(stage, None))
+    assert splitter(list(range(3, 9))) == [2 * i for i in range(3, 9)]
+    assert batches == [[3, 4], [5, 6, 7, 8]]
+    assert stage.shots_started == 1
+    splitter(list(range(9, 15)))
+    assert batches[2:] == [[9, 10, 11], [12, 13, 14]]
+    assert stage.shots_started == 2
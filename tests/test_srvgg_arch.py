@@ -0,0 +1,40 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
+
+def reference_forward(model, x):
+    # The residual as the network was trained: the nearest upsampled input
+    # added after the pixel shuffle
+    out = x
+    for layer in model.body:
+        out = layer(out)
+    out = model.upsampler(out)
+    return out + F.interpolate(x, scale_factor=model.upscale, mode="nearest")
+
+
+def create_model(scale):
+    torch.manual_seed(scale)
+    return SRVGGNetCompact(num_feat=8, num_conv=3, upscale=scale).eval()
+
+
+@pytest.mark.parametrize("scale", [2, 3, 4])
+@torch.no_grad()
+def test_forward_matches_the_interpolated_residual(scale):
+    model = create_model(scale)
+    x = torch.rand(2, 3, 13, 17)
+    assert torch.equal(model(x), reference_forward(model, x))
+
+
+@pytest.mark.parametrize("scale", [2, 3, 4])
+@pytest.mark.parametrize("mode", ["eager", "script"])
+@torch.no_grad()
+def test_optimized_network_matches(scale, mode):
+    model = create_model(scale)
+    x = torch.rand(2, 3, 13, 17)
+    optimized = model.optimize_for_inference(mode=mode)
+    output = optimized(x)
+    assert output.shape == (2, 3, 13 * scale, 17 * scale)
+    assert torch.allclose(output, reference_forward(model, x), atol=1e-5)
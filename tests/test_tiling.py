@@ -0,0 +1,117 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from realesrgan.tiling import TileCache, TileGrid, tile_forward
+
+SCALE = 2
+
+
+class SumUpsampler(nn.Module):
+    # 3x3 box sum and a nearest upsample. With inputs on a 1/16 grid every
+    # sum is exact in float32, so tiled and whole runs match bit for bit
+    # whatever the batching.
+    def forward(self, x):
+        weight = x.new_ones(x.shape[1], 1, 3, 3)
+        x = F.conv2d(x, weight, padding=1, groups=x.shape[1])
+        return F.interpolate(x, scale_factor=SCALE, mode="nearest")
+
+
+def random_frames(n, height=40, width=52, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(0, 16, (n, 3, height, width), generator=generator) / 16
+
+
+def test_grid_covers_the_image_with_equal_windows():
+    grid = TileGrid(40, 52, 16, 4)
+    covered = torch.zeros(40, 52, dtype=torch.int32)
+    for r, c in grid.tiles:
+        (y, window_y), (x, window_x) = grid.rows[r], grid.cols[c]
+        covered[y : y + grid.tile_h, x : x + grid.tile_w] += 1
+        assert 0 <= window_y <= y
+        assert y + grid.tile_h <= window_y + grid.window_h <= 40
+        assert 0 <= window_x <= x
+        assert x + grid.tile_w <= window_x + grid.window_w <= 52
+    assert covered.min() >= 1
+
+
+def test_grid_of_a_small_image_is_one_tile():
+    grid = TileGrid(10, 12, 16, 4)
+    assert grid.tiles == [(0, 0)]
+    assert (grid.window_h, grid.window_w) == (10, 12)
+
+
+def test_tiled_matches_whole_inference():
+    model = SumUpsampler()
+    frames = random_frames(2)
+    expected = model(frames)
+    output = tile_forward(model, frames, SCALE, tile_size=16, tile_pad=4)
+    assert torch.equal(output, expected)
+
+
+def test_cache_with_zero_threshold_matches_uncached():
+    model = SumUpsampler()
+    frames = random_frames(6)
+    # Frame 2 changes one corner, frames 3 and 4 repeat it, frame 5 changes
+    # the middle: most tiles are reused, the ones next to a change are not
+    frames[1] = frames[0]
+    frames[2] = frames[1]
+    frames[2, :, :5, :5] = 0
+    frames[3] = frames[2]
+    frames[4] = frames[3]
+    frames[5] = frames[4]
+    frames[5, :, 20:22, 25:27] = 1
+    cache = TileCache(tile_size=16, threshold=0)
+
+    outputs = [
+        tile_forward(model, frames[start : start + 2], SCALE, 16, 4, cache=cache)
+        for start in range(0, 6, 2)
+    ]
+    expected = tile_forward(model, frames, SCALE, 16, 4)
+    assert torch.equal(torch.cat(outputs), expected)
+    assert cache.tiles_reused > 0
+    assert cache.tiles_run + cache.tiles_reused == 6 * len(TileGrid(40, 52, 16, 4))
+
+
+def test_cache_runs_every_tile_of_the_first_frame():
+    model = SumUpsampler()
+    frames = random_frames(1)
+    cache = TileCache(tile_size=16, threshold=0)
+    tile_forward(model, frames, SCALE, 16, 4, cache=cache)
+    assert cache.tiles_run == len(TileGrid(40, 52, 16, 4))
+    assert cache.tiles_reused == 0
+
+
+def test_cache_reuses_unchanged_frames():
+    model = SumUpsampler()
+    frame = random_frames(1)
+    cache = TileCache(tile_size=16, threshold=0)
+    first = tile_forward(model, frame, SCALE, 16, 4, cache=cache)
+    tiles = cache.tiles_run
+    again = tile_forward(model, frame.clone(), SCALE, 16, 4, cache=cache)
+    assert torch.equal(first, again)
+    assert cache.tiles_run == tiles
+
+
+def test_cache_starts_over_on_a_new_layout():
+    model = SumUpsampler()
+    cache = TileCache(tile_size=16, threshold=0)
+    tile_forward(model, random_frames(1), SCALE, 16, 4, cache=cache)
+    smaller = random_frames(1, height=32, width=32, seed=1)
+    output = tile_forward(model, smaller, SCALE, 16, 4, cache=cache)
+    assert torch.equal(output, model(smaller))
+
+
+def test_cache_follows_slow_drift():
+    # Every frame is within the threshold of the previous one, but the
+    # reference is the window the cached output came from, so the drift is
+    # caught once it adds up
+    model = SumUpsampler()
+    cache = TileCache(tile_size=16, threshold=1.5 / 16)
+    frame = torch.zeros(1, 3, 32, 32)
+    outputs = [
+        tile_forward(model, frame + step / 16, SCALE, 16, 4, cache=cache)
+        for step in range(3)
+    ]
+    assert torch.equal(outputs[1], model(frame))
+    assert torch.equal(outputs[2], model(frame + 2 / 16))
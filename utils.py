@@ -10,4 +10,10 @@ def setup_logging():
 
 
 def handle_subprocess_error(error, command):
-    logging.error(f"Error running command {' '.join(command)}: {error}")
+    # Logs the failure with the end of the output of the command, the caller
+    # raises
+    message = f"Error running command {' '.join(command)}: {error}"
+    output = error.output or error.stderr
+    if output:
+        message += f"\n{output.rstrip()}"
+    logging.error(message)
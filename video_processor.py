@@ -1,81 +1,265 @@
-import os, re, logging
-from PyQt5.QtCore import QObject, pyqtSignal
+import os, logging, shutil
 from ffmpeg_integration import FFmpegHandler
 from esrgan_integration import ESRGANHandler
-from typing import List
+from streaming import StreamingPipeline
+from frame_cache import DirtyTileUpscaler, FrameDeduplicator
+from chunked import ChunkedProcessor
+from crop_detection import CropBox, CroppedUpscaler
+from encoding import EncoderProfile, split_threads
+from events import Signal
+from frame_store import create_frame_store
+from scene_detection import ShotSplitter
+from progress import (
+    CHUNKED_STAGES,
+    FRAME_STORE_STAGES,
+    STREAMING_STAGES,
+    ProgressReport,
+    ProgressTracker,
+)
+from typing import List, Optional, Tuple
 from utils import handle_subprocess_error, setup_logging
-from datetime import datetime
 
 
-class VideoProcessor(QObject):
-    progress_updated = pyqtSignal(int)
-
-    def __init__(self, destination_folder: str, video_files: List[str]):
-        super().__init__()
+class VideoProcessor:
+    def __init__(
+        self,
+        destination_folder: str,
+        video_files: List[str],
+        streaming: bool = False,
+        dedup: bool = True,
+        dedup_threshold: float = 0.0,
+        workers: int = 1,
+        resume: bool = True,
+        esrgan_handler: Optional[ESRGANHandler] = None,
+        probe_cache_folder: Optional[str] = None,
+        encoder_profile: Optional[EncoderProfile] = None,
+        frame_format: str = "png",
+        crop_detect: bool = False,
+        dirty_tiles: bool = False,
+        dirty_tile_threshold: float = 2.0,
+        scene_cuts: bool = False,
+    ):
+        # Events: overall percentage, the progress of the current video (its
+        # path and a ProgressReport), and the path of the video being
+        # started, finished (with its output) or failed (with the error)
+        self.progress_updated = Signal()
+        self.progress_detail = Signal()
+        self.video_started = Signal()
+        self.video_finished = Signal()
+        self.video_failed = Signal()
         self.destination_folder = destination_folder
         os.makedirs(self.destination_folder, exist_ok=True)
         self.video_files = video_files
-        self.ffmpeg_handler = FFmpegHandler()
-        self.esrgan_handler = ESRGANHandler()
+        self.ffmpeg_handler = FFmpegHandler(probe_cache_folder, encoder_profile)
+        self.esrgan_handler = esrgan_handler or ESRGANHandler()
+        self.streaming = streaming
+        # Intermediate format of the disk-based mode, see frame_store
+        self.frame_format = frame_format
+        # Upscale only the active area of letterboxed videos
+        self.crop_detect = crop_detect
+        # Upscale only the tiles that changed since the previous frames, see
+        # DirtyTileUpscaler
+        self.dirty_tiles = dirty_tiles
+        self.dirty_tile_threshold = dirty_tile_threshold
+        # Find the shot cuts first: the dedup and dirty tile caches start
+        # over at every cut, and segments are split at them
+        self.scene_cuts = scene_cuts
+        self.dedup = dedup
+        self.dedup_threshold = dedup_threshold
+        self.workers = workers
+        self.split_threads()
+        self.resume = resume
+        self._video_index = 0
+        self._overall_progress = None
+        self.progress_detail.connect(self._update_overall_progress)
+
+    def split_threads(self):
+        # The upscaler and the encoder run side by side, give each its share
+        # of the cores unless the caller chose the counts
+        upscaler_threads, encoder_threads = split_threads(workers=self.workers)
+        if self.esrgan_handler.threads is None:
+            self.esrgan_handler.threads = upscaler_threads
+        encoder_profile = self.ffmpeg_handler.encoder_profile
+        if encoder_profile.threads is None:
+            self.ffmpeg_handler.encoder_profile = encoder_profile._replace(
+                threads=encoder_threads
+            )
+
+    def get_output_path(self, video_file: str) -> str:
+        # The extension changes when the container cannot store the codec
+        output_video = os.path.join(
+            self.destination_folder, "upscaled_" + os.path.basename(video_file)
+        )
+        return self.ffmpeg_handler.encoder_profile.output_path(output_video)
 
     def set_progress_callback(self, callback):
-        self.progress_callback = callback
+        # callback gets the overall percentage
+        self.progress_updated.connect(callback)
+
+    def create_progress_tracker(self, video_file: str, stages) -> ProgressTracker:
+        # One probe up front gives the frame count the stages are measured against
+        total_frames = self.ffmpeg_handler.probe(video_file).frame_count
+        return ProgressTracker(
+            total_frames,
+            stages,
+            callback=lambda report: self.progress_detail.emit(video_file, report),
+        )
+
+    def _update_overall_progress(self, video_file: str, report: ProgressReport):
+        progress = int(
+            (self._video_index + report.fraction) / len(self.video_files) * 100
+        )
+        if progress != self._overall_progress:
+            self._overall_progress = progress
+            self.progress_updated.emit(progress)
 
     def process_video(self, video_file: str):
         logging.info(f"Processing video: {video_file}")
+        if self.workers > 1 or (self.streaming and self.resume):
+            # Segments are checkpointed, so an interrupted job can resume
+            self.process_video_chunked(video_file)
+            return
+        if self.streaming:
+            self.stream_video(video_file)
+            return
+        self.process_video_frames(video_file)
 
-        # Extract the frame rate of the video
-        frame_rate = self.ffmpeg_handler.get_frame_rate(video_file)
-
-        frame_folder = os.path.join(self.destination_folder, "temp_frames")
-        os.makedirs(frame_folder, exist_ok=True)
-        ffmpeg_command = [
-            "ffmpeg",
-            "-i",
+    def process_video_frames(self, video_file: str):
+        # Disk-based mode: the decoder, upscaler and encoder exchange frames
+        # through stores next to the output
+        upscaled_video = self.get_output_path(video_file)
+        work_folder = upscaled_video + ".frames"
+        # Stores append, leftovers of an interrupted run would corrupt them
+        shutil.rmtree(work_folder, ignore_errors=True)
+        width, height = self.ffmpeg_handler.get_frame_size(video_file)
+        scale = self.esrgan_handler.scale
+        frames = create_frame_store(
+            self.frame_format, os.path.join(work_folder, "frames"), width, height
+        )
+        upscaled_frames = create_frame_store(
+            self.frame_format,
+            os.path.join(work_folder, "upscaled"),
+            width * scale,
+            height * scale,
+        )
+        tracker = self.create_progress_tracker(video_file, FRAME_STORE_STAGES)
+        self.ffmpeg_handler.extract_frames(
             video_file,
-            "-vf",
-            f"fps={frame_rate}",
-            os.path.join(frame_folder, "frame_%04d.png"),
-        ]
-
-        # Run the FFmpeg command and handle progress updates
-        self.ffmpeg_handler.run_subprocess(
-            ffmpeg_command, progress_callback=self.progress_callback
+            frames,
+            progress_callback=lambda count: tracker.update("extract", count),
         )
+        self.esrgan_handler.upscale_frames(
+            frames,
+            upscaled_frames,
+            progress_callback=lambda count: tracker.update("upscale", count),
+            crop_box=self.detect_crop(video_file),
+            dirty_tile_threshold=(
+                self.dirty_tile_threshold if self.dirty_tiles else None
+            ),
+            # Only the dirty tile cache has anything to start over
+            cuts=self.get_cuts(video_file) if self.dirty_tiles else None,
+        )
+        self.ffmpeg_handler.reassemble_video(
+            video_file,
+            upscaled_frames,
+            upscaled_video,
+            progress_callback=lambda count: tracker.update("encode", count),
+        )
+        tracker.finish()
+        shutil.rmtree(work_folder)
+
+    def detect_crop(self, video_file: str) -> Optional[CropBox]:
+        if not self.crop_detect:
+            return None
+        return self.ffmpeg_handler.detect_crop(video_file)
+
+    def get_cuts(self, video_file: str) -> Optional[Tuple[int, ...]]:
+        if not self.scene_cuts:
+            return None
+        return self.ffmpeg_handler.get_shot_index(video_file).cuts
+
+    def stream_video(self, video_file: str):
+        # Frames go from the decoder through the upscaler into the encoder
+        # without touching the disk
+        upscaled_video = self.get_output_path(video_file)
+        width, height = self.ffmpeg_handler.get_frame_size(video_file)
+        upscale = self.esrgan_handler.upscale_batch
+        tile_upscaler = dedup_upscaler = None
+        if self.dirty_tiles:
+            upscale = tile_upscaler = DirtyTileUpscaler(
+                self.esrgan_handler, self.dirty_tile_threshold
+            )
+        crop_box = self.detect_crop(video_file)
+        if crop_box is not None:
+            upscale = CroppedUpscaler(upscale, crop_box, self.esrgan_handler.scale)
+            width, height = crop_box.width, crop_box.height
+        if self.dedup:
+            # Held frames reuse the output of the frame they repeat
+            upscale = dedup_upscaler = FrameDeduplicator(
+                upscale, threshold=self.dedup_threshold
+            )
+        cuts = self.get_cuts(video_file)
+        if cuts:
+            upscale = ShotSplitter(
+                upscale, cuts, stages=(dedup_upscaler, tile_upscaler)
+            )
+        pipeline = StreamingPipeline(
+            self.ffmpeg_handler,
+            upscale,
+            batch_size=self.esrgan_handler.prepare(
+                width,
+                height,
+                tile_upscaler.tile_cache.tile_size if tile_upscaler else None,
+            ),
+        )
+        tracker = self.create_progress_tracker(video_file, STREAMING_STAGES)
+        pipeline.run(video_file, upscaled_video, progress_callback=tracker.update)
+        tracker.finish()
+        if self.dedup:
+            dedup_upscaler.report(video_file)
+        if self.dirty_tiles:
+            tile_upscaler.report(video_file)
+
+    def process_video_chunked(self, video_file: str):
+        # Segments of one video are upscaled in parallel worker processes
+        upscaled_video = self.get_output_path(video_file)
+        processor = ChunkedProcessor(
+            self.ffmpeg_handler,
+            self.esrgan_handler.get_settings(),
+            workers=self.workers,
+            dedup=self.dedup,
+            dedup_threshold=self.dedup_threshold,
+            resume=self.resume,
+            crop_detect=self.crop_detect,
+            dirty_tiles=self.dirty_tiles,
+            dirty_tile_threshold=self.dirty_tile_threshold,
+            scene_cuts=self.scene_cuts,
+        )
+        tracker = self.create_progress_tracker(video_file, CHUNKED_STAGES)
+        processor.run(video_file, upscaled_video, progress_callback=tracker.update)
+        tracker.finish()
 
     def run(self):
         logging.info("Starting video processing")
-        total_videos = len(self.video_files)
+        self._overall_progress = None
         for index, video_file in enumerate(self.video_files):
-            self.process_video(video_file)
-            progress = int((index + 1) / total_videos * 100)
-            self.progress_updated.emit(progress)
+            self._video_index = index
+            self.video_started.emit(video_file)
+            try:
+                self.process_video(video_file)
+            except Exception as error:
+                self.video_failed.emit(video_file, error)
+                raise
+            self.video_finished.emit(video_file, self.get_output_path(video_file))
 
-    def get_total_frames(self):
-        # Assuming self.video_duration and self.frame_rate are already set
-        total_seconds = self.get_seconds(self.video_duration)
-        return int(total_seconds * self.frame_rate)
-
-    @staticmethod
-    def get_seconds(duration_str):
-        # Convert duration string (HH:MM:SS.ms) to total seconds
-        time_obj = datetime.strptime(duration_str, "%H:%M:%S.%f")
-        return (
-            time_obj.hour * 3600
-            + time_obj.minute * 60
-            + time_obj.second
-            + time_obj.microsecond / 1e6
-        )
 
-    def handle_ffmpeg_output(self, line):
-        print("FFmpeg output:", line)
-        # Parse the FFmpeg output line to extract frame number or other progress indicators
-        # For example, if the line contains 'frame=123', extract '123' as the current frame
-        # Calculate progress percentage based on total frames and emit signal
-        # Example parsing (you may need to adjust it based on actual FFmpeg output):
-        match = re.search(r"frame=\s*(\d+)", line)
-        if match:
-            current_frame = int(match.group(1))
-            total_frames = self.get_total_frames()
-            progress = int((current_frame / total_frames) * 100)
-            self.progress_updated.emit(progress)
+def upscale_videos(
+    video_files: List[str], destination_folder: str, progress_callback=None, **options
+) -> List[str]:
+    # Plain Python entry point: runs the whole pipeline and returns the paths
+    # of the upscaled videos
+    processor = VideoProcessor(destination_folder, video_files, **options)
+    if progress_callback:
+        processor.progress_updated.connect(progress_callback)
+    processor.run()
+    return [processor.get_output_path(video_file) for video_file in video_files]